@@ -5,17 +5,19 @@ Professional-grade image processing using OpenCV
 
 import cv2
 import numpy as np
-import os
-from django.conf import settings
+import logging
 
-try:
-    from rembg import remove
-except ImportError:
-    remove = None
+from . import colorizer, encoding, metrics, segmentation, smoothing, storage
+from .ai_presets import channel_lut, scale_saturation, _scaled_table
+from .blur import gaussian_blur
+from .memory import scratch
+from .working_image import WorkingImage
 
 from PIL import Image
 import io
 
+logger = logging.getLogger(__name__)
+
 
 class AIEngine:
     
@@ -31,47 +33,88 @@ class AIEngine:
             return img
         elif isinstance(source, np.ndarray):
             return source
+        elif isinstance(source, WorkingImage):
+            return source.bgr()
         raise ValueError("Unknown image source type")
 
+    @staticmethod
+    def _working(source, inplace=False):
+        """Wrap the input in a WorkingImage; a passed WorkingImage is edited directly."""
+        if isinstance(source, WorkingImage):
+            return source
+        # A frame read from disk belongs to this call
+        return WorkingImage(AIEngine._read_image(source), owned=inplace or isinstance(source, str))
+
+    @staticmethod
+    def _finish(frame, source, ref_path, suffix, return_path):
+        """Return the WorkingImage to a pipeline caller, else save or return it as BGR."""
+        if isinstance(source, WorkingImage) and not return_path:
+            return frame
+        return AIEngine._save_result(frame.bgr(), ref_path, suffix, return_path)
+
     @staticmethod
     def _save_result(image, original_path, suffix, return_path=True):
-        """Helper to save processed image and return relative path."""
+        """Helper to save processed image to the default storage and return its name."""
         if not return_path:
             return image
-            
-        # Create output filename
-        filename = os.path.basename(original_path)
-        name, ext = os.path.splitext(filename)
-        new_filename = f"{name}_{suffix}{ext}"
-        
-        # Ensure directory exists
-        processed_dir = os.path.join(settings.MEDIA_ROOT, 'processed')
-        os.makedirs(processed_dir, exist_ok=True)
-        
-        output_path = os.path.join(processed_dir, new_filename)
-        cv2.imwrite(output_path, image)
-        
-        # Return relative path for Django ImageField
-        return os.path.join('processed', new_filename)
+
+        # Encoded in memory with the deployment's encoding policy and stored
+        # through the configured storage backend
+        data, info = encoding.encode(image, encoding.resolve(source_name=original_path))
+        name = storage.output_name(original_path, suffix, '.' + info['format'])
+        return storage.save_output(storage.content_name(name, storage.digest(data)), data)
+
+    @staticmethod
+    def _gray_world(img, out=None, means=None):
+        """
+        Gray World white balance as per-channel lookup tables.
+
+        Same result as scaling float32 channels by avg_gray / avg_channel,
+        without a float copy of the frame. Pass out=img to work in place,
+        and `means` (B, G, R) when img is one band of a larger frame.
+        """
+        if means is None:
+            means = cv2.mean(img)[:3]
+        avg_b, avg_g, avg_r = (np.float32(m) for m in means)
+        avg_gray = (avg_b + avg_g + avg_r) / 3
+        tables = [_scaled_table(avg_gray / avg) if avg > 0 else np.arange(256, dtype=np.uint8)
+                  for avg in (avg_b, avg_g, avg_r)]
+        return channel_lut(img, tables, out=out)
+
+    @staticmethod
+    def _clahe_luminance(frame, clip_limit):
+        """CLAHE on the LAB L channel of a WorkingImage, which is left in LAB."""
+        lab = frame.writable('lab')
+        l = scratch('plane', lab.shape[:2])
+        cv2.extractChannel(lab, 0, dst=l)
+        clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(8, 8))
+        clahe.apply(l, dst=l)
+        cv2.insertChannel(l, lab, 0)
+        return frame
 
     # ============== ENHANCED PROCESSING METHODS ==============
 
     @staticmethod
+    @metrics.instrument('colorize')
     def colorize_image(image_input, return_path=True, ref_path=""):
         """
-        Apply enhanced vintage colorization with proper sepia toning.
-        Much better than simple colormap approach.
+        Colorize with the learned model when one is configured (see
+        api.colorizer), else apply enhanced vintage colorization with
+        proper sepia toning. Much better than simple colormap approach.
         """
-        img = AIEngine._read_image(image_input)
-        
-        # Convert to grayscale if needed
-        if len(img.shape) == 3:
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if isinstance(image_input, np.ndarray) and image_input.ndim == 2:
+            frame = WorkingImage(image_input, space='gray')
         else:
-            gray = img
+            frame = AIEngine._working(image_input)
+
+        model = colorizer.get_model()
+        if model is not None:
+            # The frame stays in LAB for the next stage
+            colorizer.colorize(frame, model)
+            return AIEngine._finish(frame, image_input, ref_path, 'colorized', return_path)
         
-        # Convert back to BGR for processing
-        img_bgr = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+        # Grayscale (a cached view when the frame already is gray), back to BGR for processing
+        sepia = cv2.cvtColor(frame.view('gray'), cv2.COLOR_GRAY2BGR)
         
         # Apply sepia transform matrix (classic sepia tone) - Corrected for BGR
         sepia_kernel = np.array([
@@ -79,47 +122,49 @@ class AIEngine:
             [0.168, 0.686, 0.349],
             [0.189, 0.769, 0.393]
         ])
-        sepia = cv2.transform(img_bgr, sepia_kernel)
-        sepia = np.clip(sepia, 0, 255).astype(np.uint8)
+        # The input is gray, so the transform reduces to one lookup table per channel
+        ramp = cv2.cvtColor(np.arange(256, dtype=np.uint8).reshape(1, 256), cv2.COLOR_GRAY2BGR)
+        sepia_tables = cv2.split(cv2.transform(ramp, sepia_kernel))
+        channel_lut(sepia, [t.ravel() for t in sepia_tables], out=sepia)
+        frame.replace(sepia)
         
         # Enhance contrast for vintage look
-        lab = cv2.cvtColor(sepia, cv2.COLOR_BGR2LAB)
-        l, a, b = cv2.split(lab)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        l = clahe.apply(l)
-        enhanced = cv2.merge([l, a, b])
-        final = cv2.cvtColor(enhanced, cv2.COLOR_LAB2BGR)
+        AIEngine._clahe_luminance(frame, 2.0)
         
         # Add subtle warm tint
-        final = final.astype(np.float32)
-        final[:, :, 2] = np.clip(final[:, :, 2] * 1.05, 0, 255)  # Slight red boost
-        final = final.astype(np.uint8)
+        final = frame.writable('bgr')
+        identity = np.arange(256, dtype=np.uint8)
+        channel_lut(final, (identity, identity, _scaled_table(1.05)), out=final)  # Slight red boost
         
-        return AIEngine._save_result(final, ref_path, 'colorized', return_path)
+        return AIEngine._finish(frame, image_input, ref_path, 'colorized', return_path)
 
     @staticmethod
-    def adjust_image(image_input, brightness=1.0, contrast=1.0, saturation=1.0, return_path=True, ref_path=""):
-        """Adjust brightness, contrast, and saturation."""
-        img = AIEngine._read_image(image_input)
+    @metrics.instrument('adjust')
+    def adjust_image(image_input, brightness=1.0, contrast=1.0, saturation=1.0, return_path=True, ref_path="", inplace=False):
+        """
+        Adjust brightness, contrast, and saturation.
+
+        With inplace=True the input array is modified (low-memory mode).
+        """
+        frame = AIEngine._working(image_input, inplace)
 
         # 1. Brightness and Contrast
         beta = (brightness - 1.0) * 100
-        adjusted = cv2.convertScaleAbs(img, alpha=contrast, beta=beta)
+        adjusted = frame.writable(frame.channels)
+        cv2.convertScaleAbs(adjusted, dst=adjusted, alpha=contrast, beta=beta)
         
-        # 2. Saturation
+        # 2. Saturation (the frame stays in HSV for the next stage)
         if saturation != 1.0:
-            hsv = cv2.cvtColor(adjusted, cv2.COLOR_BGR2HSV).astype(np.float32)
-            hsv[:, :, 1] = hsv[:, :, 1] * saturation
-            hsv[:, :, 1] = np.clip(hsv[:, :, 1], 0, 255)
-            adjusted = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
+            scale_saturation(frame, saturation)
             
-        return AIEngine._save_result(adjusted, ref_path, 'adjusted', return_path)
+        return AIEngine._finish(frame, image_input, ref_path, 'adjusted', return_path)
 
     @staticmethod
+    @metrics.instrument('remove_scratches')
     def remove_scratches(image_input, strength=50, return_path=True, ref_path=""):
         """
         Enhanced scratch removal with multi-pass denoising.
-        Uses bilateral filter to preserve edges while removing noise.
+        Uses an edge-preserving filter (see api.smoothing) to keep edges while removing noise.
         
         Args:
             strength: 0-100, higher = more aggressive denoising
@@ -130,72 +175,72 @@ class AIEngine:
         h_value = max(3, min(15, int(strength / 10)))  # 3-15 range
         
         # Pass 1: Non-local means denoising (best for noise)
+        # Positional: the colour strength keyword differs between OpenCV releases
         denoised = cv2.fastNlMeansDenoisingColored(
             img, None, 
-            h=h_value,           # Luminance noise
-            hForColorComponents=h_value,  # Color noise
-            templateWindowSize=7, 
-            searchWindowSize=21
+            h_value,             # Luminance noise
+            h_value,             # Color noise
+            7,                   # templateWindowSize
+            21                   # searchWindowSize
         )
         
         # Pass 2: Bilateral filter for edge preservation
         # This smooths while keeping edges sharp
         if strength > 30:
-            denoised = cv2.bilateralFilter(denoised, d=9, sigmaColor=75, sigmaSpace=75)
+            denoised = smoothing.edge_preserving(denoised, 9, 75, 75)
         
         # Pass 3: Light sharpening to restore detail
         if strength > 20:
             gaussian = cv2.GaussianBlur(denoised, (0, 0), 1.0)
-            denoised = cv2.addWeighted(denoised, 1.2, gaussian, -0.2, 0)
+            denoised = cv2.addWeighted(denoised, 1.2, gaussian, -0.2, 0, dst=gaussian)
         
         return AIEngine._save_result(denoised, ref_path, 'restored', return_path)
 
     @staticmethod
+    @metrics.instrument('restore_faces')
     def restore_faces(image_input, return_path=True, ref_path=""):
         """
         Enhanced face restoration with unsharp mask and local contrast.
         Better than simple sharpening.
         """
-        img = AIEngine._read_image(image_input)
+        frame = AIEngine._working(image_input)
         
         # 1. Apply CLAHE for local contrast enhancement
-        lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-        l, a, b = cv2.split(lab)
-        clahe = cv2.createCLAHE(clipLimit=2.5, tileGridSize=(8, 8))
-        l = clahe.apply(l)
-        enhanced = cv2.merge([l, a, b])
-        enhanced = cv2.cvtColor(enhanced, cv2.COLOR_LAB2BGR)
+        AIEngine._clahe_luminance(frame, 2.5)
+        enhanced = frame.writable('bgr')
         
         # 2. Unsharp mask for sharpening (better than simple kernel)
-        gaussian = cv2.GaussianBlur(enhanced, (0, 0), 2.0)
-        sharpened = cv2.addWeighted(enhanced, 1.5, gaussian, -0.5, 0)
+        gaussian = cv2.GaussianBlur(enhanced, (0, 0), 2.0, dst=frame.borrow(enhanced.shape))
+        sharpened = cv2.addWeighted(enhanced, 1.5, gaussian, -0.5, 0, dst=gaussian)
         
         # 3. Light denoising to smooth skin while keeping features
-        result = cv2.bilateralFilter(sharpened, d=5, sigmaColor=50, sigmaSpace=50)
+        result = smoothing.edge_preserving(sharpened, 5, 50, 50)
+        frame.replace(result)
         
-        return AIEngine._save_result(result, ref_path, 'face_restored', return_path)
+        return AIEngine._finish(frame, image_input, ref_path, 'face_restored', return_path)
 
     @staticmethod
+    @metrics.instrument('remove_background')
     def remove_background(image_input, return_path=True, ref_path=""):
         """Remove background using rembg or improved GrabCut fallback."""
         img_array = AIEngine._read_image(image_input)
         
         # Try rembg first (best quality)
-        if remove is not None:
+        if segmentation.available():
             try:
                 success, encoded_img = cv2.imencode(".png", img_array)
                 if success:
                     input_bytes = encoded_img.tobytes()
-                    output_bytes = remove(input_bytes)
+                    output_bytes = segmentation.remove(input_bytes)
                     
                     nparr = np.frombuffer(output_bytes, np.uint8)
                     img_nobg = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
                     return AIEngine._save_result(img_nobg, ref_path, 'nobg', return_path)
             except Exception as e:
-                print(f"rembg failed: {e}")
+                logger.warning("rembg failed: %s", e)
 
         # Improved GrabCut fallback
-        print("Using improved GrabCut")
+        logger.info("Using improved GrabCut")
         h, w = img_array.shape[:2]
         
         # Better rectangle - slightly inset from edges
@@ -235,43 +280,33 @@ class AIEngine:
         return AIEngine._save_result(result_rgba, ref_path, 'nobg_grabcut', return_path)
 
     @staticmethod
-    def auto_enhance(image_input, return_path=True, ref_path=""):
+    @metrics.instrument('auto_enhance')
+    def auto_enhance(image_input, return_path=True, ref_path="", inplace=False, means=None):
         """
         Enhanced auto-enhancement with:
         - CLAHE for contrast
         - Auto white balance
         - Subtle saturation boost
+
+        With inplace=True the input array is modified (low-memory mode).
+        `means` are precomputed BGR channel means (see api.image_stats).
         """
-        img = AIEngine._read_image(image_input)
+        frame = AIEngine._working(image_input, inplace)
         
         # 1. Auto White Balance (Gray World algorithm)
-        img_float = img.astype(np.float32)
-        avg_b = np.mean(img_float[:, :, 0])
-        avg_g = np.mean(img_float[:, :, 1])
-        avg_r = np.mean(img_float[:, :, 2])
-        avg_gray = (avg_b + avg_g + avg_r) / 3
-        
-        img_float[:, :, 0] = np.clip(img_float[:, :, 0] * (avg_gray / avg_b), 0, 255)
-        img_float[:, :, 1] = np.clip(img_float[:, :, 1] * (avg_gray / avg_g), 0, 255)
-        img_float[:, :, 2] = np.clip(img_float[:, :, 2] * (avg_gray / avg_r), 0, 255)
-        balanced = img_float.astype(np.uint8)
+        balanced = frame.writable('bgr')
+        AIEngine._gray_world(balanced, out=balanced, means=means)
         
         # 2. CLAHE on L channel
-        lab = cv2.cvtColor(balanced, cv2.COLOR_BGR2LAB)
-        l, a, b = cv2.split(lab)
-        clahe = cv2.createCLAHE(clipLimit=2.5, tileGridSize=(8, 8))
-        l = clahe.apply(l)
-        enhanced = cv2.merge([l, a, b])
-        final = cv2.cvtColor(enhanced, cv2.COLOR_LAB2BGR)
+        AIEngine._clahe_luminance(frame, 2.5)
         
-        # 3. Subtle saturation boost
-        hsv = cv2.cvtColor(final, cv2.COLOR_BGR2HSV).astype(np.float32)
-        hsv[:, :, 1] = np.clip(hsv[:, :, 1] * 1.1, 0, 255)
-        final = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
+        # 3. Subtle saturation boost (the frame stays in HSV for the next stage)
+        scale_saturation(frame, 1.1)
         
-        return AIEngine._save_result(final, ref_path, 'auto_enhanced', return_path)
+        return AIEngine._finish(frame, image_input, ref_path, 'auto_enhanced', return_path)
 
     @staticmethod
+    @metrics.instrument('inpaint')
     def inpaint_object(image_input, mask_input, return_path=True, ref_path=""):
         """Object removal using inpainting with mask."""
         img = AIEngine._read_image(image_input)
@@ -311,6 +346,7 @@ class AIEngine:
         return AIEngine._save_result(inpainted, ref_path, 'inpainted', return_path)
 
     @staticmethod
+    @metrics.instrument('upscale')
     def upscale_image(image_input, scale=2, return_path=True, ref_path=""):
         """
         Enhanced upscaling with:
@@ -329,7 +365,7 @@ class AIEngine:
         upscaled = cv2.resize(img, new_size, interpolation=cv2.INTER_LANCZOS4)
         
         # 2. Light denoising to reduce interpolation artifacts
-        upscaled = cv2.bilateralFilter(upscaled, d=5, sigmaColor=30, sigmaSpace=30)
+        upscaled = smoothing.edge_preserving(upscaled, 5, 30, 30)
         
         # 3. Adaptive sharpening (unsharp mask)
         gaussian = cv2.GaussianBlur(upscaled, (0, 0), 1.5)
@@ -340,6 +376,7 @@ class AIEngine:
     # ============== NEW METHODS ==============
 
     @staticmethod
+    @metrics.instrument('denoise')
     def denoise_advanced(image_input, strength=50, return_path=True, ref_path=""):
         """
         Advanced denoising with configurable strength.
@@ -354,52 +391,42 @@ class AIEngine:
         h_color = max(3, int(strength / 6))  # 3-16
         
         # Non-local means denoising
+        # Positional: the colour strength keyword differs between OpenCV releases
         denoised = cv2.fastNlMeansDenoisingColored(
             img, None,
-            h=h_luminance,
-            hForColorComponents=h_color,
-            templateWindowSize=7,
-            searchWindowSize=21
+            h_luminance,
+            h_color,
+            7,   # templateWindowSize
+            21   # searchWindowSize
         )
         
-        # Additional bilateral for higher strengths
+        # Additional edge-preserving smoothing for higher strengths (backend per quality tier)
         if strength > 50:
             d = 9 if strength > 75 else 7
-            denoised = cv2.bilateralFilter(denoised, d=d, sigmaColor=75, sigmaSpace=75)
+            denoised = smoothing.edge_preserving(denoised, d, 75, 75)
         
         return AIEngine._save_result(denoised, ref_path, 'denoised', return_path)
 
     @staticmethod
-    def correct_white_balance(image_input, return_path=True, ref_path=""):
+    @metrics.instrument('white_balance')
+    def correct_white_balance(image_input, return_path=True, ref_path="", inplace=False, means=None):
         """
         Auto white balance using Gray World algorithm.
         Corrects color casts in photos.
+
+        With inplace=True the input array is modified (low-memory mode).
+        `means` are precomputed BGR channel means (see api.image_stats).
         """
-        img = AIEngine._read_image(image_input)
-        
-        img_float = img.astype(np.float32)
-        
-        # Calculate channel averages
-        avg_b = np.mean(img_float[:, :, 0])
-        avg_g = np.mean(img_float[:, :, 1])
-        avg_r = np.mean(img_float[:, :, 2])
+        frame = AIEngine._working(image_input, inplace)
         
         # Gray world assumption: average should be gray
-        avg_gray = (avg_b + avg_g + avg_r) / 3
-        
-        # Scale channels
-        if avg_b > 0:
-            img_float[:, :, 0] = np.clip(img_float[:, :, 0] * (avg_gray / avg_b), 0, 255)
-        if avg_g > 0:
-            img_float[:, :, 1] = np.clip(img_float[:, :, 1] * (avg_gray / avg_g), 0, 255)
-        if avg_r > 0:
-            img_float[:, :, 2] = np.clip(img_float[:, :, 2] * (avg_gray / avg_r), 0, 255)
-        
-        result = img_float.astype(np.uint8)
-        return AIEngine._save_result(result, ref_path, 'wb_corrected', return_path)
+        result = frame.writable('bgr')
+        AIEngine._gray_world(result, out=result, means=means)
+        return AIEngine._finish(frame, image_input, ref_path, 'wb_corrected', return_path)
 
     @staticmethod
-    def apply_filter_preset(image_input, preset_name, return_path=True, ref_path=""):
+    @metrics.instrument('filter_preset')
+    def apply_filter_preset(image_input, preset_name, return_path=True, ref_path="", inplace=False):
         """
         Apply a professional filter preset.
         
@@ -407,13 +434,14 @@ class AIEngine:
         """
         from .ai_presets import apply_preset
         
-        img = AIEngine._read_image(image_input)
-        result = apply_preset(img, preset_name)
-        return AIEngine._save_result(result, ref_path, f'filter_{preset_name}', return_path)
+        frame = AIEngine._working(image_input, inplace)
+        apply_preset(frame, preset_name)
+        return AIEngine._finish(frame, image_input, ref_path, f'filter_{preset_name}', return_path)
 
     # ============== ADVANCED AI FEATURES ==============
 
     @staticmethod
+    @metrics.instrument('generative_inpaint')
     def generative_inpaint(image_input, mask_input, return_path=True, ref_path=""):
         """
         Advanced inpainting using OpenCV's TELEA and NS algorithms.
@@ -453,7 +481,7 @@ class AIEngine:
         
         # Optional: blend edges for smoother transition
         # Create soft mask for blending
-        soft_mask = cv2.GaussianBlur(mask.astype(np.float32) / 255, (15, 15), 0)
+        soft_mask = gaussian_blur(mask.astype(np.float32) / 255, ksize=15)
         soft_mask = np.expand_dims(soft_mask, axis=2)
         
         # Blend original edges with inpainted
@@ -462,6 +490,7 @@ class AIEngine:
         return AIEngine._save_result(result, ref_path, 'inpainted', return_path)
 
     @staticmethod
+    @metrics.instrument('replace_background')
     def replace_background(image_input, bg_type='blur', bg_color=(255, 255, 255), blur_strength=25, return_path=True, ref_path=""):
         """
         Replace or modify background.
@@ -474,12 +503,12 @@ class AIEngine:
         img = AIEngine._read_image(image_input)
         
         # Get foreground mask using rembg or GrabCut
-        if remove is not None:
+        if segmentation.available():
             try:
                 success, encoded_img = cv2.imencode(".png", img)
                 if success:
                     input_bytes = encoded_img.tobytes()
-                    output_bytes = remove(input_bytes)
+                    output_bytes = segmentation.remove(input_bytes)
                     nparr = np.frombuffer(output_bytes, np.uint8)
                     img_rgba = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
                     
@@ -513,7 +542,7 @@ class AIEngine:
             # Blurred version of original (portrait mode effect)
             # Ensure blur_strength is odd
             blur_strength = blur_strength if blur_strength % 2 == 1 else blur_strength + 1
-            background = cv2.GaussianBlur(img, (blur_strength, blur_strength), 0)
+            background = gaussian_blur(img, ksize=blur_strength)
         elif bg_type == 'solid':
             # Solid color background
             background = np.full(img.shape, bg_color[::-1], dtype=np.uint8)  # BGR
@@ -536,10 +565,12 @@ class AIEngine:
         return AIEngine._save_result(result, ref_path, 'bg_replaced', return_path)
 
     @staticmethod
-    def enhance_face_details(image_input, eye_enhance=True, skin_smooth=True, sharpen_strength=1.2, return_path=True, ref_path=""):
+    @metrics.instrument('enhance_face_details')
+    def enhance_face_details(image_input, eye_enhance=True, skin_smooth=True, sharpen_strength=1.2, return_path=True, ref_path="", faces=None):
         """
         Targeted face enhancement with eye brightening and skin smoothing.
-        Uses Haar cascades for face detection.
+        Uses Haar cascades for face detection; pass `faces` (x, y, w, h)
+        boxes to skip it (see api.image_stats).
         """
         img = AIEngine._read_image(image_input)
         result = img.copy()
@@ -548,11 +579,12 @@ class AIEngine:
         face_cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
         eye_cascade_path = cv2.data.haarcascades + 'haarcascade_eye.xml'
         
-        face_cascade = cv2.CascadeClassifier(face_cascade_path)
         eye_cascade = cv2.CascadeClassifier(eye_cascade_path)
         
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+        if faces is None:
+            face_cascade = cv2.CascadeClassifier(face_cascade_path)
+            faces = face_cascade.detectMultiScale(gray, 1.3, 5)
         
         for (x, y, w, h) in faces:
             # Extract face region with margin
@@ -564,9 +596,9 @@ class AIEngine:
             
             face_region = result[y1:y2, x1:x2].copy()
             
-            # Skin smoothing with bilateral filter
+            # Skin smoothing with an edge-preserving filter
             if skin_smooth:
-                smooth = cv2.bilateralFilter(face_region, d=9, sigmaColor=75, sigmaSpace=75)
+                smooth = smoothing.edge_preserving(face_region, 9, 75, 75)
                 # Blend to keep some texture
                 face_region = cv2.addWeighted(face_region, 0.3, smooth, 0.7, 0)
             
@@ -6,6 +6,9 @@ Professional-grade photo filter configurations
 import cv2
 import numpy as np
 
+from .blur import gaussian_blur
+from .working_image import WorkingImage
+
 # Filter Preset Configurations
 PRESETS = {
     'vintage': {
@@ -56,164 +59,297 @@ PRESETS = {
 }
 
 
-def apply_sepia(img, strength=0.5):
-    """Apply sepia tone effect"""
+# Rows per band for per-pixel float math, keeps float temporaries small
+BAND_ROWS = 64
+
+
+def channel_lut(img, tables, out=None):
+    """
+    Apply one 256-entry lookup table per channel (B, G, R) to a uint8 image.
+
+    Equivalent to the float32 multiply/add + clip + astype(uint8) chains,
+    without a float copy of the frame. Pass out=img to work in place.
+    """
+    lut = np.stack([np.asarray(t, dtype=np.uint8) for t in tables], axis=-1).reshape(1, 256, 3)
+    return cv2.LUT(img, lut, dst=out)
+
+
+def _identity_table():
+    return np.arange(256, dtype=np.uint8)
+
+
+def _scaled_table(factor):
+    values = np.arange(256, dtype=np.float32)
+    return np.clip(values * np.float32(factor), 0, 255).astype(np.uint8)
+
+
+def _offset_table(offset):
+    values = np.arange(256, dtype=np.float32)
+    return np.clip(values + np.float32(offset), 0, 255).astype(np.uint8)
+
+
+def scale_saturation(img, factor, out=None):
+    """
+    Multiply HSV saturation by factor (uint8 throughout).
+
+    A WorkingImage is edited in HSV and left there for the next stage.
+    """
+    from .memory import scratch
+
+    saturation = (_identity_table(), _scaled_table(factor), _identity_table())
+    if isinstance(img, WorkingImage):
+        hsv = img.writable('hsv')
+        channel_lut(hsv, saturation, out=hsv)
+        return img
+
+    hsv = scratch('color', img.shape)
+    cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=hsv)
+    channel_lut(hsv, saturation, out=hsv)
+    if out is None:
+        return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=out)
+
+
+def apply_sepia(img, strength=0.5, out=None, buffer=None):
+    """Apply sepia tone effect (`buffer` receives the sepia tone, a scratch buffer by default)"""
+    from .memory import scratch
+
     # Correct matrix for BGR (swapped R and B coefficients relative to RGB matrix)
     sepia_kernel = np.array([
         [0.131, 0.534, 0.272],  # Blue channel formula
         [0.168, 0.686, 0.349],  # Green channel formula
         [0.189, 0.769, 0.393]   # Red channel formula
     ])
-    sepia = cv2.transform(img, sepia_kernel)
-    sepia = np.clip(sepia, 0, 255).astype(np.uint8)
+    # cv2.transform saturates uint8 output, so no clip is needed
+    if buffer is None:
+        buffer = scratch('color', img.shape)
+    sepia = cv2.transform(img, sepia_kernel, dst=buffer)
     # Blend with original based on strength
-    return cv2.addWeighted(img, 1 - strength, sepia, strength, 0)
+    return cv2.addWeighted(img, 1 - strength, sepia, strength, 0, dst=out)
 
 
-def apply_vignette(img, strength=0.5):
-    """Apply vignette (dark corners) effect"""
-    rows, cols = img.shape[:2]
-    
-    # Create gradient mask
+def _vignette_factors(rows, cols, strength, frame_rows, row_offset):
+    # Separable gradient mask: the 2D kernel is the outer product Y * X.T
     X = cv2.getGaussianKernel(cols, cols * 0.5)
-    Y = cv2.getGaussianKernel(rows, rows * 0.5)
-    kernel = Y * X.T
-    mask = kernel / kernel.max()
-    
-    # Adjust strength
-    mask = mask ** (1 - strength * 0.5)
-    
-    # Apply to each channel
-    result = img.copy().astype(np.float32)
-    for i in range(3):
-        result[:, :, i] = result[:, :, i] * mask
-    
-    return np.clip(result, 0, 255).astype(np.uint8)
+    Y = cv2.getGaussianKernel(frame_rows, frame_rows * 0.5)
+    peak = Y.max() * X.max()
+    return Y[row_offset:row_offset + rows], X.T, peak, 1 - strength * 0.5
+
+
+def _vignette_band(Y, XT, peak, power):
+    mask = Y * XT
+    mask /= peak
+    mask **= power
+    return mask
+
+
+def vignette_mask(rows, cols, strength=0.5):
+    """Full-frame vignette mask, for reuse across images of one size (previews)."""
+    return _vignette_band(*_vignette_factors(rows, cols, strength, rows, 0))
 
 
-def adjust_temperature(img, temperature):
+def apply_vignette(img, strength=0.5, out=None, frame_rows=None, row_offset=0, mask=None):
+    """
+    Apply vignette (dark corners) effect
+
+    frame_rows/row_offset place `img` inside a taller frame when it is
+    one row band of a larger image (out-of-core rendering). `mask` is a
+    precomputed vignette_mask() for img's size.
+    """
+    rows, cols = img.shape[:2]
+    if out is None:
+        out = np.empty_like(img)
+    if frame_rows is None:
+        frame_rows = rows
+    if mask is None:
+        Y, XT, peak, power = _vignette_factors(rows, cols, strength, frame_rows, row_offset)
+
+    # Apply in row bands so the float mask never covers the whole frame
+    for y in range(0, rows, BAND_ROWS):
+        if mask is None:
+            band_mask = _vignette_band(Y[y:y + BAND_ROWS], XT, peak, power)
+        else:
+            band_mask = mask[y:y + BAND_ROWS]
+        band = img[y:y + BAND_ROWS].astype(np.float32)
+        if band.ndim == 3:
+            band_mask = band_mask[:, :, None]
+        np.multiply(band, band_mask, out=band, casting='unsafe')
+        out[y:y + BAND_ROWS] = np.clip(band, 0, 255).astype(np.uint8)
+    return out
+
+
+def adjust_temperature(img, temperature, out=None):
     """
     Adjust color temperature
     Positive = warmer (more yellow/orange)
     Negative = cooler (more blue)
     """
-    result = img.copy().astype(np.float32)
-    
     if temperature > 0:
         # Warm: increase red, decrease blue
-        result[:, :, 2] = np.clip(result[:, :, 2] + temperature, 0, 255)  # Red
-        result[:, :, 0] = np.clip(result[:, :, 0] - temperature * 0.5, 0, 255)  # Blue
+        blue, red = _offset_table(-temperature * 0.5), _offset_table(temperature)
     else:
         # Cool: increase blue, decrease red
-        result[:, :, 0] = np.clip(result[:, :, 0] - temperature, 0, 255)  # Blue
-        result[:, :, 2] = np.clip(result[:, :, 2] + temperature * 0.5, 0, 255)  # Red
-    
-    return result.astype(np.uint8)
+        blue, red = _offset_table(-temperature), _offset_table(temperature * 0.5)
+
+    return channel_lut(img, (blue, _identity_table(), red), out=out)
 
 
-def apply_fade(img, strength=0.15):
+def apply_fade(img, strength=0.15, out=None):
     """Apply faded/matte look by lifting blacks"""
-    result = img.copy().astype(np.float32)
-    lift = strength * 255
-    result = result + lift
-    result = np.clip(result, 0, 255)
-    return result.astype(np.uint8)
-
-
-def apply_clarity(img, strength=1.1):
-    """Enhance midtone contrast (clarity)"""
-    # High-pass filter approach
-    blur = cv2.GaussianBlur(img, (0, 0), 50)
-    highpass = cv2.addWeighted(img, 2, blur, -1, 0)
+    lift = _offset_table(strength * 255)
+    return channel_lut(img, (lift, lift, lift), out=out)
+
+
+def apply_clarity(img, strength=1.1, out=None, buffer=None, sigma=50):
+    """Enhance midtone contrast (clarity); `buffer` receives the blur, a scratch buffer by default"""
+    from .memory import scratch
+
+    if buffer is None:
+        buffer = scratch('color' if img.ndim == 3 else 'plane', img.shape)
+    # High-pass filter approach; sigma 50 goes through the pyramid blur
+    blur = gaussian_blur(img, sigma, dst=buffer)
+    highpass = cv2.addWeighted(img, 2, blur, -1, 0, dst=blur)
     
-    # Blend based on strength
+    # Blend based on strength (uint8 output is already saturated)
     blend_factor = (strength - 1) * 0.5
-    result = cv2.addWeighted(img, 1, highpass, blend_factor, 0)
-    return np.clip(result, 0, 255).astype(np.uint8)
+    return cv2.addWeighted(img, 1, highpass, blend_factor, 0, dst=out)
 
 
-def apply_shadows_tint(img, blue_shift=0, orange_shift=0):
+def apply_shadows_tint(img, blue_shift=0, orange_shift=0, out=None):
     """Tint shadows with color (cinematic look)"""
-    result = img.copy().astype(np.float32)
-    
-    # Create luminance mask for shadows
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype(np.float32)
-    shadow_mask = 1 - (gray / 255)  # Inverted: dark areas = 1
-    shadow_mask = shadow_mask ** 2  # Concentrate on darker areas
-    
-    if blue_shift > 0:
-        result[:, :, 0] = result[:, :, 0] + shadow_mask * blue_shift
-    
-    if orange_shift > 0:
-        # Orange = red + some green
-        highlight_mask = 1 - shadow_mask
-        result[:, :, 2] = result[:, :, 2] + highlight_mask * orange_shift
-        result[:, :, 1] = result[:, :, 1] + highlight_mask * (orange_shift * 0.3)
-    
-    return np.clip(result, 0, 255).astype(np.uint8)
+    if out is None:
+        out = np.empty_like(img)
+
+    # Work in row bands so float temporaries stay small
+    for y in range(0, img.shape[0], BAND_ROWS):
+        src = img[y:y + BAND_ROWS]
+        result = src.astype(np.float32)
+
+        # Create luminance mask for shadows
+        gray = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        shadow_mask = 1 - (gray / 255)  # Inverted: dark areas = 1
+        shadow_mask = shadow_mask ** 2  # Concentrate on darker areas
+
+        if blue_shift > 0:
+            result[:, :, 0] = result[:, :, 0] + shadow_mask * blue_shift
 
+        if orange_shift > 0:
+            # Orange = red + some green
+            highlight_mask = 1 - shadow_mask
+            result[:, :, 2] = result[:, :, 2] + highlight_mask * orange_shift
+            result[:, :, 1] = result[:, :, 1] + highlight_mask * (orange_shift * 0.3)
 
-def apply_preset(img, preset_name):
+        out[y:y + BAND_ROWS] = np.clip(result, 0, 255).astype(np.uint8)
+    return out
+
+
+def apply_preset(img, preset_name, inplace=False, frame_rows=None, row_offset=0, scale=1.0, vignette=None):
     """
     Apply a complete filter preset to an image
     Returns processed image
+
+    Takes a BGR array or a WorkingImage; a WorkingImage is returned as is,
+    left in the colour space of the last step. With inplace=True every
+    step writes into `img` (low-memory mode).
+    frame_rows/row_offset position a row band for the vignette.
+    scale is img's size relative to the full frame (previews) and scales
+    the clarity radius; vignette is a precomputed vignette_mask(..., 0.6).
     """
     if preset_name not in PRESETS:
         return img
     
     config = PRESETS[preset_name]
-    result = img.copy()
+    frame = WorkingImage.wrap(img, owned=inplace)
     
-    # Apply grayscale first if needed
+    # Apply grayscale first if needed; black & white presets then work on one plane
     if config.get('grayscale', False):
-        gray = cv2.cvtColor(result, cv2.COLOR_BGR2GRAY)
-        result = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+        frame.writable('gray')
     
     # Apply sepia
     if 'sepia_strength' in config:
-        result = apply_sepia(result, config['sepia_strength'])
+        result = frame.writable('bgr')
+        apply_sepia(result, config['sepia_strength'], out=result, buffer=frame.borrow(result.shape))
     
     # Apply temperature
     if 'temperature' in config:
-        result = adjust_temperature(result, config['temperature'])
+        result = frame.writable('bgr')
+        adjust_temperature(result, config['temperature'], out=result)
     
     # Apply warmth (similar to positive temperature)
     if 'warmth' in config:
-        result = adjust_temperature(result, config['warmth'])
+        result = frame.writable('bgr')
+        adjust_temperature(result, config['warmth'], out=result)
     
     # Apply shadows/highlights tint
     if 'shadows_blue' in config or 'highlights_orange' in config:
-        result = apply_shadows_tint(
+        result = frame.writable('bgr')
+        apply_shadows_tint(
             result,
             blue_shift=config.get('shadows_blue', 0),
-            orange_shift=config.get('highlights_orange', 0)
+            orange_shift=config.get('highlights_orange', 0),
+            out=result
         )
     
     # Apply fade
     if 'fade_strength' in config:
-        result = apply_fade(result, config['fade_strength'])
+        result = frame.writable('bgr')
+        apply_fade(result, config['fade_strength'], out=result)
     
     # Apply contrast
     if 'contrast' in config and config['contrast'] != 1.0:
         alpha = config['contrast']
-        result = cv2.convertScaleAbs(result, alpha=alpha, beta=0)
+        result = frame.writable(frame.channels)
+        cv2.convertScaleAbs(result, dst=result, alpha=alpha, beta=0)
     
     # Apply saturation
     if 'saturation' in config and config['saturation'] != 1.0:
-        hsv = cv2.cvtColor(result, cv2.COLOR_BGR2HSV).astype(np.float32)
-        hsv[:, :, 1] = hsv[:, :, 1] * config['saturation']
-        hsv[:, :, 1] = np.clip(hsv[:, :, 1], 0, 255)
-        result = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
+        scale_saturation(frame, config['saturation'])
     
     # Apply clarity
     if 'clarity' in config:
-        result = apply_clarity(result, config['clarity'])
+        result = frame.writable(frame.channels)
+        apply_clarity(result, config['clarity'], out=result, buffer=frame.borrow(result.shape), sigma=50 * scale)
     
     # Apply vignette last
     if config.get('vignette', False):
-        result = apply_vignette(result, 0.6)
+        result = frame.writable(frame.channels)
+        apply_vignette(result, 0.6, out=result, frame_rows=frame_rows, row_offset=row_offset, mask=vignette)
     
-    return result
+    if frame is img:
+        return frame
+    return frame.bgr()
+
+
+def render_previews(img, max_side=256, presets=None):
+    """
+    Render presets on one downscaled proxy of `img` and return {name: BGR preview}.
+
+    Work shared between presets runs once: the proxy itself, its gray plane
+    (black & white presets start from it) and the vignette mask. Clarity
+    is scaled to the proxy so previews match the full-size look.
+    """
+    rows, cols = img.shape[:2]
+    scale = min(1.0, max_side / max(rows, cols))
+    size = (max(1, round(cols * scale)), max(1, round(rows * scale)))
+    proxy = cv2.resize(img, size, interpolation=cv2.INTER_AREA) if scale < 1.0 else np.array(img)
+
+    gray = None
+    vignette = None
+    previews = {}
+    for name in presets or PRESETS:
+        config = PRESETS[name]
+        if config.get('grayscale', False):
+            if gray is None:
+                gray = cv2.cvtColor(proxy, cv2.COLOR_BGR2GRAY)
+            frame = WorkingImage(gray.copy(), space='gray', owned=True)
+        else:
+            frame = WorkingImage(proxy.copy(), owned=True)
+        if config.get('vignette', False) and vignette is None:
+            vignette = vignette_mask(size[1], size[0], 0.6)
+
+        apply_preset(frame, name, scale=scale, vignette=vignette)
+        previews[name] = frame.bgr()
+    return previews
 
 
 def get_available_presets():
@@ -0,0 +1,178 @@
+"""
+Animated Images for FixPix
+
+cv2.imread only sees the first frame of an animated GIF/WebP or a
+multi-page TIFF. Originals with several frames are rendered frame by
+frame instead (see pipeline.process_project):
+
+- decode: Pillow decodes one frame at a time as the pipeline asks for it
+  (open_frames()), keeping each frame's display duration;
+- process: frames run through the pipeline on a thread pool, at most
+  FRAME_WINDOW_FACTOR frames per thread in flight, and come back in order
+  (compute.map_ordered()), so memory stays bounded for any number of frames;
+- encode: processed frames are appended to a multi-page TIFF as they
+  arrive (write()). GIF and WebP outputs are assembled from that TIFF
+  spooled to scratch space, which Pillow reads back one frame at a time.
+
+Outputs keep the animation: the policy's format when it can hold one
+(GIF, WebP, TIFF), else the original's container. Frames are flattened to
+RGB; GIF frames are quantised to their own palettes on the pool threads.
+"""
+
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from django.conf import settings
+from PIL import Image, TiffImagePlugin
+
+from . import metrics, storage
+from .models import ImageProject
+
+logger = logging.getLogger(__name__)
+
+# Pillow formats rendered frame by frame, and the extension of their outputs
+ANIMATED_FORMATS = {'GIF': '.gif', 'WEBP': '.webp', 'TIFF': '.tif'}
+# Extensions of originals that may have several frames; others are never opened to check
+ANIMATED_EXTENSIONS = ('.gif', '.webp', '.tif', '.tiff')
+OUTPUT_EXTENSIONS = ('.gif', '.webp', '.tif')
+
+# Frames in flight per pool thread (decoded, processing or waiting to be written)
+FRAME_WINDOW_FACTOR = 2
+# GIF frames without a duration play at 10 fps
+DEFAULT_DURATION_MS = 100
+
+
+class Frames:
+    """The frames of an opened original: count, loop and a lazy iterator of BGR arrays."""
+
+    def __init__(self, image):
+        self._image = image
+        self.format = image.format
+        self.count = getattr(image, 'n_frames', 1)
+        self.loop = image.info.get('loop', 0)
+        # Filled in as frames are decoded
+        self.durations = []
+
+    def __iter__(self):
+        for index in range(self.count):
+            self._image.seek(index)
+            rgb = np.asarray(self._image.convert('RGB'))
+            # WebP frames only report their duration once loaded
+            self.durations.append(self._image.info.get('duration') or DEFAULT_DURATION_MS)
+            yield cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+
+def _open(field):
+    path = storage.local_path(field.name)
+    return Image.open(path) if path is not None else Image.open(field.open('rb'))
+
+
+def _count_frames(field):
+    """Frames of a stored original; 1 for anything but a GIF, WebP or TIFF with several."""
+    if os.path.splitext(field.name)[1].lower() not in ANIMATED_EXTENSIONS:
+        # Not opened: on remote storage that would download the whole file
+        return 1
+    try:
+        with _open(field) as image:
+            if image.format not in ANIMATED_FORMATS:
+                return 1
+            return getattr(image, 'n_frames', 1)
+    except (OSError, ValueError):
+        return 1
+    finally:
+        field.close()
+
+
+def frame_count(project):
+    """Frames of a project's original, read once and stored on the project (ImageProject.frame_count)."""
+    if project.frame_count is None:
+        count = _count_frames(project.original_image)
+        # update() leaves updated_at (the media LRU) alone
+        ImageProject.objects.filter(pk=project.pk).update(frame_count=count)
+        project.frame_count = count
+    return project.frame_count
+
+
+def is_animated(project):
+    """Whether a project's original has several frames in a supported format."""
+    return frame_count(project) > 1
+
+
+@contextmanager
+def open_frames(field):
+    """Open a stored original for frame-by-frame decoding (see Frames)."""
+    try:
+        with _open(field) as image:
+            yield Frames(image)
+    finally:
+        field.close()
+
+
+def output_ext(policy, source_format):
+    """Extension of an animated output: the policy's format if it animates, else the source's."""
+    ext = '.tif' if policy['ext'] == '.tiff' else policy['ext']
+    if ext in OUTPUT_EXTENSIONS:
+        return ext
+    return ANIMATED_FORMATS[source_format]
+
+
+def to_pil(image, ext):
+    """A processed BGR frame as the Pillow image appended to an output with `ext`."""
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if image.ndim == 3 else image).convert('RGB')
+    if ext == '.gif':
+        return pil.convert('P', palette=Image.Palette.ADAPTIVE)
+    return pil
+
+
+def _append_tiff(frames, path, compression=None):
+    """Append frames to a multi-page TIFF; returns (frame count, seconds spent writing)."""
+    count, seconds = 0, 0.0
+    with TiffImagePlugin.AppendingTiffWriter(path, True) as tiff:
+        for frame in frames:
+            start = time.perf_counter()
+            frame.save(tiff, format='TIFF', compression=compression)
+            tiff.newFrame()
+            seconds += time.perf_counter() - start
+            count += 1
+    return count, seconds
+
+
+def write(frames, path, ext, policy, durations, loop=0):
+    """
+    Encode Pillow frames (see to_pil) into an animated file and return its info.
+
+    Frames are written as they are produced; `durations` (ms per frame)
+    is only read once they all are. Returns the same info as
+    encoding.encode, plus the frame count.
+    """
+    if ext == '.tif':
+        count, seconds = _append_tiff(frames, path, compression='tiff_lzw')
+    else:
+        fd, spool = tempfile.mkstemp(suffix='.tif', dir=getattr(settings, 'FIXPIX_SCRATCH_DIR', '') or None)
+        os.close(fd)
+        try:
+            count, seconds = _append_tiff(frames, spool)
+            start = time.perf_counter()
+            with metrics.stage('encode'), Image.open(spool) as spooled:
+                options = {'save_all': True, 'duration': durations[:count], 'loop': loop}
+                if ext == '.webp':
+                    options.update(quality=policy['webp_quality'], method=policy['webp_method'],
+                                   lossless=policy['webp_lossless'])
+                    spooled.save(path, format='WEBP', **options)
+                else:
+                    spooled.save(path, format='GIF', **options)
+            seconds += time.perf_counter() - start
+        finally:
+            os.remove(spool)
+
+    fmt = ext.lstrip('.')
+    size = os.path.getsize(path)
+    metrics.OUTPUT_BYTES.observe(size, format=fmt)
+    return {'format': fmt, 'bytes': size, 'frames': count, 'encode_ms': round(seconds * 1000, 2)}
@@ -3,3 +3,13 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.db.models.signals import post_delete, post_save
+        from .authentication import user_changed
+
+        # Stateless JWT authentication caches each user's state; drop it when the user changes
+        user_model = get_user_model()
+        post_save.connect(user_changed, sender=user_model, dispatch_uid='fixpix-auth-user-saved')
+        post_delete.connect(user_changed, sender=user_model, dispatch_uid='fixpix-auth-user-deleted')
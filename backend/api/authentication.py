@@ -0,0 +1,104 @@
+"""
+Authentication for FixPix
+
+JWT authentication whose cost shows up as the 'auth' phase of the
+request timings (see api.middleware).
+
+StatelessJWTAuthentication, the default, does not load the User row on
+every request: request.user is a TokenUser built from the token claims
+(user id, username, email), and views scope their queries by its id.
+What the token cannot say is whether it has been revoked since it was
+issued, so each user's state (active flag and password hash) is read
+from the database once per FIXPIX_AUTH_CACHE_SECONDS and kept in Django's
+cache. Tokens carry a hash of the password they were issued under
+(SIMPLE_JWT CHECK_REVOKE_TOKEN), so changing the password revokes them,
+and deactivating or deleting the user rejects them too. The user's
+cached state is dropped when the User row is saved or deleted
+(invalidate()). Other processes with their own cache see the change
+after at most the cache TTL.
+"""
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from . import metrics
+
+
+class TimedJWTAuthentication(JWTAuthentication):
+    """simplejwt's JWTAuthentication, timed as the 'auth' request phase."""
+
+    def authenticate(self, request):
+        with metrics.phase('auth'):
+            return super().authenticate(request)
+
+
+class ClaimsUser(TokenUser):
+    """A TokenUser that also exposes the email claim."""
+
+    @property
+    def email(self):
+        return self.token.get('email', '')
+
+
+def _state_key(user_id):
+    return f"fixpix-auth:{user_id}"
+
+
+def user_state(user_id):
+    """
+    (is_active, password hash) of a user, None when the user does not exist.
+
+    Read from the cache, or from the database once per
+    FIXPIX_AUTH_CACHE_SECONDS.
+    """
+    key = _state_key(user_id)
+    state = cache.get(key)
+    if state is None:
+        row = (get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id})
+               .values_list('is_active', 'password').first())
+        state = (row[0], get_md5_hash_password(row[1])) if row is not None else ()
+        cache.set(key, state, getattr(settings, 'FIXPIX_AUTH_CACHE_SECONDS', 60))
+    return state or None
+
+
+def invalidate(user_id):
+    """Drop a user's cached state, so the next request reads it again."""
+    cache.delete(_state_key(user_id))
+
+
+def user_changed(sender, instance, **kwargs):
+    """post_save / post_delete receiver for the User model (connected in ApiConfig.ready)."""
+    invalidate(getattr(instance, api_settings.USER_ID_FIELD))
+
+
+class StatelessJWTAuthentication(TimedJWTAuthentication):
+    """
+    JWT authentication without a User query per request.
+
+    request.user is a ClaimsUser; the token is checked against the
+    user's cached state (see the module docstring).
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        state = user_state(user_id)
+        if state is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        is_active, password_hash = state
+        if api_settings.CHECK_USER_IS_ACTIVE and not is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != password_hash:
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+        return ClaimsUser(validated_token)
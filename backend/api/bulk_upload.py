@@ -0,0 +1,98 @@
+"""
+Bulk Upload for FixPix
+
+Creates many projects from one multipart request (ImageViewSet.bulk)
+instead of one POST per file:
+
+- validate: each file goes through ImageProjectSerializer (Pillow opens
+  and verifies it) and, when valid, is written to storage, on a thread
+  pool (compute.map_ordered), so slow storage backends and large files
+  overlap;
+- insert: the valid files become ImageProject rows in one bulk_create;
+- prepare: the new projects' preset preview sheets (the thumbnails of the
+  preset picker, see api.previews) and image statistics are computed on
+  a background thread after the response is sent, which also leaves the
+  decoded originals in the decode cache for their first render.
+
+Every file gets its own result, in request order, so one bad file does
+not fail the batch.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import compute, image_stats, previews
+from .models import ImageProject
+from .serializers import ImageProjectSerializer
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_preparer = None
+
+
+def max_files():
+    return getattr(settings, 'FIXPIX_BULK_UPLOAD_MAX_FILES', 100)
+
+
+def _validate(upload, fields, user_id):
+    """An unsaved ImageProject with its original stored, or the serializer's errors."""
+    serializer = ImageProjectSerializer(data=dict(fields, original_image=upload))
+    if not serializer.is_valid():
+        return None, serializer.errors
+    project = ImageProject(user_id=user_id, **serializer.validated_data)
+    # Stored here, on the pool, rather than one by one by bulk_create
+    project.original_image.save(upload.name, upload, save=False)
+    return project, None
+
+
+def create(uploads, fields, user_id):
+    """
+    Validate and store `uploads` concurrently, insert the valid ones with one
+    bulk_create and schedule their preparation.
+
+    `fields` holds the serializer fields shared by every project (e.g.
+    processing_type). Returns, in upload order, (upload, project, errors)
+    with either the created project or the validation errors.
+    """
+    def validate(upload):
+        try:
+            return _validate(upload, fields, user_id)
+        except Exception as e:
+            logger.warning("Bulk upload of %s failed: %s", upload.name, e)
+            return None, {'original_image': ['Could not store the file.']}
+
+    workers = min(len(uploads), compute.process_threads()) or 1
+    results = list(compute.map_ordered(validate, uploads, workers, name='fixpix-bulk-upload'))
+
+    projects = [project for project, _ in results if project is not None]
+    ImageProject.objects.bulk_create(projects)
+    if projects and getattr(settings, 'FIXPIX_BULK_PREPARE', True):
+        _preparer_pool().submit(prepare, [project.pk for project in projects])
+    return [(upload, project, errors) for upload, (project, errors) in zip(uploads, results)]
+
+
+def _preparer_pool():
+    global _preparer
+    with _lock:
+        if _preparer is None:
+            # One thread: preparation yields to renders
+            _preparer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fixpix-prepare')
+        return _preparer
+
+
+def prepare(project_ids):
+    """Render the default preview sheet and the image statistics of new projects."""
+    try:
+        for project in ImageProject.objects.filter(pk__in=project_ids).iterator():
+            try:
+                previews.render(project)
+                image_stats.for_project(project)
+            except Exception as e:
+                logger.warning("Preparing project %s failed: %s", project.pk, e)
+    finally:
+        close_old_connections()
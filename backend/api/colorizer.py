@@ -0,0 +1,156 @@
+"""
+Learned Colorization for FixPix
+
+When FIXPIX_COLORIZE_MODEL names a local ONNX colorization model,
+colorize_image predicts real colours instead of applying a sepia tone.
+
+The network only sees a small proxy: the LAB L channel resized to
+FIXPIX_COLORIZE_SIZE x FIXPIX_COLORIZE_SIZE (224 by default) and centred
+by subtracting 50, as an Nx1xSxS float32 tensor. It returns the
+predicted a/b chroma (Nx2xhxw, in LAB units; ECCV16/SIGGRAPH17
+colorizers exported to ONNX follow this contract). Only that chroma is
+upsampled to full size and merged with the original's full-resolution
+L channel, so inference costs the same for any input size.
+
+The model is loaded once per worker process (at worker start-up, see
+api.warmup). Inference runs through ONNX Runtime when it is installed
+(imported only then; the session's threads are sized to the worker's
+share of the cores, see api.compute) and through cv2.dnn otherwise. Calls that
+arrive while inference is busy (concurrent requests in one process) are
+queued and run together as one batch on the next forward pass.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from . import compute, optional
+
+logger = logging.getLogger(__name__)
+
+_model_lock = threading.Lock()
+_model = None
+_model_path = None
+
+# Proxies waiting for the next forward pass, as (tensor, Future)
+_pending = []
+_pending_lock = threading.Lock()
+_inference_lock = threading.Lock()
+
+
+class _Model:
+    """An ONNX colorizer behind ONNX Runtime or cv2.dnn."""
+
+    def __init__(self, path):
+        onnxruntime = optional.load('onnxruntime')
+        if onnxruntime is not None:
+            session = onnxruntime.InferenceSession(path, sess_options=compute.session_options(onnxruntime),
+                                                   providers=['CPUExecutionProvider'])
+            input_name = session.get_inputs()[0].name
+            self._forward = lambda tensor: session.run(None, {input_name: tensor})[0]
+            self.backend = 'onnxruntime'
+        else:
+            net = cv2.dnn.readNetFromONNX(path)
+
+            def forward(tensor):
+                net.setInput(tensor)
+                return net.forward()
+            self._forward = forward
+            self.backend = 'opencv'
+        # Exports with a fixed batch size of 1 reject batches; found out on first use
+        self.batches = True
+
+    def predict(self, tensor):
+        """ab chroma (Nx2xhxw) for Nx1xSxS centred L tensors."""
+        if len(tensor) > 1 and self.batches:
+            try:
+                return self._forward(tensor)
+            except Exception as e:
+                logger.info("Colorization model does not take batches, running them one by one: %s", e)
+                self.batches = False
+        if len(tensor) == 1:
+            return self._forward(tensor)
+        return np.concatenate([self._forward(tensor[i:i + 1]) for i in range(len(tensor))])
+
+
+def proxy_size():
+    return getattr(settings, 'FIXPIX_COLORIZE_SIZE', 224)
+
+
+def get_model():
+    """The configured colorization model, loaded on first use; None when none is configured."""
+    global _model, _model_path
+    path = getattr(settings, 'FIXPIX_COLORIZE_MODEL', '')
+    if not path:
+        return None
+    with _model_lock:
+        if _model is None or _model_path != path:
+            if not os.path.exists(path):
+                logger.warning("Colorization model %s not found; using the sepia tone", path)
+                return None
+            _model = _Model(path)
+            _model_path = path
+            logger.info("Loaded colorization model %s (%s)", path, _model.backend)
+        return _model
+
+
+def _run_pending(model):
+    with _pending_lock:
+        batch = _pending[:]
+        del _pending[:]
+    if not batch:
+        return
+    try:
+        chroma = model.predict(np.concatenate([tensor for tensor, _ in batch]))
+    except Exception as e:
+        for _, future in batch:
+            future.set_exception(e)
+    else:
+        for i, (_, future) in enumerate(batch):
+            future.set_result(chroma[i])
+
+
+def predict_chroma(model, tensor):
+    """
+    Predict the ab chroma (2xhxw) of one 1x1xSxS centred L tensor.
+
+    A caller that finds inference busy waits; whoever runs next takes
+    every queued tensor as one batch, which may include this one.
+    """
+    future = Future()
+    with _pending_lock:
+        _pending.append((tensor, future))
+    with _inference_lock:
+        if not future.done():
+            _run_pending(model)
+    return future.result()
+
+
+def colorize(frame, model):
+    """
+    Colorize a WorkingImage in place from its luminance; the frame is left in LAB.
+
+    The L channel is kept at full resolution; only the predicted chroma
+    is resized up to it.
+    """
+    lab = frame.writable('lab')
+    rows, cols = lab.shape[:2]
+    size = proxy_size()
+
+    # 8-bit LAB stores L as L * 255 / 100
+    luminance = cv2.resize(cv2.extractChannel(lab, 0), (size, size), interpolation=cv2.INTER_AREA)
+    tensor = luminance.astype(np.float32).reshape(1, 1, size, size)
+    tensor *= 100 / 255
+    tensor -= 50
+
+    # 8-bit LAB stores a/b offset by 128; quantised at proxy size, so the
+    # full-size upsampling works on 1 byte per pixel
+    chroma = np.clip(np.rint(predict_chroma(model, tensor)) + 128, 0, 255).astype(np.uint8)
+    for channel, plane in enumerate(chroma, start=1):
+        cv2.insertChannel(cv2.resize(plane, (cols, rows), interpolation=cv2.INTER_LINEAR), lab, channel)
+    return frame
@@ -0,0 +1,142 @@
+"""
+Compute Scheduling for FixPix
+
+Sizes the thread pools of OpenCV, BLAS and ONNX Runtime per worker
+process. Every pool defaults to one thread per core in every process, so
+two Celery workers plus the web server oversubscribe the node. Instead
+each worker process gets a share of the cores, cores /
+FIXPIX_WORKER_CONCURRENCY (the whole node when a single worker runs),
+set once when the process starts (configure_worker_process()) and passed
+to ONNX Runtime sessions when they are created (session_options()).
+Worker processes can optionally be pinned to disjoint core sets
+(FIXPIX_CPU_PINNING).
+
+These pools are process-wide, so jobs never resize them: a job that
+runs work of its own in parallel (the frames of an animation) sizes its
+own pool with threads_for_job().
+"""
+
+import collections
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+from django.conf import settings
+from PIL import Image
+
+try:
+    from threadpoolctl import threadpool_limits
+    HAS_THREADPOOLCTL = True
+except ImportError:
+    HAS_THREADPOOLCTL = False
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores():
+    """Cores this process may run on (its affinity set where the OS reports one)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def worker_concurrency():
+    return max(1, int(getattr(settings, 'FIXPIX_WORKER_CONCURRENCY', 1)))
+
+
+def process_threads():
+    """Threads one job may use when it gets this process's full share of the node."""
+    cores = len(available_cores())
+    if getattr(settings, 'FIXPIX_CPU_PINNING', False):
+        # A pinned worker's affinity set already is its share
+        return cores
+    return max(1, cores // worker_concurrency())
+
+
+def threads_for_job(shape, scale=1):
+    """
+    Threads for a job's own pool on an image of `shape` (upscaled `scale` times).
+
+    FIXPIX_THREADS_PER_JOB overrides the choice; otherwise jobs under
+    FIXPIX_SMALL_JOB_MEGAPIXELS get one thread (thread start-up outweighs
+    the parallel speed-up) and larger ones the process's share.
+    """
+    configured = int(getattr(settings, 'FIXPIX_THREADS_PER_JOB', 0))
+    if configured > 0:
+        return configured
+    megapixels = shape[0] * shape[1] * scale * scale / 1e6
+    if megapixels < getattr(settings, 'FIXPIX_SMALL_JOB_MEGAPIXELS', 1.0):
+        return 1
+    return process_threads()
+
+
+def image_shape(path):
+    """(rows, cols) of an image file, read from its header without decoding."""
+    with Image.open(path) as image:
+        return image.height, image.width
+
+
+def session_options(onnxruntime):
+    """ONNX Runtime SessionOptions sized to this process's share of the cores."""
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = process_threads()
+    # Graphs run sequentially; inter-op threads would only add to the count
+    options.inter_op_num_threads = 1
+    return options
+
+
+def map_ordered(function, items, workers, window_factor=2, name='fixpix-pool'):
+    """
+    Yield function(item) for each item, in order, computed on `workers` threads.
+
+    Items are pulled from the iterable only as results are consumed, so at
+    most window_factor * workers are held at once. Each call runs in its
+    own copy of the caller's context (see metrics.thread_context).
+    """
+    window = max(1, workers * window_factor)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(metrics.thread_context().run, function, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def pin_worker(index):
+    """
+    Pin worker `index` to its own slice of the available cores.
+
+    Workers beyond the core count wrap around; returns the pinned cores,
+    or None where the OS does not support affinity.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        return None
+    cores = available_cores()
+    per_worker = max(1, len(cores) // worker_concurrency())
+    start = (index * per_worker) % len(cores)
+    pinned = cores[start:start + per_worker]
+    os.sched_setaffinity(0, pinned)
+    return pinned
+
+
+def configure_worker_process(index=0):
+    """
+    Pin the worker (when enabled) and size OpenCV's and BLAS's pools to its
+    share, once for the life of the process.
+    """
+    if getattr(settings, 'FIXPIX_CPU_PINNING', False):
+        pinned = pin_worker(index)
+        logger.info("Worker %d pinned to cores %s", index, pinned)
+    threads = process_threads()
+    cv2.setNumThreads(threads)
+    if HAS_THREADPOOLCTL:
+        threadpool_limits(limits=threads)
+    return threads
@@ -0,0 +1,140 @@
+"""
+Decoded-Image Cache for FixPix
+
+Re-rendering a project decodes its original again, which for a 24 MP
+JPEG takes hundreds of milliseconds before any stage runs. Decoded
+originals are kept as raw .npy arrays in a node-local directory
+(FIXPIX_DECODE_CACHE_DIR) and opened with np.load(mmap_mode='c'): every
+worker process maps the same page-cache pages without copying, and
+stages that edit the frame in place get private copy-on-write pages, so
+the cached file is never modified.
+
+Entries are keyed by the original's name, size and modification time,
+so a replaced original misses the cache. The directory is kept under
+FIXPIX_DECODE_CACHE_MB by evicting the least recently used entries (hits
+refresh an entry's mtime).
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+# Partial writes older than this are left over from a crashed process (seconds)
+STALE_TEMP_SECONDS = 3600
+
+
+def cache_dir():
+    return getattr(settings, 'FIXPIX_DECODE_CACHE_DIR', '') or os.path.join(tempfile.gettempdir(), 'fixpix-decoded')
+
+
+def budget_bytes():
+    return int(getattr(settings, 'FIXPIX_DECODE_CACHE_MB', 2048) * 1024 * 1024)
+
+
+def fingerprint(field):
+    """Cache key for a stored original; changes whenever the file is replaced."""
+    store = field.storage
+    try:
+        modified = store.get_modified_time(field.name).timestamp()
+    except NotImplementedError:
+        modified = 0
+    key = f"{field.name}:{store.size(field.name)}:{modified}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _entries(directory):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def evict(directory, budget):
+    """Delete least recently used entries (and stale partial writes) until the directory fits."""
+    now = time.time()
+    entries = []
+    total = 0
+    for entry in _entries(directory):
+        # Other processes evict from the same directory: entries can vanish at any point
+        try:
+            stat = entry.stat()
+            if entry.name.endswith('.npy'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            elif now - stat.st_mtime > STALE_TEMP_SECONDS:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= budget:
+            break
+        try:
+            # Processes that mapped the entry keep their mapping
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _store(path, img, directory, budget):
+    if img.nbytes > budget:
+        return
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, img)
+        # Readers only ever see complete files
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning("Could not cache decoded image: %s", e)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    try:
+        evict(directory, budget)
+    except OSError as e:
+        # Housekeeping never fails the render
+        logger.warning("Could not evict decoded images: %s", e)
+
+
+def load(field):
+    """
+    Decode a stored original (a FieldFile) to BGR through the cache.
+
+    Hits return a copy-on-write memory map of the cached array; misses
+    decode, store the array for the next call and return it.
+    """
+    budget = budget_bytes()
+    if not budget:
+        return storage.read_image(field)
+
+    directory = cache_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, fingerprint(field) + '.npy')
+    try:
+        img = np.load(path, mmap_mode='c')
+    except (FileNotFoundError, ValueError):
+        img = None
+
+    if img is not None:
+        # Refresh the entry for LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return img
+
+    img = storage.read_image(field)
+    _store(path, img, directory, budget)
+    return img
@@ -0,0 +1,125 @@
+"""
+Output Encoding for FixPix
+
+Chooses the format and encoder parameters of rendered outputs. The
+deployment sets defaults (FIXPIX_OUTPUT_FORMAT and the FIXPIX_PNG_*,
+FIXPIX_JPEG_* and FIXPIX_WEBP_* settings); a request can override them
+with settings.output, e.g.
+
+    {"format": "jpg", "quality": 85, "progressive": true}
+
+Without a format the original's extension is kept. PNG and JPEG are
+encoded by OpenCV; WebP goes through Pillow, which exposes the encoder
+method (speed/size trade-off) that OpenCV does not.
+"""
+
+import io
+import os
+import time
+
+import cv2
+from django.conf import settings
+from PIL import Image
+
+from . import metrics
+
+
+FORMAT_EXTENSIONS = {'png': '.png', 'jpg': '.jpg', 'jpeg': '.jpg', 'webp': '.webp'}
+
+
+def _as_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ('true', '1', 'yes')
+    return bool(value)
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, int(value)))
+
+
+def resolve(options=None, source_name=''):
+    """
+    Merge request options over the deployment defaults into a policy dict.
+
+    Returns {'ext', 'png_compression', 'jpeg_quality', 'jpeg_progressive',
+    'jpeg_optimize', 'webp_quality', 'webp_method', 'webp_lossless'}.
+    Out-of-range numbers are clamped; an unknown format raises ValueError.
+    """
+    options = options or {}
+    fmt = (options.get('format') or getattr(settings, 'FIXPIX_OUTPUT_FORMAT', '')).lower().lstrip('.')
+    if fmt:
+        if fmt not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Unknown output format: {fmt}")
+        ext = FORMAT_EXTENSIONS[fmt]
+    else:
+        ext = os.path.splitext(source_name)[1].lower() or '.png'
+        ext = '.jpg' if ext == '.jpeg' else ext
+
+    quality = options.get('quality')
+    return {
+        'ext': ext,
+        'png_compression': _clamp(options.get('compression', getattr(settings, 'FIXPIX_PNG_COMPRESSION', 1)), 0, 9),
+        'jpeg_quality': _clamp(quality or getattr(settings, 'FIXPIX_JPEG_QUALITY', 95), 1, 100),
+        'jpeg_progressive': _as_bool(options.get('progressive', getattr(settings, 'FIXPIX_JPEG_PROGRESSIVE', False))),
+        'jpeg_optimize': _as_bool(options.get('optimize', getattr(settings, 'FIXPIX_JPEG_OPTIMIZE', False))),
+        'webp_quality': _clamp(quality or getattr(settings, 'FIXPIX_WEBP_QUALITY', 90), 1, 100),
+        'webp_method': _clamp(options.get('method', getattr(settings, 'FIXPIX_WEBP_METHOD', 4)), 0, 6),
+        'webp_lossless': _as_bool(options.get('lossless', False)),
+    }
+
+
+def imwrite_params(policy):
+    """OpenCV encoder parameters for the policy's format (WebP without the method)."""
+    if policy['ext'] == '.png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, policy['png_compression']]
+    if policy['ext'] == '.jpg':
+        return [
+            cv2.IMWRITE_JPEG_QUALITY, policy['jpeg_quality'],
+            cv2.IMWRITE_JPEG_PROGRESSIVE, int(policy['jpeg_progressive']),
+            cv2.IMWRITE_JPEG_OPTIMIZE, int(policy['jpeg_optimize']),
+        ]
+    if policy['ext'] == '.webp':
+        # Quality above 100 selects lossless
+        return [cv2.IMWRITE_WEBP_QUALITY, 101 if policy['webp_lossless'] else policy['webp_quality']]
+    return []
+
+
+def _encode_webp(image, policy):
+    if image.ndim == 2:
+        pil = Image.fromarray(image)
+    elif image.shape[2] == 4:
+        pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA))
+    else:
+        pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    buffer = io.BytesIO()
+    pil.save(buffer, format='WEBP', quality=policy['webp_quality'],
+             method=policy['webp_method'], lossless=policy['webp_lossless'])
+    return buffer.getvalue()
+
+
+def encode(image, policy):
+    """
+    Encode an image with the policy and return (data, info).
+
+    info holds the format, output bytes and encode time, which are also
+    recorded in the 'encode' stage and the output-size histogram.
+    """
+    ext = policy['ext']
+    if ext == '.jpg' and image.ndim == 3 and image.shape[2] == 4:
+        # JPEG has no alpha channel (background removal outputs BGRA)
+        ext = '.png'
+        policy = dict(policy, ext=ext)
+
+    start = time.perf_counter()
+    with metrics.stage('encode', image):
+        if ext == '.webp':
+            data = _encode_webp(image, policy)
+        else:
+            ok, buf = cv2.imencode(ext, image, imwrite_params(policy))
+            if not ok:
+                raise ValueError(f"Could not encode {ext} output")
+            data = buf.tobytes()
+
+    fmt = ext.lstrip('.')
+    metrics.OUTPUT_BYTES.observe(len(data), format=fmt)
+    return data, {'format': fmt, 'bytes': len(data), 'encode_ms': round((time.perf_counter() - start) * 1000, 2)}
@@ -0,0 +1,359 @@
+"""
+Local Executor for FixPix
+
+Single-node alternative to Celery: renders run in a process pool owned by
+the web process that accepted them, so the server stays responsive while
+images render and no broker is needed. Worker processes report every
+finished stage on a shared queue; a listener thread in that web process
+appends the events to the job in the job store, and the events view
+streams them to the client as Server-Sent Events.
+
+The job store is Redis when FIXPIX_JOB_STORE_URL is set (it defaults to
+FIXPIX_SINGLE_FLIGHT_URL), so whichever web process serves the events
+request finds the job: gunicorn runs several. Without it jobs live in the
+memory of the web process, which only suits a single process (runserver).
+
+A submit with the same project and settings as a job that is still
+running returns that job instead of rendering again (see api.single_flight),
+across web processes with Redis.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+from . import optional, single_flight
+
+logger = logging.getLogger(__name__)
+
+# Finished jobs stay available to late subscribers for this long (seconds)
+JOB_RETENTION = 600
+# How often event streams read new events from the store (seconds)
+POLL_INTERVAL = 0.25
+FINAL_EVENTS = ('done', 'error')
+
+_lock = threading.Lock()
+_pool = None
+_events = None
+_store = None
+# Jobs running on this process's pool, by id (the listener adds their progress counts)
+_running = {}
+
+# Set in pool processes: the queue events are reported on
+_worker_events = None
+
+
+class Job:
+    """A render queued on the local pool: its identity and planned stages (events are in the store)."""
+
+    def __init__(self, job_id, project_id, user_id, stages, key=''):
+        self.id = job_id
+        self.key = key
+        self.project_id = project_id
+        self.user_id = user_id
+        self.stages = stages
+
+    def to_json(self):
+        return json.dumps({'id': self.id, 'key': self.key, 'project_id': str(self.project_id),
+                           'user_id': self.user_id, 'stages': self.stages})
+
+    @classmethod
+    def from_json(cls, value):
+        fields = json.loads(value)
+        return cls(fields['id'], fields['project_id'], fields['user_id'], fields['stages'], fields['key'])
+
+
+class MemoryStore:
+    """Jobs and their events in this process's memory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._events = {}
+        self._finished = {}
+        self._active = {}
+
+    def create(self, job):
+        """Store `job`, or return the running job with the same key instead."""
+        with self._lock:
+            self._prune()
+            active = self._active.get(job.key)
+            if active is not None:
+                return self._jobs[active]
+            self._jobs[job.id] = job
+            self._events[job.id] = []
+            self._active[job.key] = job.id
+            return job
+
+    def add(self, job_id, event, data):
+        """Append an event; a final one ('done' or 'error') ends the job, later ones are ignored."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job_id in self._finished:
+                return
+            self._events[job_id].append((event, data))
+            if event in FINAL_EVENTS:
+                self._finished[job_id] = time.monotonic()
+                if self._active.get(job.key) == job_id:
+                    del self._active[job.key]
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def events(self, job_id, start=0):
+        """(events from index `start`, whether the job has ended)."""
+        with self._lock:
+            return list(self._events.get(job_id, ())[start:]), job_id in self._finished or job_id not in self._jobs
+
+    def _prune(self):
+        cutoff = time.monotonic() - JOB_RETENTION
+        for job_id in [job_id for job_id, finished in self._finished.items() if finished < cutoff]:
+            del self._jobs[job_id], self._events[job_id], self._finished[job_id]
+
+
+# Marks a job ended at most once; returns 1 when this event ended it
+_ADD_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 or redis.call('exists', KEYS[3]) == 1 then
+    return 0
+end
+redis.call('rpush', KEYS[2], ARGV[1])
+if ARGV[2] == '1' then
+    redis.call('set', KEYS[3], '1', 'EX', ARGV[3])
+    redis.call('expire', KEYS[1], ARGV[3])
+    redis.call('expire', KEYS[2], ARGV[3])
+    if redis.call('get', KEYS[4]) == ARGV[4] then
+        redis.call('del', KEYS[4])
+    end
+    return 1
+end
+return 0
+"""
+
+
+class RedisStore:
+    """Jobs and their events in Redis, shared by every web process."""
+
+    def __init__(self, client):
+        self.client = client
+        # Running jobs expire like render locks, in case their process dies
+        self.timeout = getattr(settings, 'FIXPIX_SINGLE_FLIGHT_TIMEOUT', 900) + JOB_RETENTION
+
+    @staticmethod
+    def _keys(job_id):
+        base = f'fixpix:job:{job_id}'
+        return base, f'{base}:events', f'{base}:finished'
+
+    @staticmethod
+    def _active_key(key):
+        return f'fixpix:job-active:{key}'
+
+    def create(self, job):
+        active_key = self._active_key(job.key)
+        for _ in range(3):
+            if self.client.set(active_key, job.id, nx=True, ex=self.timeout):
+                self.client.set(self._keys(job.id)[0], job.to_json(), ex=self.timeout)
+                return job
+            active = self.client.get(active_key)
+            existing = self.get(active.decode()) if active is not None else None
+            if existing is not None:
+                return existing
+            # The running job's record expired: take over its key
+            self.client.delete(active_key)
+        return job
+
+    def add(self, job_id, event, data):
+        meta, events, finished = self._keys(job_id)
+        job = self.get(job_id)
+        if job is None:
+            return
+        final = '1' if event in FINAL_EVENTS else '0'
+        self.client.eval(_ADD_SCRIPT, 4, meta, events, finished, self._active_key(job.key),
+                         json.dumps([event, data]), final, JOB_RETENTION, job_id)
+
+    def get(self, job_id):
+        value = self.client.get(self._keys(job_id)[0])
+        return Job.from_json(value) if value is not None else None
+
+    def events(self, job_id, start=0):
+        meta, events, finished = self._keys(job_id)
+        with self.client.pipeline() as pipe:
+            # The final event is pushed before the job is marked ended: check the mark first
+            pipe.exists(finished).exists(meta).lrange(events, start, -1)
+            ended, exists, values = pipe.execute()
+        return [tuple(json.loads(value)) for value in values], bool(ended) or not exists
+
+
+def store():
+    """The job store: Redis when FIXPIX_JOB_STORE_URL is set, else this process's memory."""
+    global _store
+    with _lock:
+        if _store is None:
+            url = getattr(settings, 'FIXPIX_JOB_STORE_URL', '')
+            redis = optional.load('redis') if url else None
+            if url and redis is None:
+                logger.warning("FIXPIX_JOB_STORE_URL is set but redis is not installed; keeping jobs in memory")
+            _store = RedisStore(redis.Redis.from_url(url)) if redis is not None else MemoryStore()
+        return _store
+
+
+# ---- Worker processes ----
+
+def _init_worker(events, counter):
+    """Set up Django in a pool process, size its thread pools and preload models."""
+    global _worker_events
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    import django
+    django.setup()
+    from . import compute, warmup
+
+    _worker_events = events
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    compute.configure_worker_process(index)
+    warmup.warm()
+
+
+def _render(job_id, project_id, process_settings, mask_data):
+    from .models import ImageProject
+    from .pipeline import render_project
+
+    def progress(stage):
+        _worker_events.put((job_id, 'stage', {'stage': stage}))
+
+    def failed(e):
+        logger.warning("Local render %s failed: %s", job_id, e)
+        _worker_events.put((job_id, 'error', {'error': str(e)}))
+
+    def stored(result):
+        # Runs once the upload finishes, while this process renders its next job
+        if result.exception() is not None:
+            failed(result.exception())
+        else:
+            _worker_events.put((job_id, 'done', {'url': result.result().processed_image.url}))
+
+    # The outcome goes through the same queue, so it arrives after every stage event
+    try:
+        project = ImageProject.objects.get(pk=project_id)
+        render_project(project, process_settings, mask_data, progress).add_done_callback(stored)
+    except Exception as e:
+        failed(e)
+
+
+# ---- Web process ----
+
+def _listen(events):
+    """Move events from the worker queue into the job store."""
+    completed = {}
+    while True:
+        job_id, event, data = events.get()
+        job = _running.get(job_id)
+        if job is None:
+            continue
+        if event == 'stage':
+            completed[job_id] = completed.get(job_id, 0) + 1
+            data = dict(data, completed=completed[job_id], total=len(job.stages))
+            event = 'progress'
+        _record(job, event, data)
+        if event in FINAL_EVENTS:
+            completed.pop(job_id, None)
+
+
+def _record(job, event, data):
+    """Add an event to the store; a final one also drops the job from this process's running set."""
+    try:
+        store().add(job.id, event, data)
+    except Exception as e:
+        logger.warning("Could not record event %s of job %s: %s", event, job.id, e)
+    if event in FINAL_EVENTS:
+        with _lock:
+            _running.pop(job.id, None)
+
+
+def _get_pool():
+    global _pool, _events
+    with _lock:
+        if _pool is None:
+            # Spawned workers do not inherit the web server's threads or sockets
+            context = multiprocessing.get_context('spawn')
+            _events = context.Queue()
+            workers = getattr(settings, 'FIXPIX_LOCAL_WORKERS', 0) or getattr(settings, 'FIXPIX_WORKER_CONCURRENCY', 1)
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(_events, context.Value('i', 0)),
+            )
+            threading.Thread(target=_listen, args=(_events,), name='fixpix-executor-events', daemon=True).start()
+        return _pool
+
+
+def submit(project, process_settings, mask_data=None):
+    """
+    Queue a render of `project` on the local pool and return its Job.
+
+    While a job with the same project and settings is running, that job
+    is returned instead.
+    """
+    from .pipeline import planned_stages
+
+    key = single_flight.key(project.pk, process_settings, mask_data)
+    job = Job(uuid.uuid4().hex, project.pk, project.user_id, planned_stages(process_settings, mask_data), key)
+    created = store().create(job)
+    if created is not job:
+        logger.info("Attaching to local render %s", created.id)
+        return created
+    with _lock:
+        _running[job.id] = job
+
+    def finished(future):
+        # A worker that died (e.g. killed for memory) cannot report its own failure
+        error = future.exception()
+        if error is not None:
+            logger.warning("Local render %s crashed: %s", job.id, error)
+            _record(job, 'error', {'error': str(error)})
+            if isinstance(error, BrokenProcessPool):
+                _discard(pool)
+
+    try:
+        pool = _get_pool()
+        pool.submit(_render, job.id, project.pk, process_settings, mask_data).add_done_callback(finished)
+    except Exception as e:
+        # Later submits must not attach to a job that never started
+        _record(job, 'error', {'error': str(e)})
+        raise
+    return job
+
+
+def _discard(pool):
+    """Drop a broken pool; the next submit starts a new one."""
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+
+
+def get_job(job_id):
+    return store().get(job_id)
+
+
+def job_events(job_id, start=0):
+    """(events of a job from index `start`, whether it has ended); see the store classes."""
+    return store().events(job_id, start)
+
+
+def shutdown():
+    """Stop the pool (used by tests and on server shutdown)."""
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
@@ -0,0 +1,177 @@
+"""
+Bulk Export for FixPix
+
+Downloads of processed images, one at a time (ImageViewSet.download) or
+many at once as a ZIP archive (ImageViewSet.export).
+
+An export streams its archive: entries are encoded on a thread pool
+(compute.map_ordered) at most EXPORT_WINDOW_FACTOR per thread ahead of
+the one being sent, and each is written to the response as soon as it
+is its turn (stream_zip()). The archive is never held whole in memory or
+on disk, so memory stays the same for ten projects or ten thousand, and
+the first bytes reach the client while later entries are still encoding.
+
+Under ASGI the archive is read through an async generator
+(stream_async()): Django reads a plain iterator whole before sending it
+there.
+
+Entries are stored, not deflated: the images are already compressed, and
+deflating them again costs CPU for a percent or two. Without a requested
+format or quality the stored outputs are copied as they are.
+"""
+
+import logging
+import os
+import time
+import zipfile
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from PIL import Image
+
+from . import compute
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'webp': 'WEBP'}
+DEFAULT_QUALITY = 90
+
+# Entries per pool thread encoded ahead of the one being streamed
+EXPORT_WINDOW_FACTOR = 2
+
+
+def normalize_format(value):
+    """A requested format as an extension of FORMATS ('jpeg' is 'jpg'); '' when not given."""
+    value = (value or '').lower().lstrip('.')
+    return 'jpg' if value == 'jpeg' else value
+
+
+def parse_quality(value, default=DEFAULT_QUALITY):
+    """A requested quality clamped to 1-100; `default` when missing or not a number."""
+    try:
+        return max(1, min(100, int(value)))
+    except (TypeError, ValueError):
+        return default
+
+
+def stored_format(field):
+    """The format of a stored file, from its extension."""
+    return normalize_format(os.path.splitext(field.name)[1])
+
+
+def encode(field, target_format, quality=DEFAULT_QUALITY):
+    """Re-encode a stored image (a FieldFile) as `target_format` at `quality`; returns the bytes."""
+    with field.open('rb'), Image.open(field) as img:
+        # JPEG has no alpha
+        if target_format == 'jpg' and img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGB')
+
+        save_params = {'format': FORMATS.get(target_format, target_format.upper())}
+        if target_format in ('jpg', 'webp'):
+            save_params['quality'] = quality
+            if target_format == 'webp':
+                save_params['method'] = 6
+
+        buffer = BytesIO()
+        img.save(buffer, **save_params)
+        return buffer.getvalue()
+
+
+def entry_name(project, ext):
+    """Archive name of a project's output: the original's name plus the project id, unique per archive."""
+    stem = os.path.splitext(os.path.basename(project.original_image.name))[0] or 'image'
+    return f"{stem}_{str(project.pk)[:8]}.{ext}"
+
+
+def export_entry(project, target_format='', quality=None):
+    """
+    (name, bytes) of a project's output in the archive, or None when it
+    cannot be read.
+
+    The stored file is copied as is unless a format or quality is given.
+    """
+    field = project.processed_image
+    source_format = stored_format(field)
+    target_format = target_format or source_format
+    try:
+        if target_format == source_format and quality is None:
+            with field.open('rb') as stored:
+                data = stored.read()
+        else:
+            data = encode(field, target_format, DEFAULT_QUALITY if quality is None else quality)
+    except Exception as e:
+        logger.warning("Export of project %s skipped: %s", project.pk, e)
+        return None
+    return entry_name(project, target_format), data
+
+
+class _Chunks:
+    """Write-only file collecting what ZipFile writes until it is drained."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries):
+    """
+    Yield a ZIP archive of (name, bytes) entries chunk by chunk, one chunk per entry.
+
+    ZipFile sees an unseekable file, so each entry gets a data descriptor
+    instead of a rewritten header and nothing is written twice. Entries
+    that are None are left out.
+    """
+    sink = _Chunks()
+    modified = time.localtime()[:6]
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for entry in entries:
+            if entry is None:
+                continue
+            name, data = entry
+            archive.writestr(zipfile.ZipInfo(name, date_time=modified), data)
+            yield sink.drain()
+    # The central directory
+    yield sink.drain()
+
+
+def export_zip(projects, target_format='', quality=None, workers=None):
+    """
+    Yield a ZIP archive of the projects' outputs (see export_entry),
+    encoding entries on `workers` threads (default: the process's share).
+    """
+    workers = workers or getattr(settings, 'FIXPIX_EXPORT_WORKERS', 0) or compute.process_threads()
+    entries = compute.map_ordered(lambda project: export_entry(project, target_format, quality),
+                                  projects, workers, EXPORT_WINDOW_FACTOR, 'fixpix-export')
+    yield from stream_zip(entries)
+
+
+async def stream_async(chunks):
+    """
+    Yield the chunks of a plain iterator from an async generator, each
+    read on a worker thread, so ASGI servers stream it as it is produced.
+    """
+    chunks = iter(chunks)
+    read = sync_to_async(next, thread_sensitive=False)
+    try:
+        while True:
+            chunk = await read(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # A client that disconnects stops the encoding pool too
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            await sync_to_async(close, thread_sensitive=False)()
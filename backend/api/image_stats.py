@@ -0,0 +1,128 @@
+"""
+Image Statistics for FixPix
+
+Global statistics of a project's original, computed once and stored on
+the project (ImageProject.stats) for every later render and request:
+
+- means: BGR channel means, used by the Gray World white balance of
+  auto_enhance / correct_white_balance instead of a full-resolution pass;
+- histograms: 256-bin B, G, R and gray histograms;
+- noise: estimated noise sigma of the gray plane (Immerkaer's method);
+- faces: Haar cascade face boxes (x, y, w, h) in original coordinates
+  (None when the OpenCV build has no cascade classifier).
+
+Means, histograms and faces come from a proxy downscaled to STATS_MAX_SIDE
+with area averaging, which keeps channel means. Downscaling also averages
+noise away, so the noise estimate uses a full-resolution centre crop.
+Stored statistics carry the original's fingerprint (see
+api.decode_cache) and are recomputed when the original is replaced.
+"""
+
+import logging
+import math
+
+import cv2
+import numpy as np
+
+from . import decode_cache, metrics
+from .models import ImageProject
+
+logger = logging.getLogger(__name__)
+
+# Bump when the stored layout or the computation changes
+STATS_VERSION = 1
+STATS_MAX_SIDE = 1024
+NOISE_CROP = 1024
+
+# Immerkaer (1996): Laplacian difference kernel whose response is pure noise on smooth areas
+_NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
+_face_cascade = None
+
+
+def faces_detector():
+    """The Haar face cascade, or None when this OpenCV build has no cascade classifier."""
+    global _face_cascade
+    if _face_cascade is None:
+        if not hasattr(cv2, 'CascadeClassifier'):
+            logger.warning("OpenCV has no CascadeClassifier; image statistics will not include faces")
+            _face_cascade = False
+        else:
+            _face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    return _face_cascade or None
+
+
+def _histogram(plane):
+    return cv2.calcHist([plane], [0], None, [256], [0, 256]).ravel().astype(int).tolist()
+
+
+def estimate_noise(gray):
+    """Noise sigma of a gray image (Immerkaer's fast estimate)."""
+    rows, cols = gray.shape
+    if rows < 3 or cols < 3:
+        return 0.0
+    response = cv2.filter2D(gray.astype(np.float32), -1, _NOISE_KERNEL)[1:-1, 1:-1]
+    return float(np.abs(response).sum() * math.sqrt(math.pi / 2) / (6 * (rows - 2) * (cols - 2)))
+
+
+def compute(img):
+    """Statistics of a BGR (or gray) image as a JSON-serialisable dict."""
+    with metrics.stage('image_stats', img):
+        rows, cols = img.shape[:2]
+        scale = min(1.0, STATS_MAX_SIDE / max(rows, cols))
+        if scale < 1.0:
+            proxy = cv2.resize(img, (max(1, round(cols * scale)), max(1, round(rows * scale))),
+                               interpolation=cv2.INTER_AREA)
+        else:
+            proxy = np.asarray(img)
+        if proxy.ndim == 2:
+            proxy = cv2.cvtColor(proxy, cv2.COLOR_GRAY2BGR)
+        gray = cv2.cvtColor(proxy, cv2.COLOR_BGR2GRAY)
+
+        top, left = max(0, (rows - NOISE_CROP) // 2), max(0, (cols - NOISE_CROP) // 2)
+        crop = np.ascontiguousarray(img[top:top + NOISE_CROP, left:left + NOISE_CROP])
+        if crop.ndim == 3:
+            crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+
+        detector = faces_detector()
+        faces = None
+        if detector is not None:
+            # Scale the detector's minimum face size with the proxy
+            found = detector.detectMultiScale(gray, 1.3, 5, minSize=(max(8, round(30 * scale)),) * 2)
+            faces = [[round(v / scale) for v in face] for face in np.asarray(found).reshape(-1, 4).tolist()]
+
+        return {
+            'version': STATS_VERSION,
+            'shape': [rows, cols],
+            'means': list(cv2.mean(proxy)[:3]),
+            'histograms': {
+                'b': _histogram(proxy[:, :, 0]),
+                'g': _histogram(proxy[:, :, 1]),
+                'r': _histogram(proxy[:, :, 2]),
+                'gray': _histogram(gray),
+            },
+            'noise': round(estimate_noise(crop), 4),
+            'faces': faces,
+        }
+
+
+def for_project(project, img=None):
+    """
+    Return the statistics of a project's original, computing them on first use.
+
+    `img` is the decoded original when the caller already holds it;
+    otherwise it is loaded through the decode cache. New statistics are
+    stored with update(), which leaves updated_at (the media LRU) alone.
+    """
+    fingerprint = decode_cache.fingerprint(project.original_image)
+    stats = project.stats or {}
+    if stats.get('version') == STATS_VERSION and stats.get('fingerprint') == fingerprint:
+        return stats
+
+    if img is None:
+        img = decode_cache.load(project.original_image)
+    stats = dict(compute(img), fingerprint=fingerprint)
+    ImageProject.objects.filter(pk=project.pk).update(stats=stats)
+    project.stats = stats
+    logger.debug("Computed image statistics for %s", project.pk)
+    return stats
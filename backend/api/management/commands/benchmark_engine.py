@@ -0,0 +1,278 @@
+"""
+Benchmark suite for the FixPix AI engine.
+
+Runs every AIEngine method, every filter preset and representative
+pipeline setting combinations on deterministic synthetic images, and
+reports throughput, latency percentiles and peak RSS. Results can be
+stored as a baseline; later runs fail when a case regresses beyond the
+threshold.
+
+Usage:
+    python manage.py benchmark_engine --sizes 1,12 --repeat 3
+    python manage.py benchmark_engine --save-baseline
+    python manage.py benchmark_engine --cases preset: --threshold 0.15
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+DEFAULT_SIZES = (1, 12, 24, 48, 100)
+DEFAULT_BASELINE = os.path.join(settings.BASE_DIR, 'benchmarks', 'baseline.json')
+
+# Representative editor setting combinations for the full pipeline
+PIPELINE_CASES = {
+    'restore': {'removeScratches': True, 'faceRestoration': True},
+    'quick_edit': {'brightness': 1.1, 'contrast': 1.1, 'saturation': 1.2, 'autoEnhance': True},
+    'look': {'whiteBalance': True, 'filterPreset': 'cinematic'},
+    'colorize_upscale': {'colorize': True, 'upscaleX': 2},
+    'full': {
+        'removeScratches': True, 'faceRestoration': True, 'autoEnhance': True,
+        'brightness': 1.05, 'saturation': 1.1, 'denoiseStrength': 40, 'filterPreset': 'vivid',
+    },
+}
+
+
+def synthetic_image(megapixels, seed=0):
+    """
+    Build a deterministic BGR test image of roughly the given size (4:3).
+
+    Smooth gradients, hard edges and sensor-like noise keep every stage
+    on its realistic code path.
+    """
+    rng = np.random.default_rng(seed)
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(megapixels * 1e6 / width))
+
+    xs = np.linspace(0, 255, width, dtype=np.float32)
+    ys = np.linspace(0, 255, height, dtype=np.float32)
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:, :, 0] = (ys[:, None] * 0.6 + xs[None, :] * 0.4).astype(np.uint8)
+    img[:, :, 1] = (ys[:, None] * 0.3 + xs[None, ::-1] * 0.7).astype(np.uint8)
+    img[:, :, 2] = (255 - ys[:, None] * 0.5 - xs[None, :] * 0.5).clip(0, 255).astype(np.uint8)
+
+    # Hard-edged blocks
+    block = max(8, width // 16)
+    for y in range(0, height, block * 2):
+        img[y:y + block, ::2 * block] = 255 - img[y:y + block, ::2 * block]
+
+    # Noise, added in row bands to keep the int16 temporary small
+    band = 1024
+    for y in range(0, height, band):
+        rows = img[y:y + band]
+        noise = rng.integers(-12, 13, size=rows.shape, dtype=np.int16)
+        rows[:] = np.clip(rows.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    return img
+
+
+def synthetic_mask(shape):
+    """Centered rectangular object-removal mask."""
+    h, w = shape[:2]
+    mask = np.zeros((h, w), dtype=np.uint8)
+    mask[h * 2 // 5:h * 3 // 5, w * 2 // 5:w * 3 // 5] = 255
+    return mask
+
+
+def build_cases():
+    """Return {case_name: callable(img)} for every benchmarked operation."""
+    from api.ai_engine import AIEngine
+    from api.ai_presets import PRESETS
+    from api.pipeline import run_pipeline
+
+    cases = {
+        'engine:colorize_image': lambda img: AIEngine.colorize_image(img, return_path=False),
+        'engine:adjust_image': lambda img: AIEngine.adjust_image(img, 1.1, 1.2, 1.3, return_path=False),
+        'engine:remove_scratches': lambda img: AIEngine.remove_scratches(img, strength=50, return_path=False),
+        'engine:restore_faces': lambda img: AIEngine.restore_faces(img, return_path=False),
+        'engine:remove_background': lambda img: AIEngine.remove_background(img, return_path=False),
+        'engine:auto_enhance': lambda img: AIEngine.auto_enhance(img, return_path=False),
+        'engine:inpaint_object': lambda img: AIEngine.inpaint_object(img, synthetic_mask(img.shape), return_path=False),
+        'engine:upscale_image': lambda img: AIEngine.upscale_image(img, scale=2, return_path=False),
+        'engine:denoise_advanced': lambda img: AIEngine.denoise_advanced(img, strength=60, return_path=False),
+        'engine:correct_white_balance': lambda img: AIEngine.correct_white_balance(img, return_path=False),
+        'engine:generative_inpaint': lambda img: AIEngine.generative_inpaint(img, synthetic_mask(img.shape), return_path=False),
+        'engine:replace_background': lambda img: AIEngine.replace_background(img, bg_type='blur', return_path=False),
+        'engine:enhance_face_details': lambda img: AIEngine.enhance_face_details(img, return_path=False),
+    }
+    for preset_name in PRESETS:
+        cases[f'preset:{preset_name}'] = (
+            lambda img, name=preset_name: AIEngine.apply_filter_preset(img, name, return_path=False)
+        )
+    for combo_name, combo in PIPELINE_CASES.items():
+        cases[f'pipeline:{combo_name}'] = lambda img, combo=combo: run_pipeline(img, dict(combo))
+    return cases
+
+
+def _percentile(samples, pct):
+    return float(np.percentile(samples, pct)) if samples else None
+
+
+def _run_case(case_name, image_path, repeat, warmup, queue):
+    """Child-process entry point: time one case and report peak RSS."""
+    try:
+        # Stage tracing would add tracemalloc overhead to every timing
+        settings.FIXPIX_TRACE_MEMORY = False
+        func = build_cases()[case_name]
+        img = np.load(image_path)
+
+        for _ in range(warmup):
+            func(img)
+
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(img)
+            latencies.append(time.perf_counter() - start)
+
+        # ru_maxrss is reported in KiB on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if platform.system() != 'Darwin':
+            maxrss *= 1024
+        queue.put({'latencies': latencies, 'peak_rss_bytes': maxrss})
+    except Exception as e:
+        queue.put({'error': f'{type(e).__name__}: {e}'})
+
+
+class Command(BaseCommand):
+    help = 'Benchmark AIEngine methods, filter presets and pipeline combinations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                            help='Comma-separated image sizes in megapixels')
+        parser.add_argument('--cases', default='',
+                            help='Comma-separated case name prefixes (e.g. "engine:,preset:vivid")')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case')
+        parser.add_argument('--warmup', type=int, default=1, help='Untimed runs per case')
+        parser.add_argument('--timeout', type=float, default=900, help='Seconds before a case is abandoned')
+        parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON path')
+        parser.add_argument('--save-baseline', action='store_true', help='Write results as the new baseline')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed fractional regression of p50 latency and peak RSS')
+        parser.add_argument('--output', default='', help='Write the full results as JSON')
+        parser.add_argument('--list', action='store_true', help='List case names and exit')
+
+    def handle(self, *args, **options):
+        case_names = list(build_cases())
+        if options['list']:
+            for name in case_names:
+                self.stdout.write(name)
+            return
+
+        prefixes = [p for p in options['cases'].split(',') if p]
+        if prefixes:
+            case_names = [n for n in case_names if any(n.startswith(p) for p in prefixes)]
+        if not case_names:
+            raise CommandError('No benchmark cases match --cases')
+
+        try:
+            sizes = [float(s) for s in options['sizes'].split(',') if s]
+        except ValueError:
+            raise CommandError('--sizes must be a comma-separated list of numbers')
+
+        results = {}
+        # Cases run in forked children so each peak RSS is measured in isolation
+        ctx = multiprocessing.get_context('fork')
+        with tempfile.TemporaryDirectory(prefix='fixpix-bench-') as tmp_dir:
+            for size in sizes:
+                image_path = os.path.join(tmp_dir, f'{size:g}mp.npy')
+                img = synthetic_image(size)
+                np.save(image_path, img)
+                megapixels = img.shape[0] * img.shape[1] / 1e6
+                del img
+
+                for case_name in case_names:
+                    key = f'{case_name}@{size:g}mp'
+                    result = self._run_isolated(ctx, case_name, image_path, options)
+                    if 'latencies' in result:
+                        latencies = result.pop('latencies')
+                        p50 = _percentile(latencies, 50)
+                        result.update({
+                            'p50_s': p50,
+                            'p95_s': _percentile(latencies, 95),
+                            'p99_s': _percentile(latencies, 99),
+                            'throughput_mp_s': megapixels / p50 if p50 else None,
+                        })
+                    results[key] = result
+                    self._report(key, result)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if options['save_baseline']:
+            os.makedirs(os.path.dirname(options['baseline']), exist_ok=True)
+            baseline = self._load_baseline(options['baseline'])
+            baseline.update({k: v for k, v in results.items() if 'p50_s' in v})
+            with open(options['baseline'], 'w') as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f'Baseline written to {options["baseline"]}'))
+            return
+
+        regressions = self._compare(results, self._load_baseline(options['baseline']), options['threshold'])
+        if regressions:
+            for line in regressions:
+                self.stderr.write(self.style.ERROR(line))
+            raise CommandError(f'{len(regressions)} benchmark regression(s) beyond {options["threshold"]:.0%}')
+
+    def _run_isolated(self, ctx, case_name, image_path, options):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run_case,
+                           args=(case_name, image_path, options['repeat'], options['warmup'], queue))
+        proc.start()
+        deadline = time.monotonic() + options['timeout']
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    return queue.get(timeout=1)
+                except Exception:
+                    # A child killed by the OOM killer never reports back
+                    if not proc.is_alive() and queue.empty():
+                        return {'error': f'worker exited with code {proc.exitcode}'}
+            return {'error': f'timed out after {options["timeout"]:g}s'}
+        finally:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+
+    def _report(self, key, result):
+        if 'error' in result:
+            self.stdout.write(self.style.WARNING(f'{key:<45} {result["error"]}'))
+            return
+        self.stdout.write(
+            f'{key:<45} p50 {result["p50_s"] * 1000:10.1f} ms  '
+            f'p95 {result["p95_s"] * 1000:10.1f} ms  '
+            f'{result["throughput_mp_s"]:8.2f} MP/s  '
+            f'peak RSS {result["peak_rss_bytes"] / (1024 * 1024):8.1f} MB'
+        )
+
+    @staticmethod
+    def _load_baseline(path):
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _compare(results, baseline, threshold):
+        """Return a description of every case that regressed beyond the threshold."""
+        regressions = []
+        for key, result in results.items():
+            base = baseline.get(key)
+            if not base or 'p50_s' not in result:
+                continue
+            for metric in ('p50_s', 'peak_rss_bytes'):
+                if base.get(metric) and result[metric] > base[metric] * (1 + threshold):
+                    regressions.append(
+                        f'{key}: {metric} {result[metric]:.4g} vs baseline {base[metric]:.4g} '
+                        f'(+{result[metric] / base[metric] - 1:.0%})'
+                    )
+        return regressions
@@ -0,0 +1,42 @@
+"""
+Media garbage collection for FixPix.
+
+Runs the same passes as the cleanup_old_processed_images Celery task:
+expires old processed outputs, enforces the per-user and global quotas
+and removes orphaned outputs and leftover temp files.
+
+Usage:
+    python manage.py gc_media --days 7
+    python manage.py gc_media --user-quota-mb 500 --quota-mb 50000
+"""
+
+from django.core.management.base import BaseCommand
+
+from api import media_gc
+
+
+class Command(BaseCommand):
+    help = 'Expire processed outputs, enforce media quotas and sweep orphaned files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Expire outputs not rendered for this many days (0 keeps them)')
+        parser.add_argument('--user-quota-mb', type=float, default=None,
+                            help='Per-user quota (defaults to FIXPIX_MEDIA_USER_QUOTA_MB)')
+        parser.add_argument('--quota-mb', type=float, default=None, help='Global quota (defaults to FIXPIX_MEDIA_QUOTA_MB)')
+        parser.add_argument('--grace-seconds', type=int, default=None,
+                            help='Keep unreferenced files younger than this (defaults to FIXPIX_MEDIA_GC_GRACE_SECONDS)')
+
+    def handle(self, *args, **options):
+        def to_bytes(mb):
+            return None if mb is None else int(mb * 1024 * 1024)
+
+        stats = media_gc.collect(
+            days=options['days'],
+            user_quota_bytes=to_bytes(options['user_quota_mb']),
+            quota_bytes=to_bytes(options['quota_mb']),
+            grace_seconds=options['grace_seconds'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Evicted {stats['evicted']} outputs, removed {stats['orphans']} orphans and "
+            f"{stats['temp']} temp files, freed {stats['bytes_freed'] / 1e6:.1f} MB"
+        ))
@@ -0,0 +1,318 @@
+"""
+End-to-end load test for the FixPix REST API.
+
+Logs in through the token endpoint, uploads synthetic images to /images/
+and then drives process_image, download and list requests with a
+configurable mix at one or more concurrency levels. Reports per-endpoint
+p50/p95/p99 latency, error rates and the concurrency level where
+throughput stops scaling (the saturation point).
+
+With --spawn-server the command starts its own dev server on a throwaway
+SQLite database and media root, using the in-memory Celery broker, so no
+external services are needed.
+
+Usage:
+    python manage.py loadtest --spawn-server --concurrency 1,2,4,8 --duration 30
+    python manage.py loadtest --url http://127.0.0.1:8000 --mix process=1,download=4,list=2
+"""
+
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib import error, request
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from .benchmark_engine import synthetic_image
+
+
+DEFAULT_MIX = 'process=2,download=5,list=3'
+
+# Settings posted to process_image, picked at random per request
+PROCESS_SETTINGS = [
+    {'autoEnhance': True},
+    {'brightness': 1.1, 'contrast': 1.05, 'saturation': 1.2},
+    {'filterPreset': 'warm'},
+    {'whiteBalance': True, 'filterPreset': 'cinematic'},
+]
+
+
+class Client:
+    """Minimal JSON/multipart HTTP client on urllib (no extra dependencies)."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.token = None
+
+    def call(self, method, path, json_body=None, files=None):
+        """Return (status, body bytes, elapsed seconds); network errors give status 0."""
+        headers = {}
+        data = None
+        if json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif files:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for field, (filename, content, content_type) in files.items():
+                parts.append(
+                    f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+                    f'filename="{filename}"\r\nContent-Type: {content_type}\r\n\r\n'.encode()
+                    + content + b'\r\n'
+                )
+            data = b''.join(parts) + f'--{boundary}--\r\n'.encode()
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+
+        req = request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        start = time.perf_counter()
+        try:
+            with request.urlopen(req, timeout=self.timeout) as resp:
+                body = resp.read()
+                return resp.status, body, time.perf_counter() - start
+        except error.HTTPError as e:
+            return e.code, e.read(), time.perf_counter() - start
+        except (error.URLError, socket.timeout, ConnectionError) as e:
+            return 0, str(e).encode(), time.perf_counter() - start
+
+
+class Recorder:
+    """Thread-safe per-endpoint latency and status collection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, endpoint, status, elapsed):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append((status, elapsed))
+
+    def summary(self, wall_seconds):
+        report = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = np.array([s[1] for s in samples])
+            errors = sum(1 for status, _ in samples if status == 0 or status >= 400)
+            report[endpoint] = {
+                'requests': len(samples),
+                'errors': errors,
+                'error_rate': errors / len(samples),
+                'rps': len(samples) / wall_seconds if wall_seconds else 0.0,
+                'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                'p95_ms': float(np.percentile(latencies, 95) * 1000),
+                'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            }
+        return report
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        if not part:
+            continue
+        name, _, weight = part.partition('=')
+        if name not in ('process', 'download', 'list'):
+            raise CommandError(f'Unknown endpoint in --mix: {name}')
+        mix[name] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise CommandError('--mix needs at least one positive weight')
+    return mix
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = 'Drive the REST API with a configurable request mix and report latency and saturation.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='API server base URL')
+        parser.add_argument('--spawn-server', action='store_true',
+                            help='Start a dev server on a temporary SQLite DB and in-memory broker')
+        parser.add_argument('--username', default='loadtest')
+        parser.add_argument('--password', default='loadtest-pass-123')
+        parser.add_argument('--images', type=int, default=4, help='Projects to upload before the run')
+        parser.add_argument('--megapixels', type=float, default=1.0, help='Size of uploaded images')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help='Weighted endpoint mix')
+        parser.add_argument('--concurrency', default='1,2,4,8', help='Comma-separated concurrency levels')
+        parser.add_argument('--duration', type=float, default=20, help='Seconds per concurrency level')
+        parser.add_argument('--timeout', type=float, default=120, help='Per-request timeout in seconds')
+        parser.add_argument('--saturation-gain', type=float, default=0.1,
+                            help='Minimum throughput gain for a level to count as scaling')
+        parser.add_argument('--output', default='', help='Write the full report as JSON')
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options['mix'])
+        try:
+            levels = [int(c) for c in options['concurrency'].split(',') if c]
+        except ValueError:
+            raise CommandError('--concurrency must be a comma-separated list of integers')
+
+        server = None
+        tmp_dir = None
+        base_url = options['url']
+        if options['spawn_server']:
+            tmp_dir = tempfile.TemporaryDirectory(prefix='fixpix-loadtest-')
+            server, base_url = self._spawn_server(tmp_dir.name)
+
+        try:
+            client = Client(base_url, options['timeout'])
+            self._login(client, options['username'], options['password'])
+            project_ids = self._upload_images(client, options['images'], options['megapixels'])
+
+            report = {'levels': []}
+            for level in levels:
+                self.stdout.write(f'\n== concurrency {level} ({options["duration"]:g}s) ==')
+                result = self._run_level(client, project_ids, mix, level, options['duration'])
+                report['levels'].append(result)
+                self._print_level(result)
+
+            report['saturation_concurrency'] = self._saturation_point(report['levels'], options['saturation_gain'])
+            if report['saturation_concurrency'] is not None:
+                self.stdout.write(self.style.WARNING(
+                    f'\nThroughput stops scaling at concurrency {report["saturation_concurrency"]}'))
+            else:
+                self.stdout.write(self.style.SUCCESS('\nThroughput kept scaling across all levels'))
+
+            if options['output']:
+                with open(options['output'], 'w') as f:
+                    json.dump(report, f, indent=2)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(timeout=10)
+            if tmp_dir is not None:
+                tmp_dir.cleanup()
+
+    def _spawn_server(self, tmp_dir):
+        port = _free_port()
+        env = dict(
+            os.environ,
+            DATABASE_URL=f'sqlite:///{os.path.join(tmp_dir, "loadtest.sqlite3")}',
+            MEDIA_ROOT=os.path.join(tmp_dir, 'media'),
+            CELERY_BROKER_URL='memory://',
+            THROTTLE_ANON_RATE='100000/minute',
+            THROTTLE_USER_RATE='100000/minute',
+        )
+        manage_py = os.path.join(settings.BASE_DIR, 'manage.py')
+        subprocess.run([sys.executable, manage_py, 'migrate', '--noinput', '-v', '0'], env=env, check=True)
+        server = subprocess.Popen(
+            [sys.executable, manage_py, 'runserver', '--noreload', f'127.0.0.1:{port}'],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        base_url = f'http://127.0.0.1:{port}'
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=1):
+                    self.stdout.write(f'Dev server listening on {base_url}')
+                    return server, base_url
+            except OSError:
+                if server.poll() is not None:
+                    break
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError('Dev server did not start')
+
+    def _login(self, client, username, password):
+        client.call('POST', '/api/register/', json_body={
+            'username': username, 'password': password, 'email': f'{username}@example.com',
+        })
+        status, body, _ = client.call('POST', '/api/token/', json_body={'username': username, 'password': password})
+        if status != 200:
+            raise CommandError(f'Login failed ({status}): {body[:200]!r}')
+        client.token = json.loads(body)['access']
+
+    def _upload_images(self, client, count, megapixels):
+        ok, encoded = cv2.imencode('.jpg', synthetic_image(megapixels), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if not ok:
+            raise CommandError('Could not encode synthetic image')
+        content = encoded.tobytes()
+
+        project_ids = []
+        for i in range(count):
+            status, body, elapsed = client.call(
+                'POST', '/api/images/', files={'original_image': (f'loadtest_{i}.jpg', content, 'image/jpeg')})
+            if status != 201:
+                raise CommandError(f'Upload failed ({status}): {body[:200]!r}')
+            project_ids.append(json.loads(body)['id'])
+        self.stdout.write(f'Uploaded {count} synthetic {megapixels:g} MP images')
+
+        # Every project needs a processed image before download can be driven
+        for project_id in project_ids:
+            client.call('POST', f'/api/images/{project_id}/process_image/', json_body={'settings': PROCESS_SETTINGS[0]})
+        return project_ids
+
+    def _request(self, client, recorder, endpoint, project_ids):
+        project_id = random.choice(project_ids)
+        if endpoint == 'process':
+            status, _, elapsed = client.call('POST', f'/api/images/{project_id}/process_image/',
+                                             json_body={'settings': random.choice(PROCESS_SETTINGS)})
+        elif endpoint == 'download':
+            fmt = random.choice(['jpg', 'png', 'webp'])
+            status, _, elapsed = client.call('GET', f'/api/images/{project_id}/download/?format={fmt}&quality=85')
+        else:
+            status, _, elapsed = client.call('GET', '/api/images/')
+        recorder.add(endpoint, status, elapsed)
+
+    def _run_level(self, client, project_ids, mix, concurrency, duration):
+        recorder = Recorder()
+        endpoints = list(mix)
+        weights = [mix[e] for e in endpoints]
+        stop_at = time.monotonic() + duration
+
+        def worker():
+            while time.monotonic() < stop_at:
+                endpoint = random.choices(endpoints, weights)[0]
+                self._request(client, recorder, endpoint, project_ids)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(worker) for _ in range(concurrency)]:
+                future.result()
+        wall = time.monotonic() - start
+
+        endpoints_report = recorder.summary(wall)
+        total = sum(r['requests'] for r in endpoints_report.values())
+        errors = sum(r['errors'] for r in endpoints_report.values())
+        return {
+            'concurrency': concurrency,
+            'wall_s': wall,
+            'rps': total / wall if wall else 0.0,
+            'error_rate': errors / total if total else 0.0,
+            'endpoints': endpoints_report,
+        }
+
+    def _print_level(self, result):
+        for endpoint, r in result['endpoints'].items():
+            self.stdout.write(
+                f'  {endpoint:<9} n={r["requests"]:<6} err={r["error_rate"]:6.1%}  '
+                f'p50 {r["p50_ms"]:8.1f} ms  p95 {r["p95_ms"]:8.1f} ms  p99 {r["p99_ms"]:8.1f} ms'
+            )
+        self.stdout.write(f'  total     {result["rps"]:.2f} req/s, error rate {result["error_rate"]:.1%}')
+
+    @staticmethod
+    def _saturation_point(levels, min_gain):
+        """First level whose throughput gain over the previous one is below min_gain (or errors climb)."""
+        for prev, cur in zip(levels, levels[1:]):
+            if prev['rps'] <= 0:
+                continue
+            gain = cur['rps'] / prev['rps'] - 1
+            if gain < min_gain or cur['error_rate'] > max(0.01, prev['error_rate'] * 2):
+                return prev['concurrency']
+        return None
@@ -0,0 +1,204 @@
+"""
+Media Garbage Collection for FixPix
+
+Reclaims storage used by derived outputs:
+
+- expired outputs: processed images of projects not saved for `days`;
+- quotas: per-user and global byte limits on processed images, evicting
+  the least recently rendered outputs first (projects ordered by
+  updated_at);
+- orphans: files in processed/ that no project references (superseded
+  outputs, failed saves) and leftover masks in temp/.
+
+Outputs are read, measured and deleted through Django's default storage
+(local filesystem, S3 or Cloudinary, see api.storage); sizes come from
+the encoding info kept on the project when it has one, so quotas do not
+cost a request per object. Masks are scratch files in MEDIA_ROOT/temp
+(see pipeline._save_mask) and are swept on the local filesystem.
+
+Projects are read with .iterator() in batches of GC_BATCH; the rows to
+evict are collected before any is updated, so no update runs against the
+table while it is being read. Evicted projects keep their settings and
+can be re-rendered; only processed_image is cleared, and a file is only
+deleted once no other project references it.
+"""
+
+import logging
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import ImageProject
+
+logger = logging.getLogger(__name__)
+
+# Rows / files handled per query
+GC_BATCH = 1000
+OUTPUT_DIR = 'processed'
+
+
+def _file_size(name):
+    try:
+        return default_storage.size(name)
+    except Exception as e:
+        # Missing files raise OSError locally and backend-specific errors remotely
+        logger.debug("Could not read the size of %s: %s", name, e)
+        return 0
+
+
+def _remove(name, size=None):
+    """Delete a stored file and return the bytes freed (0 if it is already gone)."""
+    if not default_storage.exists(name):
+        return 0
+    if size is None:
+        size = _file_size(name)
+    default_storage.delete(name)
+    return size
+
+
+def _remove_local(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def _batches(iterable, size=GC_BATCH):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _with_outputs(queryset=None):
+    queryset = ImageProject.objects.all() if queryset is None else queryset
+    return queryset.exclude(processed_image__isnull=True).exclude(processed_image='')
+
+
+def _rows(queryset):
+    """(pk, name, size or None) of the outputs of `queryset`, streamed."""
+    return (queryset.values_list('pk', 'processed_image', 'metrics__output__bytes')
+            .iterator(chunk_size=GC_BATCH))
+
+
+def _evict(rows, stats):
+    """
+    Delete the outputs of collected (pk, name, size) rows and clear their
+    references, a batch at a time.
+    """
+    for batch in _batches(rows):
+        pks = [pk for pk, _, _ in batch]
+        # update() leaves updated_at alone, so eviction does not reorder the LRU
+        ImageProject.objects.filter(pk__in=pks).update(processed_image='')
+        names = {name: size for _, name, size in batch}
+        shared = set(ImageProject.objects.filter(processed_image__in=list(names))
+                     .values_list('processed_image', flat=True))
+        for name, size in names.items():
+            if name not in shared:
+                stats['bytes_freed'] += _remove(name, size)
+        stats['evicted'] += len(batch)
+
+
+def _over_quota(rows, quota_bytes):
+    """The rows (newest first) that do not fit in the quota."""
+    used = 0
+    evict = []
+    for pk, name, size in rows:
+        size = size if size is not None else _file_size(name)
+        used += size
+        if used > quota_bytes:
+            evict.append((pk, name, size))
+    return evict
+
+
+def expire_outputs(days, stats):
+    cutoff = timezone.now() - timedelta(days=days)
+    _evict(list(_rows(_with_outputs().filter(updated_at__lt=cutoff))), stats)
+
+
+def enforce_quota(quota_bytes, stats, queryset=None):
+    """Evict the least recently rendered outputs of `queryset` beyond quota_bytes."""
+    _evict(_over_quota(_rows(_with_outputs(queryset).order_by('-updated_at')), quota_bytes), stats)
+
+
+def enforce_user_quotas(quota_bytes, stats):
+    users = list(_with_outputs().order_by('user_id').values_list('user_id', flat=True).distinct())
+    for user_id in users:
+        enforce_quota(quota_bytes, stats, ImageProject.objects.filter(user_id=user_id))
+
+
+def _modified(name):
+    try:
+        return default_storage.get_modified_time(name).timestamp()
+    except NotImplementedError:
+        # Without a timestamp a fresh output cannot be told from an orphan: keep it
+        return float('inf')
+
+
+def sweep_orphans(stats, grace_seconds):
+    """Delete files in processed/ that no project references."""
+    try:
+        _, files = default_storage.listdir(OUTPUT_DIR)
+    except (FileNotFoundError, NotImplementedError):
+        return
+    # Files younger than the grace period may belong to a render that has not saved yet
+    cutoff = time.time() - grace_seconds
+    for batch in _batches(files):
+        names = [f'{OUTPUT_DIR}/{name}' for name in batch]
+        referenced = set(ImageProject.objects.filter(processed_image__in=names)
+                         .values_list('processed_image', flat=True))
+        for name in names:
+            if name not in referenced and _modified(name) < cutoff:
+                stats['bytes_freed'] += _remove(name)
+                stats['orphans'] += 1
+
+
+def sweep_temp(stats, grace_seconds):
+    """Delete leftover masks and other temporary files in MEDIA_ROOT/temp."""
+    directory = os.path.join(settings.MEDIA_ROOT, 'temp')
+    if not os.path.isdir(directory):
+        return
+    cutoff = time.time() - grace_seconds
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                stats['bytes_freed'] += _remove_local(entry.path)
+                stats['temp'] += 1
+
+
+def collect(days=7, user_quota_bytes=None, quota_bytes=None, grace_seconds=None):
+    """
+    Run every collection pass and return counts plus bytes freed.
+
+    Quotas default to FIXPIX_MEDIA_USER_QUOTA_MB / FIXPIX_MEDIA_QUOTA_MB
+    (0 disables a quota).
+    """
+    if user_quota_bytes is None:
+        user_quota_bytes = int(getattr(settings, 'FIXPIX_MEDIA_USER_QUOTA_MB', 0) * 1024 * 1024)
+    if quota_bytes is None:
+        quota_bytes = int(getattr(settings, 'FIXPIX_MEDIA_QUOTA_MB', 0) * 1024 * 1024)
+    if grace_seconds is None:
+        grace_seconds = getattr(settings, 'FIXPIX_MEDIA_GC_GRACE_SECONDS', 3600)
+
+    stats = {'evicted': 0, 'orphans': 0, 'temp': 0, 'bytes_freed': 0}
+    if days:
+        expire_outputs(days, stats)
+    if user_quota_bytes:
+        enforce_user_quotas(user_quota_bytes, stats)
+    if quota_bytes:
+        enforce_quota(quota_bytes, stats)
+    sweep_orphans(stats, grace_seconds)
+    sweep_temp(stats, grace_seconds)
+    logger.info("Media GC: %(evicted)d outputs evicted, %(orphans)d orphans and %(temp)d temp files "
+                "removed, %(bytes_freed)d bytes freed", stats)
+    return stats
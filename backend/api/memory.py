@@ -0,0 +1,173 @@
+"""
+Memory Budget for FixPix
+
+Bounded peak-memory execution mode for the processing pipeline.
+
+In low-memory mode the pipeline owns its frame: stages that support it
+work in place on uint8 data, share per-job scratch buffers instead of
+allocating float32 copies, and the peak of the job's own buffers is kept
+below a configurable multiple of the largest frame it has produced.
+"""
+
+import contextvars
+import threading
+import weakref
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+
+_active_budget = contextvars.ContextVar('fixpix_memory_budget', default=None)
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a job's peak allocation goes over its budget."""
+
+
+def _root(array):
+    """The array owning the memory behind `array` (views lead back to it)."""
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+
+class MemoryBudget:
+    """
+    Per-job peak-memory limit plus a pool of reusable scratch buffers.
+
+    The limit is `factor` times the largest frame seen so far, so stages
+    that legitimately grow the frame (upscaling) grow the budget with it.
+
+    Usage is kept in a ledger of the job's own buffers rather than read
+    from process-wide counters, so jobs, frames and background threads
+    running at the same time are not charged for each other: buffers are
+    charged when the pipeline takes them (track(): frame buffers, scratch
+    buffers and stage outputs) and released when they are freed. The
+    frame the job starts from is not charged, whether it lives on the
+    heap or in a memory map.
+    """
+
+    def __init__(self, image, factor):
+        self.factor = factor
+        self.frame_bytes = image.nbytes
+        self.peak_bytes = 0
+        self.held_bytes = 0
+        self._stage_peak = 0
+        self._scratch = {}
+        self._ledger = {}
+        self._lock = threading.Lock()
+        # Bytes held before the job (the decoded frame) are not charged
+        for array in _buffers(image):
+            self._add(array, charge=False)
+
+    @property
+    def limit_bytes(self):
+        return int(self.frame_bytes * self.factor)
+
+    def _add(self, array, charge=True):
+        root = _root(array)
+        key = id(root)
+        with self._lock:
+            if key in self._ledger:
+                return
+            nbytes = root.nbytes if charge else 0
+            self._ledger[key] = weakref.finalize(root, self._release, key, nbytes)
+            self.held_bytes += nbytes
+            self._stage_peak = max(self._stage_peak, self.held_bytes)
+
+    def _release(self, key, nbytes):
+        # Runs when the buffer is freed, possibly on another thread
+        with self._lock:
+            self._ledger.pop(key, None)
+            self.held_bytes -= nbytes
+
+    def track(self, array):
+        """Charge a buffer the job holds until it is freed (views and repeats are free)."""
+        if isinstance(array, np.ndarray):
+            self._add(array)
+        return array
+
+    def scratch(self, key, shape, dtype=np.uint8):
+        """
+        Return a reusable buffer for `key`, reallocating only when the shape changes.
+
+        Stages use 'color' for a full 3-channel frame (LAB/HSV/sepia
+        conversions, never live at the same time) and 'plane' for one channel.
+        """
+        buf = self._scratch.get(key)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            # Drop the old buffer before allocating its replacement
+            self._scratch.pop(key, None)
+            buf = self.track(np.empty(shape, dtype=dtype))
+            self._scratch[key] = buf
+        return buf
+
+    def check(self, stage, image=None):
+        """Record the peak since the last check and enforce the limit."""
+        if image is not None:
+            for array in _buffers(image):
+                self.track(array)
+            self.frame_bytes = max(self.frame_bytes, image.nbytes)
+        with self._lock:
+            used = self._stage_peak
+            self._stage_peak = self.held_bytes
+        self.peak_bytes = max(self.peak_bytes, used)
+        if used > self.limit_bytes:
+            raise MemoryBudgetExceeded(
+                f"Stage '{stage}' peaked at {used / 1e6:.1f} MB, over the "
+                f"{self.limit_bytes / 1e6:.1f} MB budget ({self.factor:g}x frame)"
+            )
+
+    def release(self):
+        self._scratch.clear()
+        with self._lock:
+            ledger, self._ledger = self._ledger, {}
+        for finalizer in ledger.values():
+            finalizer.detach()
+
+
+def _buffers(image):
+    """The arrays behind an array or a WorkingImage."""
+    if isinstance(image, np.ndarray):
+        return [image]
+    return list(image.buffers())
+
+
+def low_memory_enabled(process_settings):
+    """Low-memory mode is on per request ('lowMemory') or for the whole deployment."""
+    return bool(process_settings.get('lowMemory', getattr(settings, 'FIXPIX_LOW_MEMORY', False)))
+
+
+@contextmanager
+def memory_budget(image, factor=None):
+    """Activate a MemoryBudget for the current job."""
+    if factor is None:
+        factor = getattr(settings, 'FIXPIX_MEMORY_BUDGET_FACTOR', 4.0)
+    budget = MemoryBudget(image, factor)
+    token = _active_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _active_budget.reset(token)
+        budget.release()
+
+
+def current_budget():
+    return _active_budget.get()
+
+
+def track(array):
+    """Charge `array` to the active budget, if any (see MemoryBudget.track); returns it."""
+    budget = _active_budget.get()
+    if budget is not None:
+        budget.track(array)
+    return array
+
+
+def scratch(key, shape, dtype=np.uint8):
+    """Scratch buffer from the active budget, or a fresh array outside low-memory mode."""
+    budget = _active_budget.get()
+    if budget is None:
+        return np.empty(shape, dtype=dtype)
+    return budget.scratch(key, shape, dtype)
@@ -0,0 +1,346 @@
+"""
+Engine Metrics for FixPix
+
+Per-stage instrumentation for the AI engine and processing pipeline.
+Every stage records wall time, CPU time and input megapixels, plus its
+peak allocated memory when FIXPIX_TRACE_MEMORY is on. Observations feed
+Prometheus-style histograms (served by the metrics endpoint) and, while
+a job is being recorded, are also collected so they can be attached to
+the ImageProject.
+
+Memory is traced with tracemalloc, which slows every Python allocation
+in the process several times over, so it is opt-in and only runs while a
+job is being recorded: the first job starts it and the last one to
+finish stops it (see record_job()). tracemalloc's peak is process-wide:
+jobs or pool threads running at the same time see each other's
+allocations, so the peaks are upper bounds.
+
+API requests are measured by api.middleware.RequestMetricsMiddleware;
+top-level stages and phase() blocks run during a request are added to
+its timings (the Server-Timing header).
+
+Note: histograms live in process memory, so each gunicorn/celery
+process exports its own series.
+"""
+
+import contextvars
+import functools
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+# Histogram bucket boundaries
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+MEGAPIXEL_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 12, 24, 48, 100)
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 8, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192))
+OUTPUT_BYTES_BUCKETS = tuple(kb * 1024 for kb in (64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072))
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+HTTP_BYTES_BUCKETS = tuple(kb * 1024 for kb in (1, 4, 16, 64, 256, 1024, 4096, 16384, 65536))
+
+
+class Histogram:
+    """
+    Minimal Prometheus histogram with labels.
+
+    Thread-safe; renders in the text exposition format.
+    """
+
+    def __init__(self, name, documentation, buckets, labelnames=('stage',)):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                self._series[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def _labels(self, key, extra=''):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} histogram',
+        ]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series['counts']):
+                    le = 'le="%g"' % bound
+                    lines.append(f'{self.name}_bucket{self._labels(key, le)} {count}')
+                le = 'le="+Inf"'
+                lines.append(f'{self.name}_bucket{self._labels(key, le)} {series["count"]}')
+                lines.append(f'{self.name}_sum{self._labels(key)} {series["sum"]:g}')
+                lines.append(f'{self.name}_count{self._labels(key)} {series["count"]}')
+        return lines
+
+
+class Registry:
+    """Collection of histograms exported together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, documentation, buckets, labelnames=('stage',)):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, documentation, buckets, labelnames)
+            return self._metrics[name]
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_WALL_SECONDS = REGISTRY.histogram(
+    'fixpix_stage_wall_seconds', 'Wall-clock time spent in an engine stage.', LATENCY_BUCKETS)
+STAGE_CPU_SECONDS = REGISTRY.histogram(
+    'fixpix_stage_cpu_seconds', 'Process CPU time spent in an engine stage.', LATENCY_BUCKETS)
+STAGE_INPUT_MEGAPIXELS = REGISTRY.histogram(
+    'fixpix_stage_input_megapixels', 'Input image size of an engine stage.', MEGAPIXEL_BUCKETS)
+STAGE_PEAK_BYTES = REGISTRY.histogram(
+    'fixpix_stage_peak_bytes', 'Peak memory allocated while an engine stage ran.', MEMORY_BUCKETS)
+OUTPUT_BYTES = REGISTRY.histogram(
+    'fixpix_output_bytes', 'Size of encoded outputs.', OUTPUT_BYTES_BUCKETS, labelnames=('format',))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'fixpix_http_request_seconds', 'API request latency.', LATENCY_BUCKETS,
+    labelnames=('endpoint', 'method', 'status'))
+HTTP_DB_QUERIES = REGISTRY.histogram(
+    'fixpix_http_db_queries', 'Database queries per API request.', QUERY_COUNT_BUCKETS, labelnames=('endpoint',))
+HTTP_DB_SECONDS = REGISTRY.histogram(
+    'fixpix_http_db_seconds', 'Database time per API request.', LATENCY_BUCKETS, labelnames=('endpoint',))
+HTTP_REQUEST_BYTES = REGISTRY.histogram(
+    'fixpix_http_request_bytes', 'API request body size.', HTTP_BYTES_BUCKETS, labelnames=('endpoint',))
+HTTP_RESPONSE_BYTES = REGISTRY.histogram(
+    'fixpix_http_response_bytes', 'API response body size.', HTTP_BYTES_BUCKETS, labelnames=('endpoint',))
+
+
+# Per-job record list and stack of nested stage peaks (see stage())
+_job_records = contextvars.ContextVar('fixpix_job_records', default=None)
+_peak_stack = contextvars.ContextVar('fixpix_peak_stack', default=None)
+# Timings of the API request being served, {name: seconds} (see phase())
+_request_timings = contextvars.ContextVar('fixpix_request_timings', default=None)
+
+# Jobs being recorded with memory tracing on, and whether they started tracemalloc
+_tracing_lock = threading.Lock()
+_tracing_jobs = 0
+_started_tracing = False
+
+
+def _trace_memory_enabled():
+    return getattr(settings, 'FIXPIX_TRACE_MEMORY', False)
+
+
+def _start_tracing():
+    global _tracing_jobs, _started_tracing
+    with _tracing_lock:
+        if _tracing_jobs == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+            _started_tracing = True
+        _tracing_jobs += 1
+
+
+def _stop_tracing():
+    global _tracing_jobs, _started_tracing
+    with _tracing_lock:
+        _tracing_jobs -= 1
+        # Tracing someone else started (e.g. a profiler) is left alone
+        if _tracing_jobs == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def _megapixels(image):
+    """Return the size of an image array (or WorkingImage) in megapixels, or None."""
+    shape = getattr(image, 'shape', None)
+    if shape is not None and len(shape) >= 2:
+        return round(shape[0] * shape[1] / 1e6, 3)
+    return None
+
+
+@contextmanager
+def record_job():
+    """
+    Collect the records of every stage run inside the block.
+
+    Usage:
+        with metrics.record_job() as records:
+            run_pipeline(...)
+        project.metrics = metrics.summarize(records)
+
+    Memory is traced while the block runs when FIXPIX_TRACE_MEMORY is on.
+    """
+    tracing = _trace_memory_enabled()
+    if tracing:
+        _start_tracing()
+    records = []
+    token = _job_records.set(records)
+    try:
+        yield records
+    finally:
+        _job_records.reset(token)
+        if tracing:
+            _stop_tracing()
+
+
+@contextmanager
+def stage(name, image=None):
+    """
+    Measure one engine stage.
+
+    Peak memory is taken from tracemalloc (numpy reports its buffers to it)
+    while it is tracing (see record_job()). Nested stages reset the
+    tracemalloc peak, so each level carries the highest peak seen by its
+    children on a stack.
+    """
+    # Measure the input now rather than keeping the frame alive for the whole stage
+    megapixels = _megapixels(image)
+    image = None
+
+    tracing = tracemalloc.is_tracing()
+
+    stack = _peak_stack.get()
+    if stack is None:
+        stack = []
+        _peak_stack.set(stack)
+
+    base_bytes = 0
+    if tracing:
+        base_bytes, outer_peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1] = max(stack[-1], outer_peak)
+        tracemalloc.reset_peak()
+    stack.append(0)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        child_peak = stack.pop()
+        peak_bytes = None
+        # Tracing may have stopped meanwhile if the stage outlived its job
+        if tracing and tracemalloc.is_tracing():
+            _, own_peak = tracemalloc.get_traced_memory()
+            absolute_peak = max(own_peak, child_peak)
+            peak_bytes = max(0, absolute_peak - base_bytes)
+            if stack:
+                stack[-1] = max(stack[-1], absolute_peak)
+
+        if not stack:
+            add_timing(name, wall)
+        STAGE_WALL_SECONDS.observe(wall, stage=name)
+        STAGE_CPU_SECONDS.observe(cpu, stage=name)
+        if megapixels is not None:
+            STAGE_INPUT_MEGAPIXELS.observe(megapixels, stage=name)
+        if peak_bytes is not None:
+            STAGE_PEAK_BYTES.observe(peak_bytes, stage=name)
+
+        records = _job_records.get()
+        if records is not None:
+            records.append({
+                'stage': name,
+                'wall_ms': round(wall * 1000, 2),
+                'cpu_ms': round(cpu * 1000, 2),
+                'megapixels': megapixels,
+                'peak_bytes': peak_bytes,
+                'depth': len(stack),
+            })
+
+
+def thread_context():
+    """
+    A copy of the current context for work handed to a pool thread.
+
+    Job records are shared; stages run in it get their own stack and are
+    recorded as children of the stage open in the caller (one context per
+    task: a context cannot be entered by two threads at once).
+    """
+    context = contextvars.copy_context()
+    context.run(_peak_stack.set, [0])
+    return context
+
+
+@contextmanager
+def request_timings():
+    """Collect the phase timings of one API request into the yielded dict."""
+    timings = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def add_timing(name, seconds):
+    """Add to a phase of the API request being served, if any."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    """Time a block as one phase of the current API request (e.g. 'auth')."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - start)
+
+
+def instrument(name):
+    """
+    Decorator form of stage() for AIEngine methods.
+
+    The first positional argument is treated as the stage input image.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            image = args[0] if args else kwargs.get('image_input')
+            with stage(name, image):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summarize(records):
+    """Build the JSON document stored on the job record."""
+    return {
+        'stages': records,
+        'total_wall_ms': round(sum(r['wall_ms'] for r in records if r['depth'] == 0), 2),
+        'peak_bytes': max((r['peak_bytes'] or 0 for r in records), default=0),
+    }
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    return REGISTRY.render()
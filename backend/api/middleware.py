@@ -0,0 +1,152 @@
+"""
+Request Metrics Middleware for FixPix
+
+Measures every API request: latency, database queries (count and time),
+and request and response body sizes, labelled by the matched URL name
+(e.g. 'imageproject-process-image') rather than the raw path so that
+project ids do not explode the series.
+
+Observations feed the fixpix_http_* histograms of api.metrics. When
+FIXPIX_SERVER_TIMING is on, the response carries a Server-Timing header
+with the total, database, authentication and top-level engine stage
+times, so browser dev tools show where a request spent its time.
+Requests slower than FIXPIX_SLOW_REQUEST_MS are logged with their
+slowest queries.
+"""
+
+import logging
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Queries listed in the slow-request log
+SLOW_LOG_QUERIES = 5
+
+
+class QueryRecorder:
+    """Database execute wrapper counting queries and their time, per SQL statement."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.seconds += elapsed
+            entry = self.statements.setdefault(sql, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def slowest(self, limit=SLOW_LOG_QUERIES):
+        """The `limit` statements with the most total time, as (sql, count, seconds)."""
+        ranked = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)
+        return [(sql, count, seconds) for sql, (count, seconds) in ranked[:limit]]
+
+
+def _endpoint(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match.route or 'unmatched'
+
+
+def _request_bytes(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+def _response_bytes(response):
+    if not getattr(response, 'streaming', False):
+        return len(response.content)
+    try:
+        return int(response.get('Content-Length', 0))
+    except ValueError:
+        return 0
+
+
+def server_timing(total, timings, queries=None):
+    """Server-Timing header value (durations in milliseconds)."""
+    parts = [f'total;dur={total * 1000:.1f}']
+    if queries is not None:
+        parts.append(f'db;dur={queries.seconds * 1000:.1f};desc="{queries.count} queries"')
+    parts.extend(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items())
+    return ', '.join(parts)
+
+
+class RequestMetricsMiddleware:
+    """Records latency, database use and body sizes of every request (see the module docstring)."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        queries = QueryRecorder()
+        start = time.perf_counter()
+        with metrics.request_timings() as timings, ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(queries))
+            response = self.get_response(request)
+        self._finish(request, response, time.perf_counter() - start, timings, queries)
+        return response
+
+    async def __acall__(self, request):
+        # Async views reach the database from sync_to_async threads,
+        # whose connections are not wrapped here: time and bytes only
+        start = time.perf_counter()
+        with metrics.request_timings() as timings:
+            response = await self.get_response(request)
+        self._finish(request, response, time.perf_counter() - start, timings)
+        return response
+
+    def _finish(self, request, response, total, timings, queries=None):
+        endpoint = _endpoint(request)
+        status = f'{response.status_code // 100}xx'
+        metrics.HTTP_REQUEST_SECONDS.observe(total, endpoint=endpoint, method=request.method, status=status)
+        metrics.HTTP_REQUEST_BYTES.observe(_request_bytes(request), endpoint=endpoint)
+        metrics.HTTP_RESPONSE_BYTES.observe(_response_bytes(response), endpoint=endpoint)
+        if queries is not None:
+            metrics.HTTP_DB_QUERIES.observe(queries.count, endpoint=endpoint)
+            metrics.HTTP_DB_SECONDS.observe(queries.seconds, endpoint=endpoint)
+
+        if getattr(settings, 'FIXPIX_SERVER_TIMING', True):
+            response['Server-Timing'] = server_timing(total, timings, queries)
+
+        threshold = getattr(settings, 'FIXPIX_SLOW_REQUEST_MS', 1000)
+        if threshold and total * 1000 >= threshold:
+            self._log_slow(request, endpoint, response, total, timings, queries)
+
+    def _log_slow(self, request, endpoint, response, total, timings, queries):
+        lines = [f"Slow request: {request.method} {request.path} ({endpoint}) -> {response.status_code} "
+                 f"in {total * 1000:.0f} ms"]
+        if timings:
+            lines.append("  phases: " + ', '.join(
+                f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items()))
+        if queries is not None:
+            lines.append(f"  {queries.count} queries in {queries.seconds * 1000:.0f} ms")
+            for sql, count, seconds in queries.slowest():
+                lines.append(f"    {seconds * 1000:7.1f} ms  x{count}  {sql[:200]}")
+        logger.warning('\n'.join(lines))
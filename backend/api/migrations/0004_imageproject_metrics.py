@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_imageproject_settings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageproject',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_imageproject_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageproject',
+            name='stats',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
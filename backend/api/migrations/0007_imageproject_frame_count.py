@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_imageproject_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageproject',
+            name='frame_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -21,7 +21,11 @@ class ImageProject(models.Model):
     processed_image = models.ImageField(upload_to='processed/', null=True, blank=True)
     processing_type = models.CharField(max_length=20, choices=PROCESSING_TYPES, default='restore')
     settings = models.JSONField(default=dict, blank=True)
+    metrics = models.JSONField(default=dict, blank=True)  # Per-stage timings of the last render
+    stats = models.JSONField(default=dict, blank=True)  # Statistics of the original (see api.image_stats)
+    frame_count = models.PositiveIntegerField(null=True, blank=True)  # Frames of the original, read once (see api.animation)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # Last save; orders media eviction
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
 
     def __str__(self):
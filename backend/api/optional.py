@@ -0,0 +1,36 @@
+"""
+Optional Dependencies for FixPix
+
+Heavy optional packages (rembg, ONNX Runtime, redis) are imported on
+first use rather than at module load, so web processes that never need
+them start fast. available() checks that a package is installed without
+importing it.
+"""
+
+import functools
+import importlib
+import importlib.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def available(name):
+    """Whether package `name` is installed (found, not imported)."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def load(name):
+    """Import package `name` on first use; None when it is not installed or fails to import."""
+    if not available(name):
+        return None
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        logger.warning("Could not import %s: %s", name, e)
+        return None
@@ -0,0 +1,332 @@
+"""
+Out-of-Core Rendering for FixPix
+
+Outputs above FIXPIX_OUT_OF_CORE_MEGAPIXELS (e.g. a 4x upscale of a
+10k-pixel original, ~4.8 GB as BGR) are rendered through memory-mapped
+scratch files instead of RAM. Upscaling and the stages after it run on
+row bands, with enough halo rows around each band to reproduce the
+full-frame result; the encoder then consumes the final buffer band by band.
+"""
+
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+
+import cv2
+import numpy as np
+from django.conf import settings as django_settings
+
+from . import encoding, metrics, smoothing
+from .ai_engine import AIEngine
+from .ai_presets import PRESETS, apply_preset, scale_saturation
+from .blur import PYRAMID_ALIGN
+
+logger = logging.getLogger(__name__)
+
+# Target size of one in-memory band
+BAND_BYTES = 64 * 1024 * 1024
+
+# Context rows needed on each side of a band for local filters to match the full frame
+UPSCALE_HALO = 12    # input rows: Lanczos taps (4) + bilateral/unsharp support at 2x (7 output rows)
+DENOISE_HALO = 24    # NL-means search (10) + template (3) + smoothing (bilateral 4, guided filter 8)
+CLARITY_HALO = 192   # pyramid blur at sigma 50 reaches ~170 rows; a multiple of PYRAMID_ALIGN
+
+# Settings handled after upscaling, in pipeline order
+POST_UPSCALE_SETTINGS = ('autoEnhance', 'whiteBalance', 'denoiseStrength', 'filterPreset', 'removeBackground')
+
+
+def upscale_factor(settings):
+    upscale_x = int(settings.get('upscaleX', 1))
+    if upscale_x <= 1:
+        return 1
+    return 4 if upscale_x >= 4 else 2
+
+
+def needs_out_of_core(shape, settings):
+    """True when the rendered output would exceed the out-of-core threshold."""
+    threshold = getattr(django_settings, 'FIXPIX_OUT_OF_CORE_MEGAPIXELS', 150)
+    factor = upscale_factor(settings)
+    return bool(threshold) and shape[0] * shape[1] * factor * factor / 1e6 > threshold
+
+
+def band_rows(shape):
+    row_bytes = int(np.prod(shape[1:]))
+    return max(16, BAND_BYTES // row_bytes)
+
+
+class ScratchSpace:
+    """Temporary directory of memory-mapped frame buffers, removed on close()."""
+
+    def __init__(self):
+        base_dir = getattr(django_settings, 'FIXPIX_SCRATCH_DIR', None) or tempfile.gettempdir()
+        os.makedirs(base_dir, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix='fixpix-ooc-', dir=base_dir)
+        self._count = 0
+
+    def array(self, shape, dtype=np.uint8):
+        self._count += 1
+        filename = os.path.join(self.path, f'buffer_{self._count}.raw')
+        return np.memmap(filename, dtype=dtype, mode='w+', shape=tuple(shape))
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def map_bands(src, dst, func, halo=0, scale=1):
+    """
+    Run func over row bands of src and write the results into dst.
+
+    func(band, row_offset) receives a band plus up to `halo` context rows
+    on each side (row_offset is the band's first row in src) and returns
+    an array `scale` times as large; only the band's own rows are kept.
+    src and dst may be the same buffer only when halo is 0.
+    """
+    rows = src.shape[0]
+    # Aligned band starts keep pyramid blurs on the same grid as the full frame
+    step = max(PYRAMID_ALIGN, band_rows(dst.shape) // scale // PYRAMID_ALIGN * PYRAMID_ALIGN)
+    for y0 in range(0, rows, step):
+        y1 = min(rows, y0 + step)
+        top = max(0, y0 - halo)
+        bottom = min(rows, y1 + halo)
+        # Copy the band into RAM; funcs may modify it in place
+        result = func(np.array(src[top:bottom]), top)
+        start = (y0 - top) * scale
+        dst[y0 * scale:y1 * scale] = result[start:start + (y1 - y0) * scale]
+    return dst
+
+
+def channel_means(frame):
+    """BGR channel means of a (possibly memory-mapped) frame, accumulated per band."""
+    totals = np.zeros(3)
+    step = band_rows(frame.shape)
+    for y in range(0, frame.shape[0], step):
+        totals += cv2.sumElems(np.ascontiguousarray(frame[y:y + step]))[:3]
+    return totals / (frame.shape[0] * frame.shape[1])
+
+
+class FrameRenderer:
+    """Holds the current frame in a memory-mapped buffer and applies banded stages."""
+
+    def __init__(self, scratch, frame, means=None):
+        self.scratch = scratch
+        self.frame = frame
+        # Channel means of the frame when known up front (see api.image_stats)
+        self.means = means
+
+    def _next_buffer(self, shape=None):
+        return self.scratch.array(shape or self.frame.shape)
+
+    def upscale(self, scale=2):
+        dst = self._next_buffer((self.frame.shape[0] * scale, self.frame.shape[1] * scale) + self.frame.shape[2:])
+        self.frame = map_bands(
+            self.frame, dst,
+            lambda band, _: AIEngine.upscale_image(band, scale=scale, return_path=False),
+            halo=UPSCALE_HALO, scale=scale,
+        )
+
+    def white_balance(self):
+        means = self.means if self.means is not None else channel_means(self.frame)
+        self.means = None
+        map_bands(self.frame, self.frame, lambda band, _: AIEngine._gray_world(band, out=band, means=means))
+
+    def auto_enhance(self):
+        """Gray world + CLAHE + saturation, with CLAHE run on a mapped L plane."""
+        self.white_balance()
+
+        rows, cols = self.frame.shape[:2]
+        luminance = self.scratch.array((rows, cols))
+        step = band_rows(self.frame.shape)
+        for y in range(0, rows, step):
+            lab = cv2.cvtColor(np.ascontiguousarray(self.frame[y:y + step]), cv2.COLOR_BGR2LAB)
+            luminance[y:y + step] = lab[:, :, 0]
+
+        # CLAHE tiles span the whole frame, so it needs the full (1 byte/pixel) plane
+        clahe = cv2.createCLAHE(clipLimit=2.5, tileGridSize=(8, 8))
+        equalized = self.scratch.array((rows, cols))
+        clahe.apply(luminance, dst=equalized)
+
+        def finish(band, y0):
+            lab = cv2.cvtColor(band, cv2.COLOR_BGR2LAB)
+            lab[:, :, 0] = equalized[y0:y0 + band.shape[0]]
+            cv2.cvtColor(lab, cv2.COLOR_LAB2BGR, dst=band)
+            return scale_saturation(band, 1.1, out=band)
+
+        map_bands(self.frame, self.frame, finish)
+
+    def denoise(self, strength):
+        self.frame = map_bands(
+            self.frame, self._next_buffer(),
+            lambda band, _: AIEngine.denoise_advanced(band, strength=strength, return_path=False),
+            halo=DENOISE_HALO,
+        )
+
+    def filter_preset(self, preset_name):
+        if preset_name not in PRESETS:
+            return
+        rows = self.frame.shape[0]
+
+        def apply(band, y0):
+            return apply_preset(band, preset_name, inplace=True, frame_rows=rows, row_offset=y0)
+
+        if 'clarity' in PRESETS[preset_name]:
+            self.frame = map_bands(self.frame, self._next_buffer(), apply, halo=CLARITY_HALO)
+        else:
+            map_bands(self.frame, self.frame, apply)
+
+    def whole_frame(self, func):
+        """Fallback for global stages (rembg, GrabCut, inpainting): run on the mapped frame."""
+        result = func(self.frame)
+        if not isinstance(result, np.memmap):
+            mapped = self._next_buffer(result.shape)
+            mapped[:] = result
+            del result
+            result = mapped
+        self.frame = result
+
+
+def write_png(frame, output_path, compression=1):
+    """
+    Stream a (possibly memory-mapped) BGR/BGRA/gray frame to a PNG file.
+
+    Rows are written with the PNG 'Up' filter and deflated band by band
+    (level 1 by default, like OpenCV's PNG encoder),
+    so memory use is bounded by one band regardless of the image size.
+    """
+    rows, cols = frame.shape[:2]
+    channels = frame.shape[2] if frame.ndim == 3 else 1
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+
+    def chunk(f, tag, data):
+        f.write(struct.pack('>I', len(data)))
+        f.write(tag + data)
+        f.write(struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+    compressor = zlib.compressobj(compression)
+    previous = np.zeros(cols * channels, dtype=np.uint8)
+    step = band_rows(frame.shape)
+    with open(output_path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        chunk(f, b'IHDR', struct.pack('>IIBBBBB', cols, rows, 8, color_type, 0, 0, 0))
+        for y in range(0, rows, step):
+            band = np.ascontiguousarray(frame[y:y + step])
+            if channels == 3:
+                band = cv2.cvtColor(band, cv2.COLOR_BGR2RGB)
+            elif channels == 4:
+                band = cv2.cvtColor(band, cv2.COLOR_BGRA2RGBA)
+            band = band.reshape(band.shape[0], -1)
+
+            # 'Up' filter: byte minus the byte above, modulo 256
+            filtered = np.empty((band.shape[0], band.shape[1] + 1), dtype=np.uint8)
+            filtered[:, 0] = 2
+            np.subtract(band[0], previous, out=filtered[0, 1:])
+            np.subtract(band[1:], band[:-1], out=filtered[1:, 1:])
+            previous = band[-1].copy()
+
+            data = compressor.compress(filtered.tobytes())
+            if data:
+                chunk(f, b'IDAT', data)
+        chunk(f, b'IDAT', compressor.flush())
+        chunk(f, b'IEND', b'')
+
+
+def encode(frame, output_path, policy=None):
+    """
+    Write the final frame with an encoding policy and return its encoding info.
+
+    PNG is streamed; other encoders (OpenCV's, so WebP ignores the
+    method) read the mapped rows sequentially.
+    """
+    policy = policy or encoding.resolve(source_name=output_path)
+    start = time.perf_counter()
+    with metrics.stage('encode', frame):
+        if policy['ext'] == '.png':
+            write_png(frame, output_path, policy['png_compression'])
+        elif not cv2.imwrite(output_path, frame, encoding.imwrite_params(policy)):
+            raise ValueError(f"Could not encode {output_path}")
+
+    fmt = policy['ext'].lstrip('.')
+    size = os.path.getsize(output_path)
+    metrics.OUTPUT_BYTES.observe(size, format=fmt)
+    return {'format': fmt, 'bytes': size, 'encode_ms': round((time.perf_counter() - start) * 1000, 2)}
+
+
+def render(img, settings, output_path, mask_data=None, job_id='', progress=None, policy=None, stats=None):
+    """
+    Render a huge output to `output_path` without holding it in RAM.
+
+    `img` is a BGR array or a WorkingImage (see run_pipeline).
+
+    Stages before upscaling run in memory at the input size; everything
+    from upscaling on runs on memory-mapped row bands. `progress(stage)`
+    is called after each stage, with the names run_pipeline uses. The
+    output is written with the encoding `policy`; returns its encoding info.
+    `stats` (see api.image_stats) spare the white balance a pass over the
+    upscaled frame when no earlier stage changed the colours.
+    """
+    from .pipeline import planned_stages, run_pipeline, _save_mask
+
+    pre_settings = {k: v for k, v in settings.items()
+                    if k not in POST_UPSCALE_SETTINGS and k != 'upscaleX'}
+    # Every stage before upscaling changes the colours
+    if planned_stages(pre_settings) != ['decode', 'save']:
+        stats = None
+    img = run_pipeline(img, pre_settings, progress=progress)
+
+    def report(stage):
+        if progress is not None:
+            progress(stage)
+
+    scratch = ScratchSpace()
+    try:
+        # Banded stages only see their halo rows (no bilateral grid)
+        with metrics.stage('out_of_core', img), smoothing.banded():
+            frame = scratch.array(img.shape)
+            frame[:] = img
+            del img
+            renderer = FrameRenderer(scratch, frame, stats['means'] if stats else None)
+
+            factor = upscale_factor(settings)
+            while factor > 1:
+                renderer.upscale(2)
+                report('upscale')
+                factor //= 2
+
+            if settings.get('autoEnhance', False):
+                renderer.auto_enhance()
+                report('auto_enhance')
+            if settings.get('whiteBalance', False):
+                renderer.white_balance()
+                report('white_balance')
+            denoise_strength = int(settings.get('denoiseStrength', 0))
+            if denoise_strength > 0:
+                renderer.denoise(denoise_strength)
+                report('denoise')
+            filter_preset = settings.get('filterPreset', '')
+            if filter_preset and filter_preset != 'none':
+                renderer.filter_preset(filter_preset)
+                report('filter_preset')
+            if settings.get('removeBackground', False):
+                try:
+                    renderer.whole_frame(lambda frame: AIEngine.remove_background(frame, return_path=False))
+                except Exception as e:
+                    logger.warning("BG Removal Failed: %s", e)
+                report('remove_background')
+            if mask_data:
+                mask_path = _save_mask(mask_data, job_id)
+                try:
+                    renderer.whole_frame(lambda frame: AIEngine.inpaint_object(frame, mask_path, return_path=False))
+                finally:
+                    if os.path.exists(mask_path):
+                        os.remove(mask_path)
+                report('inpaint')
+
+        with metrics.stage('save', renderer.frame):
+            info = encode(renderer.frame, output_path, policy)
+        report('save')
+    finally:
+        scratch.close()
+    return info
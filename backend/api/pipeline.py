@@ -0,0 +1,387 @@
+"""
+Processing Pipeline for FixPix
+
+Runs the editor's settings through the AI engine stages in a fixed order.
+Shared by the synchronous API view and background workers.
+"""
+
+import base64
+import collections
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future
+
+from django.conf import settings as django_settings
+from django.db import close_old_connections
+
+from . import animation, compute, decode_cache, encoding, image_stats, memory, metrics, out_of_core, smoothing, storage
+from .ai_engine import AIEngine
+from .models import ImageProject
+from .working_image import WorkingImage
+
+logger = logging.getLogger(__name__)
+
+
+def apply_legacy_settings(settings, processing_type):
+    """Map the legacy processing_type onto pipeline settings when none are given."""
+    if not settings and processing_type:
+        if processing_type == 'restore':
+            settings['removeScratches'] = True
+        if processing_type == 'colorize':
+            settings['colorize'] = True
+        if processing_type == 'upscale':
+            settings['upscaleX'] = 2
+    return settings
+
+
+def _save_mask(mask_data, job_id):
+    """Decode a base64 data-URL mask into a temporary file and return its path."""
+    # Expecting "data:image/png;base64,..."
+    if 'base64,' in mask_data:
+        mask_data = mask_data.split('base64,')[1]
+
+    mask_content = base64.b64decode(mask_data)
+    # Unique per call: the frames of an animation are inpainted concurrently
+    mask_filename = f"mask_{job_id}_{uuid.uuid4().hex}.png"
+    mask_path = os.path.join(django_settings.MEDIA_ROOT, 'temp', mask_filename)
+    os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+
+    with open(mask_path, 'wb') as f:
+        f.write(mask_content)
+    return mask_path
+
+
+def planned_stages(settings, mask_data=None):
+    """Names of the stages a render with `settings` reports to its progress callback, in order."""
+    stages = ['decode']
+    if settings.get('removeScratches', False):
+        stages.append('remove_scratches')
+    if settings.get('faceRestoration', False):
+        stages.append('restore_faces')
+    if settings.get('colorize', False):
+        stages.append('colorize')
+    if any(float(settings.get(key, 1.0)) != 1.0 for key in ('brightness', 'contrast', 'saturation')):
+        stages.append('adjust')
+    upscale_x = int(settings.get('upscaleX', 1))
+    if upscale_x > 1:
+        stages.extend(['upscale', 'upscale'] if upscale_x >= 4 else ['upscale'])
+    if settings.get('autoEnhance', False):
+        stages.append('auto_enhance')
+    if settings.get('whiteBalance', False):
+        stages.append('white_balance')
+    if int(settings.get('denoiseStrength', 0)) > 0:
+        stages.append('denoise')
+    filter_preset = settings.get('filterPreset', '')
+    if filter_preset and filter_preset != 'none':
+        stages.append('filter_preset')
+    if settings.get('removeBackground', False):
+        stages.append('remove_background')
+    if mask_data:
+        stages.append('inpaint')
+    stages.append('save')
+    return stages
+
+
+def run_pipeline(image, settings, mask_data=None, job_id='', progress=None, stats=None):
+    """
+    Apply every enabled stage to an image and return the result as BGR.
+
+    `image` is a BGR array or a WorkingImage, which is emptied when the
+    result is handed back. Stages edit the working image in their own
+    colour space, so consecutive stages that share one skip the
+    conversion back to BGR. An array is only modified in low-memory mode
+    (see api.memory), where the pipeline takes ownership.
+
+    Each AIEngine call records its own stage metrics; the whole run is
+    recorded as the 'pipeline' stage. `progress(stage)` is called after
+    every stage (see planned_stages). `stats` are the statistics of the
+    image (see api.image_stats), used while no stage has changed its colours.
+    """
+    low_memory = memory.low_memory_enabled(settings)
+    frame = WorkingImage.wrap(image, owned=low_memory)
+    # Only the working image references the frame from here on
+    del image
+
+    with metrics.stage('pipeline', frame):
+        if not low_memory:
+            return _run_stages(frame, settings, mask_data, job_id, None, progress, stats)
+        with memory.memory_budget(frame) as budget:
+            return _run_stages(frame, settings, mask_data, job_id, budget, progress, stats)
+
+
+def _run_stages(frame, settings, mask_data, job_id, budget, progress, stats):
+    def checkpoint(stage):
+        if budget is not None:
+            budget.check(stage, frame)
+        if progress is not None:
+            progress(stage)
+
+    # Channel means of the original hold until a stage changes the colours
+    # (upscaling resamples but keeps them)
+    means = stats['means'] if stats else None
+
+    # 1. Restoration (Scratches/Denoise)
+    if settings.get('removeScratches', False):
+        frame.replace(AIEngine.remove_scratches(frame.bgr(), return_path=False))
+        means = None
+        checkpoint('remove_scratches')
+
+    # 2. Face Restoration
+    if settings.get('faceRestoration', False):
+        AIEngine.restore_faces(frame, return_path=False)
+        means = None
+        checkpoint('restore_faces')
+
+    # 3. Colorization
+    if settings.get('colorize', False):
+        AIEngine.colorize_image(frame, return_path=False)
+        means = None
+        checkpoint('colorize')
+
+    # 4. Adjustments (Brightness, Contrast, Saturation)
+    b = float(settings.get('brightness', 1.0))
+    c = float(settings.get('contrast', 1.0))
+    s = float(settings.get('saturation', 1.0))
+
+    if b != 1.0 or c != 1.0 or s != 1.0:
+        AIEngine.adjust_image(frame, brightness=b, contrast=c, saturation=s, return_path=False)
+        means = None
+        checkpoint('adjust')
+
+    # 5. Upscaling
+    upscale_x = int(settings.get('upscaleX', 1))
+    if upscale_x > 1:
+        frame.replace(AIEngine.upscale_image(frame.bgr(), scale=2, return_path=False))
+        checkpoint('upscale')
+        if upscale_x >= 4:
+            frame.replace(AIEngine.upscale_image(frame.bgr(), scale=2, return_path=False))
+            checkpoint('upscale')
+
+    # 6. Auto-Enhance (Magic Wand)
+    if settings.get('autoEnhance', False):
+        AIEngine.auto_enhance(frame, return_path=False, means=means)
+        means = None
+        checkpoint('auto_enhance')
+
+    # 6.5. White Balance Correction
+    if settings.get('whiteBalance', False):
+        AIEngine.correct_white_balance(frame, return_path=False, means=means)
+        checkpoint('white_balance')
+
+    # 6.6. Advanced Denoising (if strength specified)
+    denoise_strength = int(settings.get('denoiseStrength', 0))
+    if denoise_strength > 0:
+        frame.replace(AIEngine.denoise_advanced(frame.bgr(), strength=denoise_strength, return_path=False))
+        checkpoint('denoise')
+
+    # 6.7. Filter Preset
+    filter_preset = settings.get('filterPreset', '')
+    if filter_preset and filter_preset != 'none':
+        AIEngine.apply_filter_preset(frame, filter_preset, return_path=False)
+        checkpoint('filter_preset')
+
+    # 7. Background Removal
+    if settings.get('removeBackground', False):
+        try:
+            frame.replace(AIEngine.remove_background(frame.bgr(), return_path=False))
+        except Exception as e:
+            logger.warning("BG Removal Failed: %s", e)
+        checkpoint('remove_background')
+
+    # 8. Object Removal (Inpainting)
+    if mask_data:
+        mask_path = _save_mask(mask_data, job_id)
+        try:
+            frame.replace(AIEngine.inpaint_object(frame.bgr(), mask_path, return_path=False))
+        finally:
+            # Clean up mask
+            if os.path.exists(mask_path):
+                os.remove(mask_path)
+        checkpoint('inpaint')
+
+    # Only the final output is materialised in BGR
+    return frame.detach()
+
+
+def process_project(project, settings, mask_data=None, progress=None):
+    """
+    Run the pipeline for a project, store the output and attach stage metrics.
+
+    `progress(stage)` is called after each stage, including 'decode' and
+    'save'. The output is encoded with the encoding policy (settings.output
+    over the deployment defaults, see api.encoding) and uploaded to the
+    default storage in the background; returns a Future that resolves to
+    (storage name, encoding info).
+    """
+    policy = encoding.resolve(settings.get('output'), project.original_image.name)
+    if animation.is_animated(project):
+        return _process_frames(project, settings, mask_data, progress, policy)
+
+    name = storage.output_name(project.original_image.name, 'edited', policy['ext'])
+    with metrics.record_job() as records:
+        with metrics.stage('decode'):
+            # The decoded frame belongs to the pipeline, which edits it in place
+            # (a cached original is a copy-on-write map, see api.decode_cache)
+            frame = WorkingImage(decode_cache.load(project.original_image), owned=True)
+        if progress is not None:
+            progress('decode')
+        # Computed once per original and stored on the project
+        stats = image_stats.for_project(project, frame.bgr())
+
+        # The edge-preserving smoothing backend follows settings.quality (see api.smoothing)
+        with smoothing.quality(settings.get('quality')):
+            if out_of_core.needs_out_of_core(frame.shape, settings):
+                # Huge outputs render through memory-mapped bands straight into a file: on local
+                # storage one in the media directory that is then renamed to the output's content
+                # name, else a temporary file that is streamed up
+                target = output_path = storage.local_target(name)
+                if target is None:
+                    fd, output_path = tempfile.mkstemp(suffix=os.path.splitext(name)[1],
+                                                       dir=getattr(django_settings, 'FIXPIX_SCRATCH_DIR', '') or None)
+                    os.close(fd)
+                try:
+                    info = out_of_core.render(frame, settings, output_path, mask_data, job_id=project.pk,
+                                              progress=progress, policy=policy, stats=stats)
+                except Exception:
+                    os.remove(output_path)
+                    raise
+                if target is not None:
+                    upload = storage.completed((storage.commit_local(name, target), info))
+                else:
+                    upload = storage.save_file_async(name, output_path, info)
+            else:
+                current_img = run_pipeline(frame, settings, mask_data, job_id=project.pk, progress=progress, stats=stats)
+
+                # Final Save - encoding and upload overlap with whatever this worker runs next
+                upload = storage.save_image_async(project.original_image.name, 'edited', current_img, policy)
+                del current_img
+                if progress is not None:
+                    progress('save')
+
+    project.metrics = metrics.summarize(records)
+    return upload
+
+
+def _process_frames(project, settings, mask_data, progress, policy):
+    """
+    process_project for originals with several frames (see api.animation).
+
+    Frames are decoded one at a time and rendered on the job's threads, one
+    frame per thread. OpenCV's pool is shared by the process: a frame that
+    finds it busy runs its loops on its own thread. In low-memory mode each
+    frame runs under its own budget (budgets are per context, see
+    api.memory). Every frame uses the statistics of the first, so all
+    frames get the same white balance gains. Each stage is reported to
+    `progress` once every frame has run it.
+    """
+    with metrics.record_job() as records, animation.open_frames(project.original_image) as frames:
+        ext = animation.output_ext(policy, frames.format)
+        name = storage.output_name(project.original_image.name, 'edited', ext)
+        decoded = iter(frames)
+        with metrics.stage('decode'):
+            first = next(decoded)
+        if progress is not None:
+            progress('decode')
+        stats = image_stats.for_project(project, first)
+
+        lock = threading.Lock()
+        done = collections.Counter()
+
+        def frame_progress(stage):
+            with lock:
+                done[stage] += 1
+                finished = done[stage] % frames.count == 0
+            if finished and progress is not None:
+                progress(stage)
+
+        def render_frame(image):
+            output = run_pipeline(WorkingImage(image, owned=True), settings, mask_data, job_id=project.pk,
+                                  progress=frame_progress, stats=stats)
+            return animation.to_pil(output, ext)
+
+        rows, cols = first.shape[:2]
+        fd, output_path = tempfile.mkstemp(suffix=ext, dir=getattr(django_settings, 'FIXPIX_SCRATCH_DIR', '') or None)
+        os.close(fd)
+        # Threads are sized for all frames together
+        threads = compute.threads_for_job((rows * frames.count, cols), out_of_core.upscale_factor(settings))
+        with smoothing.quality(settings.get('quality')), metrics.stage('frames', first):
+            try:
+                rendered = compute.map_ordered(render_frame, itertools.chain([first], decoded), threads,
+                                               animation.FRAME_WINDOW_FACTOR, 'fixpix-frame')
+                info = animation.write(rendered, output_path, ext, policy, frames.durations, frames.loop)
+            except Exception:
+                os.remove(output_path)
+                raise
+        del first
+        if progress is not None:
+            progress('save')
+
+    project.metrics = metrics.summarize(records)
+    return storage.save_file_async(name, output_path, info)
+
+
+def _mark_failed(project):
+    """
+    Mark a project 'failed' with a single-column update, so a render never
+    stays 'processing' because the full save of its other fields failed.
+    """
+    project.status = 'failed'
+    try:
+        ImageProject.objects.filter(pk=project.pk).update(status='failed')
+    except Exception as e:
+        logger.error("Could not mark %s failed: %s", project.pk, e)
+        # Drop the connection if it broke, so the thread's next query reconnects
+        close_old_connections()
+
+
+def render_project(project, settings, mask_data=None, progress=None):
+    """
+    Process a project and record the outcome on it.
+
+    The project is marked 'processing' while the pipeline runs. Returns a
+    Future that resolves to the project once its output is stored, which
+    is then 'completed' with the new output and settings (the previous
+    output is deleted). A failed render or upload marks it 'failed'; a
+    pipeline error is raised directly, an upload error through the Future.
+    """
+    project.status = 'processing'
+    project.save()
+    try:
+        upload = process_project(project, settings, mask_data, progress)
+    except Exception:
+        _mark_failed(project)
+        raise
+
+    result = Future()
+
+    def stored(upload):
+        # Runs on a long-lived upload thread: drop its connection if stale before and
+        # after using it, as request handling does
+        close_old_connections()
+        try:
+            name, output = upload.result()
+            previous = project.processed_image.name
+            project.processed_image.name = name
+            # Encoding finishes after the stage metrics were summarised
+            project.metrics = dict(project.metrics, output=output)
+            # Save the settings used for this generation
+            project.settings = settings
+            project.status = 'completed'
+            project.save()
+            if previous != name:
+                storage.delete(previous)
+        except Exception as e:
+            logger.warning("Storing the output of %s failed: %s", project.pk, e)
+            _mark_failed(project)
+            result.set_exception(e)
+        else:
+            result.set_result(project)
+        finally:
+            close_old_connections()
+
+    upload.add_done_callback(stored)
+    return result
@@ -0,0 +1,104 @@
+"""
+Preset Previews for FixPix
+
+Renders a project's original under every preset in one pass for the
+preset picker: the original is decoded once (through the decode cache),
+downscaled once to a proxy and each preset runs on that proxy, sharing
+the gray plane and the vignette mask (see ai_presets.render_previews).
+
+Two layouts are served: 'sheet', one JPEG contact sheet with a labelled
+tile per preset, and 'json', a base64 JPEG data URL per preset. Results
+are cached in Django's cache under a key built from the original's
+fingerprint, the preview size, the layout and the preset definitions, so
+editing a preset or replacing the original invalidates them; the same key
+is the response ETag.
+"""
+
+import base64
+import hashlib
+import json
+import math
+
+import cv2
+import numpy as np
+from django.core.cache import cache
+
+from . import decode_cache
+from .ai_presets import PRESETS, render_previews
+
+DEFAULT_SIZE = 256
+MIN_SIZE = 64
+MAX_SIZE = 512
+LAYOUTS = ('sheet', 'json')
+
+# Contact sheet geometry
+SHEET_COLUMNS = 4
+TILE_GAP = 8
+LABEL_HEIGHT = 24
+PREVIEW_QUALITY = 85
+CACHE_SECONDS = 24 * 3600
+
+_PRESETS_VERSION = hashlib.sha1(json.dumps(PRESETS, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def clamp_size(value):
+    try:
+        return max(MIN_SIZE, min(MAX_SIZE, int(value)))
+    except (TypeError, ValueError):
+        return DEFAULT_SIZE
+
+
+def cache_key(project, size, layout):
+    """Cache key / ETag of a project's previews; changes with the original or any preset."""
+    fingerprint = decode_cache.fingerprint(project.original_image)
+    return f"fixpix-previews:{fingerprint}:{size}:{layout}:{_PRESETS_VERSION}"
+
+
+def _jpeg(image):
+    ok, buf = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY])
+    if not ok:
+        raise ValueError("Could not encode preview")
+    return buf.tobytes()
+
+
+def contact_sheet(previews):
+    """Lay previews out in a labelled grid (all previews share one size)."""
+    rows, cols = next(iter(previews.values())).shape[:2]
+    grid_rows = math.ceil(len(previews) / SHEET_COLUMNS)
+    grid_cols = min(len(previews), SHEET_COLUMNS)
+    cell_h, cell_w = rows + LABEL_HEIGHT + TILE_GAP, cols + TILE_GAP
+    sheet = np.full((grid_rows * cell_h + TILE_GAP, grid_cols * cell_w + TILE_GAP, 3), 32, np.uint8)
+
+    for i, (name, preview) in enumerate(previews.items()):
+        y = TILE_GAP + (i // SHEET_COLUMNS) * cell_h
+        x = TILE_GAP + (i % SHEET_COLUMNS) * cell_w
+        sheet[y:y + rows, x:x + cols] = preview
+        cv2.putText(sheet, name, (x, y + rows + LABEL_HEIGHT - 8),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (230, 230, 230), 1, cv2.LINE_AA)
+    return sheet
+
+
+def render(project, size=DEFAULT_SIZE, layout='sheet'):
+    """
+    Return (key, body, content_type) for a project's preset previews.
+
+    body is JPEG bytes for the 'sheet' layout and a JSON string mapping
+    each preset to a data URL for 'json'. Rendered once per key.
+    """
+    key = cache_key(project, size, layout)
+    cached = cache.get(key)
+    if cached is not None:
+        return (key,) + cached
+
+    previews = render_previews(decode_cache.load(project.original_image), max_side=size)
+    if layout == 'sheet':
+        result = (_jpeg(contact_sheet(previews)), 'image/jpeg')
+    else:
+        body = {
+            name: 'data:image/jpeg;base64,' + base64.b64encode(_jpeg(preview)).decode()
+            for name, preview in previews.items()
+        }
+        result = (json.dumps(body), 'application/json')
+
+    cache.set(key, result, CACHE_SECONDS)
+    return (key,) + result
@@ -0,0 +1,67 @@
+"""
+Background Segmentation for FixPix
+
+Foreground masks from rembg, when it is installed. rembg imports ONNX
+Runtime and its model code, so it is only imported on first use, and
+rembg.remove() without a session loads the model on every call: one
+session of FIXPIX_REMBG_MODEL is created per process and reused (worker
+warm-up creates it ahead of the first job, see api.warmup).
+
+The session's ONNX Runtime threads are sized to the worker's share of
+the cores when it is created (api.compute.session_options()).
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+
+from . import compute, optional
+
+logger = logging.getLogger(__name__)
+
+_session_lock = threading.Lock()
+_session = None
+
+
+def available():
+    """Whether rembg is installed (without importing it)."""
+    return optional.available('rembg')
+
+
+def model_name():
+    return getattr(settings, 'FIXPIX_REMBG_MODEL', 'u2net')
+
+
+def _new_session(rembg, name):
+    """
+    A rembg session of model `name` with this process's thread count.
+
+    rembg.new_session() only sizes its threads from OMP_NUM_THREADS, so the
+    session class is created directly with our SessionOptions.
+    """
+    for session_class in rembg.sessions.sessions_class:
+        if session_class.name() == name:
+            return session_class(name, compute.session_options(optional.load('onnxruntime')))
+    return rembg.new_session(name)
+
+
+def get_session():
+    """This process's rembg session, created on first use; None without rembg."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            rembg = optional.load('rembg')
+            if rembg is None:
+                return None
+            _session = _new_session(rembg, model_name())
+            logger.info("Loaded rembg model %s", model_name())
+        return _session
+
+
+def remove(image_bytes):
+    """Encoded image bytes with the background removed (PNG with alpha)."""
+    session = get_session()
+    if session is None:
+        raise RuntimeError("rembg is not installed")
+    return optional.load('rembg').remove(image_bytes, session=session)
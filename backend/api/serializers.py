@@ -37,5 +37,12 @@ class RegisterSerializer(serializers.ModelSerializer):
 class ImageProjectSerializer(serializers.ModelSerializer):
     class Meta:
         model = ImageProject
-        fields = '__all__'
-        read_only_fields = ('user', 'id', 'processed_image', 'created_at', 'status')
+        # Statistics are served by the stats action, not with every project
+        exclude = ('stats',)
+        read_only_fields = ('user', 'id', 'processed_image', 'created_at', 'status', 'metrics', 'frame_count')
+
+    def update(self, instance, validated_data):
+        if 'original_image' in validated_data:
+            # Read again from the new original on its next render
+            instance.frame_count = None
+        return super().update(instance, validated_data)
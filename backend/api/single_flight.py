@@ -0,0 +1,150 @@
+"""
+Single-Flight Renders for FixPix
+
+Double-clicked "Apply" buttons and client retries send the same render
+several times. A render is identified by its project and canonical
+settings (see key()); the first request runs it and requests with the
+same key that arrive while it is in flight attach to it instead of
+rendering again.
+
+Within a process, callers share the leader's Future. When
+FIXPIX_SINGLE_FLIGHT_URL points at Redis, the leader also holds a lock
+there for the duration of the render, so a duplicate that reaches
+another web process waits for the lock and then reads the leader's
+result (see run()). Locks expire after FIXPIX_SINGLE_FLIGHT_TIMEOUT
+seconds in case a leader dies without releasing its lock.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from django.conf import settings
+
+from . import optional
+
+logger = logging.getLogger(__name__)
+
+# How often followers in other processes check the Redis lock (seconds)
+POLL_INTERVAL = 0.2
+
+# Deletes the lock only while it still belongs to the caller
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_lock = threading.Lock()
+_inflight = {}
+_client = None
+# The redis package, imported by _redis() when a URL is configured
+redis = None
+
+
+def key(project_id, process_settings, mask_data=None):
+    """Identity of a render: the project plus its settings in canonical JSON form."""
+    canonical = json.dumps([str(project_id), process_settings, mask_data or ''],
+                           sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def _redis():
+    global _client, redis
+    url = getattr(settings, 'FIXPIX_SINGLE_FLIGHT_URL', '')
+    if not url:
+        return None
+    with _lock:
+        if _client is None:
+            redis = optional.load('redis')
+            if redis is None:
+                logger.warning("FIXPIX_SINGLE_FLIGHT_URL is set but redis is not installed; coalescing locally only")
+                return None
+            _client = redis.Redis.from_url(url)
+        return _client
+
+
+class _RedisLock:
+    """A render lock shared by every process using the same Redis."""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = f'fixpix:render:{name}'
+        self.token = uuid.uuid4().hex
+        self.timeout = getattr(settings, 'FIXPIX_SINGLE_FLIGHT_TIMEOUT', 900)
+
+    def acquire(self):
+        return bool(self.client.set(self.name, self.token, nx=True, ex=self.timeout))
+
+    def wait(self):
+        """Block until the holder releases the lock (or it expires)."""
+        deadline = time.monotonic() + self.timeout
+        while self.client.exists(self.name) and time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+
+    def release(self):
+        try:
+            self.client.eval(_RELEASE_SCRIPT, 1, self.name, self.token)
+        except redis.RedisError as e:
+            # The lock expires on its own
+            logger.warning("Could not release render lock %s: %s", self.name, e)
+
+
+def _forward(source, target):
+    error = source.exception()
+    if error is not None:
+        target.set_exception(error)
+    else:
+        target.set_result(source.result())
+
+
+def run(render_key, start, follow):
+    """
+    Run a render once per key at a time and return a Future of its result.
+
+    start() begins the render and returns a Future. A caller arriving
+    while the same key is in flight in this process gets that render's
+    Future. When another process holds the Redis lock, the caller waits
+    for it to finish and the Future resolves to follow(), which reads the
+    result the other process stored.
+    """
+    with _lock:
+        shared = _inflight.get(render_key)
+        if shared is not None:
+            logger.info("Attaching to in-flight render %s", render_key)
+            return shared
+        shared = _inflight[render_key] = Future()
+
+    client = _redis()
+    lock = _RedisLock(client, render_key) if client is not None else None
+
+    def finished(_):
+        with _lock:
+            _inflight.pop(render_key, None)
+
+    try:
+        try:
+            leader = lock is None or lock.acquire()
+        except redis.RedisError as e:
+            logger.warning("Render lock unavailable, coalescing locally only: %s", e)
+            lock, leader = None, True
+
+        if leader:
+            if lock is not None:
+                shared.add_done_callback(lambda _: lock.release())
+            start().add_done_callback(lambda future: _forward(future, shared))
+        else:
+            logger.info("Render %s is in flight in another process; waiting for it", render_key)
+            lock.wait()
+            shared.set_result(follow())
+    except Exception as e:
+        if not shared.done():
+            shared.set_exception(e)
+    # Registered last: callers may attach until the render is finished
+    shared.add_done_callback(finished)
+    return shared
@@ -0,0 +1,209 @@
+"""
+Edge-Preserving Smoothing for FixPix
+
+cv2.bilateralFilter costs one weighted tap per kernel pixel, so d=9 is
+~6x the work of d=5 and a large share of restoration time. Stages call
+edge_preserving() with bilateral parameters and the backend comes from
+the job's quality tier:
+
+- high:     bilateral, cv2.bilateralFilter itself (the reference).
+- balanced: guided, a self-guided filter (He et al.) per channel from
+            box filters, O(1) per pixel for any radius (d // 2).
+- fast:     grid, a bilateral grid: pixels are splatted into a grid
+            downsampled by sigma_space / 2 in space and sigma_color / 2
+            in range, the grid is blurred, and pixels are read back with
+            trilinear interpolation.
+
+At d=9 on a 12 MP image the guided filter and the grid take ~40% and
+~35% of the bilateral filter's time (mean error ~1 and ~1.5 levels).
+Up to BILATERAL_MAX_D the bilateral filter is cheaper than either, so
+it is used at every tier.
+
+The tier is FIXPIX_SMOOTHING_QUALITY, overridden per render with
+settings.quality (see quality()). Out-of-core bands only see a few halo
+rows, less than the grid's support, so banded stages use the guided
+filter in place of the grid (see banded()). Both approximations hold
+several full-frame float32 intermediates, so under a memory budget
+(low-memory mode, see api.memory) every tier uses the bilateral filter,
+which needs none.
+"""
+
+import contextlib
+import contextvars
+import math
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from . import memory
+
+TIERS = {'high': 'bilateral', 'balanced': 'guided', 'fast': 'grid'}
+
+# Kernel diameters up to this are filtered directly at every tier
+BILATERAL_MAX_D = 5
+
+# Grid cells per sigma in space and range; 2 keeps the interpolation error low
+GRID_CELLS_PER_SIGMA = 2
+
+_tier = contextvars.ContextVar('fixpix_smoothing_tier', default=None)
+_banded = contextvars.ContextVar('fixpix_smoothing_banded', default=False)
+
+
+def resolve_tier(tier=None):
+    """The tier to use: `tier` when given, else FIXPIX_SMOOTHING_QUALITY. Unknown tiers raise ValueError."""
+    tier = tier or getattr(settings, 'FIXPIX_SMOOTHING_QUALITY', 'high')
+    if tier not in TIERS:
+        raise ValueError(f"Unknown quality tier: {tier}")
+    return tier
+
+
+@contextlib.contextmanager
+def quality(tier=None):
+    """Smooth with the backend of `tier` (default FIXPIX_SMOOTHING_QUALITY) inside the block."""
+    token = _tier.set(resolve_tier(tier))
+    try:
+        yield
+    finally:
+        _tier.reset(token)
+
+
+@contextlib.contextmanager
+def banded():
+    """Inside the block images are row bands with small halos: the grid falls back to the guided filter."""
+    token = _banded.set(True)
+    try:
+        yield
+    finally:
+        _banded.reset(token)
+
+
+def choose_method(d):
+    """Pick 'bilateral', 'guided' or 'grid' for kernel diameter d under the current tier."""
+    if d <= BILATERAL_MAX_D or memory.current_budget() is not None:
+        return 'bilateral'
+    method = TIERS[_tier.get() or resolve_tier()]
+    if method == 'grid' and _banded.get():
+        return 'guided'
+    return method
+
+
+def guided_filter(src, radius, eps):
+    """
+    Self-guided filter of each channel of a uint8 image.
+
+    q = mean(a) * I + mean(b) with a = var / (var + eps), b = (1 - a) * mean
+    over (2 * radius + 1)^2 windows; eps is in units of (intensity / 255)^2.
+    The box filters read the uint8 image directly into float32.
+    """
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    border = cv2.BORDER_REFLECT_101
+
+    mean = cv2.boxFilter(src, cv2.CV_32F, ksize, borderType=border)
+    variance = cv2.sqrBoxFilter(src, cv2.CV_32F, ksize, borderType=border)
+    scratch = cv2.multiply(mean, mean)
+    cv2.subtract(variance, scratch, dst=variance)
+
+    # a = var / (var + eps), in the variance buffer
+    cv2.add(variance, eps * 255 * 255, dst=scratch)
+    a = cv2.divide(variance, scratch, dst=variance)
+    # b = mean - a * mean, in the mean buffer
+    b = cv2.subtract(mean, cv2.multiply(a, mean, dst=scratch), dst=mean)
+
+    cv2.boxFilter(a, -1, ksize, dst=a, borderType=border)
+    cv2.boxFilter(b, -1, ksize, dst=b, borderType=border)
+    result = cv2.multiply(a, src, dst=scratch, dtype=cv2.CV_32F)
+    cv2.add(result, b, dst=result)
+    return cv2.convertScaleAbs(result)
+
+
+def bilateral_grid(src, sigma_color, sigma_space):
+    """
+    Bilateral filter approximation on a downsampled (y, x, intensity) grid.
+
+    Range is taken from the luminance, so all channels share one grid.
+    The grid is filled from a copy of the image area-downsampled to
+    half a grid cell per pixel (a weighted histogram, np.bincount) and
+    read back at full resolution with two bilinear cv2.remap reads of the
+    range slices laid side by side, blended by the pixel's intensity.
+    """
+    rows, cols = src.shape[:2]
+    channels = src.shape[2] if src.ndim == 3 else 1
+    space_step = max(1.0, sigma_space / GRID_CELLS_PER_SIGMA)
+    range_step = max(1.0, sigma_color / GRID_CELLS_PER_SIGMA)
+
+    # One cell of padding on each side keeps the blur and the interpolation inside the grid
+    grid_rows = int(math.ceil((rows - 1) / space_step)) + 3
+    grid_cols = int(math.ceil((cols - 1) / space_step)) + 3
+    grid_depth = int(math.ceil(255 / range_step)) + 3
+
+    guide = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY) if channels == 3 else src
+
+    # Splat from the downsampled copy: nearest cell, values and counts summed with bincount
+    factor = max(1, int(space_step / 2))
+    small_size = (max(1, cols // factor), max(1, rows // factor))
+    small = cv2.resize(src, small_size, interpolation=cv2.INTER_AREA).reshape(-1, channels)
+    small_guide = cv2.resize(guide, small_size, interpolation=cv2.INTER_AREA)
+    cell_y = ((np.arange(small_size[1]) + 0.5) * (rows / small_size[1]) / space_step + 1.5).astype(np.intp)
+    cell_x = ((np.arange(small_size[0]) + 0.5) * (cols / small_size[0]) / space_step + 1.5).astype(np.intp)
+    index = (cell_y[:, None] * grid_cols + cell_x[None, :]) * grid_depth
+    index += (small_guide / range_step + 1.5).astype(np.intp)
+    index = index.ravel()
+    size = grid_rows * grid_cols * grid_depth
+    grid = np.empty((grid_rows, grid_cols, grid_depth, channels + 1), np.float32)
+    for c in range(channels):
+        grid[..., c] = np.bincount(index, weights=small[:, c], minlength=size).reshape(grid.shape[:3])
+    grid[..., channels] = np.bincount(index, minlength=size).reshape(grid.shape[:3])
+
+    # Blur with a [1, 4, 6, 4, 1] / 16 kernel (sigma 1 cell) along each axis
+    kernel = np.array([1, 4, 6, 4, 1], np.float32) / 16
+    for axis in range(3):
+        grid = _convolve_axis(grid, kernel, axis)
+    values = grid[..., :channels] / np.maximum(grid[..., channels:], 1e-6)
+
+    # Slice: the range slices side by side form one image (uint8 keeps the remaps cheap)
+    atlas = cv2.convertScaleAbs(np.ascontiguousarray(values.transpose(0, 2, 1, 3))
+                                .reshape(grid_rows, grid_depth * grid_cols, channels))
+    depth = guide.astype(np.float32)
+    depth *= 1 / range_step
+    depth += 1
+    lower = np.floor(depth)
+    upper_weight = cv2.subtract(depth, lower, dst=depth)
+
+    map_y = np.empty((rows, cols), np.float32)
+    map_y[:] = (np.arange(rows, dtype=np.float32) / space_step + 1)[:, None]
+    map_x = lower
+    map_x *= grid_cols
+    map_x += np.arange(cols, dtype=np.float32) / space_step + 1
+    below = cv2.remap(atlas, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    map_x += grid_cols
+    above = cv2.remap(atlas, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    lower_weight = cv2.subtract(1.0, upper_weight, dst=map_y)
+    return cv2.blendLinear(below, above, lower_weight, upper_weight).reshape(src.shape)
+
+
+def _convolve_axis(grid, kernel, axis):
+    padded = np.pad(grid, [(2, 2) if a == axis else (0, 0) for a in range(grid.ndim)], mode='edge')
+    result = np.zeros_like(grid)
+    length = grid.shape[axis]
+    for offset, weight in enumerate(kernel):
+        result += weight * np.take(padded, range(offset, offset + length), axis=axis)
+    return result
+
+
+def edge_preserving(src, d, sigma_color, sigma_space, method=None):
+    """
+    Edge-preserving smoothing of a uint8 BGR or gray image with
+    cv2.bilateralFilter's parameters, by the backend choose_method()
+    picks (or `method`: 'bilateral', 'guided' or 'grid').
+    """
+    method = method or choose_method(d)
+    if method == 'bilateral':
+        return cv2.bilateralFilter(src, d=d, sigmaColor=sigma_color, sigmaSpace=sigma_space)
+    if method == 'grid':
+        return bilateral_grid(src, sigma_color, sigma_space)
+    if method == 'guided':
+        # A bilateral range weight exp(-x^2 / 2 sigma^2) halves at ~1.2 sigma;
+        # eps of sigma^2 / 2 gives the guided filter a similar edge threshold
+        return guided_filter(src, max(1, d // 2), (sigma_color / 255) ** 2 / 2)
+    raise ValueError(f"Unknown smoothing method: {method}")
@@ -0,0 +1,212 @@
+"""
+Output Storage for FixPix
+
+Renders are encoded in memory (see api.encoding) and handed to Django's
+default storage (local filesystem, S3 or Cloudinary, see
+STORAGE_PROVIDER), so remote deployments never write MEDIA_ROOT first.
+Encoding and upload run on a small thread pool: a worker starts its next
+job while the previous output is still being encoded and uploaded.
+Storage backends stream file objects themselves (S3 switches to
+multipart uploads for large outputs).
+
+Outputs are immutable: their names carry a hash of their content
+(processed/<original>_<suffix>.<digest><ext>, see content_name()), so a
+re-render is stored under a new URL instead of overwriting the previous
+one, concurrent renders never write the same file, and an identical
+re-render reuses the stored file. Their URLs can be cached forever
+(IMMUTABLE_CACHE_CONTROL, see cache_control()); superseded versions are
+deleted when a project stores its new output and by media GC.
+
+Any Django storage works, including InMemoryStorage as an in-process
+stand-in for an object store.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+
+from . import encoding, metrics
+
+# Hex digits of the SHA-1 content digest in output names
+DIGEST_LENGTH = 16
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Media without a content digest (originals, legacy outputs) may be replaced
+MUTABLE_CACHE_CONTROL = 'public, max-age=300'
+
+# Also matches names under a storage location prefix
+_CONTENT_NAME = re.compile(r'(?:^|/)processed/[^/]+\.[0-9a-f]{%d}\.[A-Za-z0-9]+$' % DIGEST_LENGTH)
+
+_lock = threading.Lock()
+_uploads = None
+
+
+def output_name(source_name, suffix, ext=None):
+    """Storage name of a processed output derived from an original (path or storage name)."""
+    name, source_ext = os.path.splitext(os.path.basename(source_name))
+    return f"processed/{name}_{suffix}{ext or source_ext}"
+
+
+def digest(data):
+    """Content digest of bytes for output names."""
+    return hashlib.sha1(data).hexdigest()[:DIGEST_LENGTH]
+
+
+def file_digest(path):
+    """Content digest of a file, read in chunks."""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha1').hexdigest()[:DIGEST_LENGTH]
+
+
+def content_name(name, content_digest):
+    """`name` (from output_name()) with the content digest before its extension."""
+    root, ext = os.path.splitext(name)
+    return f"{root}.{content_digest}{ext}"
+
+
+def is_immutable(name):
+    """Whether a storage name is a content-addressed output."""
+    return _CONTENT_NAME.search(name) is not None
+
+
+def cache_control(name):
+    """Cache-Control header value for serving a stored file."""
+    return IMMUTABLE_CACHE_CONTROL if is_immutable(name) else MUTABLE_CACHE_CONTROL
+
+
+def local_path(name):
+    """Filesystem path of `name` when the default storage is local, else None."""
+    # Some remote storages implement path() too, so test for the filesystem backend
+    if isinstance(default_storage, FileSystemStorage):
+        return default_storage.path(name)
+    return None
+
+
+def read_image(field):
+    """Decode a stored image (a FieldFile) to BGR, reading remote storage into memory."""
+    path = local_path(field.name)
+    if path is not None:
+        img = cv2.imread(path)
+    else:
+        with field.open('rb') as f:
+            img = cv2.imdecode(np.frombuffer(f.read(), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not read image: {field.name}")
+    return img
+
+
+def save(name, content):
+    """Store bytes (or a File) under `name` and return the name the storage chose."""
+    if not isinstance(content, File):
+        content = ContentFile(content)
+    with metrics.stage('upload'):
+        return default_storage.save(name, content)
+
+
+def save_output(name, content):
+    """
+    Store an output under its content name (`name` must be one) and return it.
+
+    An existing file under a content name holds the same bytes, so it is
+    reused instead of uploaded again.
+    """
+    if default_storage.exists(name):
+        return name
+    return save(name, content)
+
+
+def _uploader():
+    global _uploads
+    with _lock:
+        if _uploads is None:
+            _uploads = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'FIXPIX_UPLOAD_WORKERS', 2),
+                thread_name_prefix='fixpix-upload',
+            )
+        return _uploads
+
+
+def _upload(name, content, remove_path=None):
+    try:
+        return save_output(name, content)
+    finally:
+        if remove_path is not None:
+            content.close()
+            os.remove(remove_path)
+
+
+def _encode_and_upload(source_name, suffix, image, policy):
+    data, info = encoding.encode(image, policy)
+    del image
+    # The encoder may change the format (e.g. JPEG requested for an image with alpha)
+    name = content_name(output_name(source_name, suffix, '.' + info['format']), digest(data))
+    return _upload(name, data), info
+
+
+def save_image_async(source_name, suffix, image, policy):
+    """
+    Queue an image for encoding and upload on a background thread.
+
+    The Future resolves to (stored name, encoding info). The image must not
+    be modified after it is handed over.
+    """
+    return _uploader().submit(_encode_and_upload, source_name, suffix, image, policy)
+
+
+def save_file_async(name, path, info=None):
+    """
+    Queue a local file for a streamed upload under its content name
+    (derived from `name`) and delete it afterwards.
+
+    The Future resolves to (stored name, info).
+    """
+    def upload():
+        stored_name = content_name(name, file_digest(path))
+        return _upload(stored_name, File(open(path, 'rb'), name=os.path.basename(path)), path), info
+    return _uploader().submit(upload)
+
+
+def local_target(name):
+    """
+    Path to write an output to directly when the default storage is local,
+    else None: a unique file next to where `name` goes, which
+    commit_local() moves to the output's content name.
+    """
+    if local_path(name) is None:
+        return None
+    path = default_storage.path(default_storage.get_available_name(name))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def commit_local(name, path):
+    """Move an output written at a local_target() path to its content name; returns the name."""
+    with metrics.stage('upload'):
+        stored_name = content_name(name, file_digest(path))
+        target = default_storage.path(stored_name)
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.replace(path, target)
+    return stored_name
+
+
+def delete(name):
+    """Remove a stored file, ignoring ones that are already gone."""
+    if name and default_storage.exists(name):
+        default_storage.delete(name)
+
+
+def completed(result):
+    """A Future that already holds its result (for outputs written in place)."""
+    future = Future()
+    future.set_result(result)
+    return future
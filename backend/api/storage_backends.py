@@ -0,0 +1,21 @@
+"""
+Storage Backends for FixPix
+
+S3 storage that uploads content-addressed outputs (see api.storage) with
+an immutable, far-future Cache-Control, so browsers and the CDN never
+revalidate them. Other objects keep AWS_S3_OBJECT_PARAMETERS.
+"""
+
+from storages.backends.s3 import S3Storage
+
+from . import storage
+
+
+class OutputsS3Storage(S3Storage):
+    """S3Storage with immutable caching of content-addressed outputs."""
+
+    def get_object_parameters(self, name):
+        params = super().get_object_parameters(name)
+        if storage.is_immutable(name):
+            params['CacheControl'] = storage.IMMUTABLE_CACHE_CONTROL
+        return params
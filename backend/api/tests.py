@@ -1,3 +1,1001 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import (animation, authentication, blur, colorizer, decode_cache, encoding, executor, export, image_stats,
+               media_gc, memory, metrics, out_of_core, previews, single_flight, smoothing, tasks)
+from .ai_engine import AIEngine
+from .ai_presets import PRESETS
+from .models import ImageProject
+from . import pipeline
+from .management.commands.benchmark_engine import synthetic_image
+from .pipeline import run_pipeline
+from .working_image import WorkingImage
+
+
+class MetricsTests(SimpleTestCase):
+    """Memory tracing is opt-in and bounded by jobs; the metrics endpoint is not public."""
+
+    def test_tracing_is_off_by_default(self):
+        with metrics.record_job() as records, metrics.stage('noop'):
+            self.assertFalse(tracemalloc.is_tracing())
+        self.assertIsNone(records[0]['peak_bytes'])
+
+    @override_settings(FIXPIX_TRACE_MEMORY=True)
+    def test_tracing_stops_with_the_last_job(self):
+        with metrics.record_job():
+            with metrics.record_job() as records, metrics.stage('alloc'):
+                buffer = bytearray(1 << 20)
+            self.assertTrue(tracemalloc.is_tracing())
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreaterEqual(records[0]['peak_bytes'], len(buffer))
+
+    def test_metrics_endpoint_allow_list(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 200)
+        self.assertEqual(self.client.get('/api/metrics/', REMOTE_ADDR='203.0.113.7').status_code, 403)
+        with override_settings(FIXPIX_METRICS_TOKEN='secret'):
+            response = self.client.get('/api/metrics/', REMOTE_ADDR='203.0.113.7',
+                                       HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+
+def _frame(seed=0, shape=(96, 128, 3)):
+    return np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+
+
+class MemoryBudgetTests(SimpleTestCase):
+    """Budgets charge each job for its own buffers only."""
+
+    def test_starting_frame_is_not_charged(self):
+        frame = _frame()
+        with memory.memory_budget(frame) as budget:
+            budget.check('noop', frame)
+        self.assertEqual(budget.peak_bytes, 0)
+
+    def test_memory_mapped_frame_is_not_charged(self):
+        with tempfile.NamedTemporaryFile() as f:
+            frame = np.memmap(f, dtype=np.uint8, mode='w+', shape=(96, 128, 3))
+            with memory.memory_budget(frame) as budget:
+                copy = memory.track(frame.copy())
+                budget.check('copy', frame)
+            self.assertEqual(budget.peak_bytes, copy.nbytes)
+
+    def test_freed_buffers_are_released(self):
+        frame = _frame()
+        with memory.memory_budget(frame, factor=2.5) as budget:
+            for _ in range(5):
+                memory.track(np.empty_like(frame))
+                budget.check('transient', frame)
+            self.assertEqual(budget.held_bytes, 0)
+        self.assertEqual(budget.peak_bytes, frame.nbytes)
+
+    def test_over_budget_raises(self):
+        frame = _frame()
+        with memory.memory_budget(frame, factor=2) as budget:
+            held = [memory.track(np.empty_like(frame)) for _ in range(3)]
+            with self.assertRaises(memory.MemoryBudgetExceeded):
+                budget.check('hoard', frame)
+        self.assertEqual(len(held), 3)
+
+    def test_concurrent_budgets_are_independent(self):
+        barrier = threading.Barrier(4)
+
+        def job(index):
+            frame = _frame(index)
+            with memory.memory_budget(frame, factor=2) as budget:
+                # Every job holds one frame-sized buffer while all the others hold theirs
+                buffer = memory.track(np.empty_like(frame))
+                barrier.wait()
+                budget.check('hold', frame)
+                barrier.wait()
+                del buffer
+                budget.check('after', frame)
+            return budget.peak_bytes, frame.nbytes
+
+        with ThreadPoolExecutor(4) as pool:
+            for peak, frame_bytes in pool.map(job, range(4)):
+                self.assertEqual(peak, frame_bytes)
+
+    def test_concurrent_low_memory_pipelines(self):
+        settings = {'lowMemory': True, 'removeScratches': True, 'autoEnhance': True,
+                    'brightness': 1.1, 'upscaleX': 2, 'filterPreset': 'vivid'}
+        expected = [run_pipeline(_frame(index), settings) for index in range(8)]
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda index: run_pipeline(_frame(index), settings), range(8)))
+        for result, reference in zip(results, expected):
+            np.testing.assert_array_equal(result, reference)
+
+
+class OutOfCoreTests(SimpleTestCase):
+    """Banded out-of-core renders match the in-memory pipeline bit for bit."""
+
+    SETTINGS = [
+        {'upscaleX': 2},
+        {'upscaleX': 4, 'brightness': 1.1},
+        {'upscaleX': 2, 'autoEnhance': True, 'whiteBalance': True},
+        {'upscaleX': 2, 'denoiseStrength': 60},
+        {'upscaleX': 2, 'filterPreset': 'vivid'},
+        {'upscaleX': 2, 'filterPreset': 'bw_noir'},
+    ]
+
+    def test_matches_in_memory_output(self):
+        image = synthetic_image(0.05)
+        output_path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'out.png')
+        # Small bands, so every stage runs on many of them
+        with mock.patch.object(out_of_core, 'BAND_BYTES', 64 * 1024):
+            for process_settings in self.SETTINGS:
+                with self.subTest(**process_settings):
+                    expected = run_pipeline(image.copy(), dict(process_settings))
+                    out_of_core.render(image.copy(), dict(process_settings), output_path)
+                    rendered = cv2.imread(output_path, cv2.IMREAD_UNCHANGED)
+                    self.assertEqual(rendered.shape, expected.shape)
+                    self.assertTrue(np.array_equal(rendered, expected))
+
+
+class BlurTests(SimpleTestCase):
+    """The box and pyramid approximations stay within 5 levels of cv2.GaussianBlur."""
+
+    MAX_ERROR = 5
+
+    def test_error_bound(self):
+        image = synthetic_image(0.3)
+        for method, sigmas in (('box', (6, 12)), ('pyramid', (20, 50))):
+            for sigma in sigmas:
+                with self.subTest(method=method, sigma=sigma):
+                    expected = cv2.GaussianBlur(image, (0, 0), sigma)
+                    blurred = blur.gaussian_blur(image, sigma, method=method)
+                    self.assertEqual(blurred.shape, image.shape)
+                    error = np.abs(blurred.astype(np.int16) - expected)
+                    self.assertLessEqual(int(error.max()), self.MAX_ERROR)
+                    self.assertLess(float(error.mean()), 1)
+
+    def test_small_blurs_are_exact(self):
+        image = synthetic_image(0.05)
+        self.assertEqual(blur.choose_method(image.shape, 2), 'direct')
+        self.assertTrue(np.array_equal(blur.gaussian_blur(image, ksize=5), cv2.GaussianBlur(image, (5, 5), 0)))
+
+
+class WorkingImageTests(SimpleTestCase):
+    """Lazy colour-space views, copy before the first edit and spare-buffer reuse."""
+
+    CONVERSIONS = {'lab': cv2.COLOR_BGR2LAB, 'hsv': cv2.COLOR_BGR2HSV, 'gray': cv2.COLOR_BGR2GRAY}
+    TO_BGR = {'lab': cv2.COLOR_LAB2BGR, 'hsv': cv2.COLOR_HSV2BGR}
+
+    def _expected(self, bgr, space):
+        return bgr if space == 'bgr' else cv2.cvtColor(bgr, self.CONVERSIONS[space])
+
+    def test_views_match_cvtcolor(self):
+        bgr = _frame()
+        for start in ('bgr', 'lab', 'hsv'):
+            image = self._expected(bgr, start)
+            # Other spaces are converted from the frame's BGR
+            reference = bgr if start == 'bgr' else cv2.cvtColor(image, self.TO_BGR[start])
+            frame = WorkingImage(image, space=start)
+            for space in ('lab', 'hsv', 'gray', 'bgr'):
+                with self.subTest(start=start, space=space):
+                    expected = image if space == start else self._expected(reference, space)
+                    self.assertTrue(np.array_equal(frame.view(space), expected))
+            self.assertEqual(frame.space, start)
+
+    def test_writable_converts_and_keeps_edits(self):
+        bgr = _frame()
+        frame = WorkingImage(bgr.copy(), owned=True)
+        lab = frame.writable('lab')
+        self.assertTrue(np.array_equal(lab, self._expected(bgr, 'lab')))
+        lab[..., 0] //= 2
+        edited = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+        # lab -> hsv goes through BGR
+        self.assertTrue(np.array_equal(frame.writable('hsv'), self._expected(edited, 'hsv')))
+        self.assertEqual(frame.space, 'hsv')
+        self.assertTrue(np.array_equal(frame.writable('gray'), self._expected(frame.view('bgr'), 'gray')))
+        self.assertEqual(frame.shape, bgr.shape)
+
+    def test_input_is_not_modified(self):
+        bgr = _frame()
+        original = bgr.copy()
+        frame = WorkingImage(bgr)
+        frame.writable('bgr')[:] = 0
+        frame.writable('lab')[:] = 0
+        self.assertTrue(np.array_equal(bgr, original))
+        # An owned frame is edited in place
+        owned = WorkingImage(bgr, owned=True)
+        self.assertIs(owned.writable('bgr'), bgr)
+
+    def test_borrowed_buffer_is_never_a_live_view(self):
+        frame = WorkingImage(_frame(), owned=True)
+        frame.view('hsv')
+        lab = frame.writable('lab')
+        # The dropped BGR/HSV buffers are recycled, never the current frame
+        borrowed = frame.borrow(lab.shape)
+        self.assertFalse(any(np.shares_memory(borrowed, view) for view in frame._views.values()))
+        expected = frame.view('bgr').copy()
+        borrowed[:] = 7
+        self.assertTrue(np.array_equal(frame.view('bgr'), expected))
+        self.assertFalse(np.shares_memory(frame.borrow(lab.shape), borrowed))
+        # A conversion after a borrow takes a fresh buffer, not the borrowed one
+        self.assertFalse(np.shares_memory(frame.view('hsv'), borrowed))
+
+
+class JobEventsTests(SimpleTestCase):
+    """Job events stream as they are recorded, under WSGI and ASGI."""
+
+    def setUp(self):
+        self.job = executor.store().create(
+            executor.Job(os.urandom(8).hex(), 'project', 1, ['decode', 'save'], os.urandom(8).hex()))
+        self.url = f'/api/jobs/{self.job.id}/events/'
+
+    def _finish_later(self):
+        def finish():
+            time.sleep(0.5)
+            executor.store().add(self.job.id, 'done', {'url': '/media/out.png'})
+        threading.Thread(target=finish).start()
+
+    def test_duplicate_submits_share_a_job(self):
+        duplicate = executor.Job('other', 'project', 1, ['decode', 'save'], self.job.key)
+        self.assertIs(executor.store().create(duplicate), self.job)
+        executor.store().add(self.job.id, 'error', {'error': 'failed'})
+        self.assertIs(executor.store().create(duplicate), duplicate)
+
+    def test_unknown_job(self):
+        self.assertEqual(self.client.get('/api/jobs/missing/events/').status_code, 404)
+
+    def test_wsgi_stream_is_incremental(self):
+        executor.store().add(self.job.id, 'progress', {'stage': 'decode', 'completed': 1, 'total': 2})
+        self._finish_later()
+        start = time.monotonic()
+        chunks = []
+        for chunk in self.client.get(self.url).streaming_content:
+            chunks.append((time.monotonic() - start, chunk.decode()))
+        self.assertLess(chunks[0][0], 0.4)
+        self.assertTrue(chunks[0][1].startswith('event: progress'))
+        self.assertIn('"url": "http://testserver/media/out.png"', chunks[-1][1])
+
+    async def test_asgi_stream_is_incremental(self):
+        executor.store().add(self.job.id, 'progress', {'stage': 'decode', 'completed': 1, 'total': 2})
+        self._finish_later()
+        start = time.monotonic()
+        response = await self.async_client.get(self.url)
+        chunks = [(time.monotonic() - start, chunk.decode()) async for chunk in response.streaming_content]
+        self.assertLess(chunks[0][0], 0.4)
+        self.assertEqual([chunk.split('\n')[0] for _, chunk in chunks], ['event: progress', 'event: done'])
+
+
+class MediaGCTests(TestCase):
+    """Media GC works through the storage API (an in-memory store here, like S3)."""
+
+    def setUp(self):
+        # A fresh store per test
+        self.enterContext(override_settings(STORAGES={
+            'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+            'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+        }))
+
+    def _output(self, name, size=100, recorded=True, age_days=0, user=None):
+        name = default_storage.save(f'processed/{name}', ContentFile(b'x' * size))
+        project = ImageProject.objects.create(
+            original_image='originals/o.png', processed_image=name, user=user,
+            metrics={'output': {'bytes': size}} if recorded else {})
+        ImageProject.objects.filter(pk=project.pk).update(
+            updated_at=timezone.now() - timedelta(days=age_days))
+        return project
+
+    def _stats(self):
+        return {'evicted': 0, 'orphans': 0, 'temp': 0, 'bytes_freed': 0}
+
+    def _evicted(self, project):
+        return not ImageProject.objects.get(pk=project.pk).processed_image
+
+    def test_orphans(self):
+        kept = self._output('kept.png')
+        default_storage.save('processed/orphan.png', ContentFile(b'x' * 50))
+        stats = self._stats()
+        media_gc.sweep_orphans(stats, grace_seconds=3600)
+        self.assertEqual(stats['orphans'], 0)
+        media_gc.sweep_orphans(stats, grace_seconds=-1)
+        self.assertEqual((stats['orphans'], stats['bytes_freed']), (1, 50))
+        self.assertFalse(default_storage.exists('processed/orphan.png'))
+        self.assertTrue(default_storage.exists(kept.processed_image.name))
+
+    def test_quota_evicts_least_recently_rendered(self):
+        user = User.objects.create_user('quota')
+        old = self._output('old.png', age_days=3, user=user)
+        # Sized through the storage when the project has no encoding info
+        middle = self._output('middle.png', recorded=False, age_days=2, user=user)
+        new = self._output('new.png', age_days=1, user=user)
+        stats = self._stats()
+        media_gc.enforce_user_quotas(250, stats)
+        self.assertEqual((stats['evicted'], stats['bytes_freed']), (1, 100))
+        self.assertTrue(self._evicted(old))
+        self.assertFalse(self._evicted(middle) or self._evicted(new))
+        self.assertFalse(default_storage.exists('processed/old.png'))
+        media_gc.enforce_quota(150, stats)
+        self.assertTrue(self._evicted(middle))
+        self.assertFalse(self._evicted(new))
+
+    def test_age(self):
+        expired = self._output('expired.png', age_days=10)
+        recent = self._output('recent.png', age_days=1)
+        stats = media_gc.collect(days=7, user_quota_bytes=0, quota_bytes=0, grace_seconds=3600)
+        self.assertEqual(stats['evicted'], 1)
+        self.assertTrue(self._evicted(expired))
+        self.assertFalse(self._evicted(recent))
+        self.assertEqual(ImageProject.objects.get(pk=expired.pk).settings, expired.settings)
+
+    def test_shared_output_is_kept(self):
+        expired = self._output('shared.png', age_days=10)
+        ImageProject.objects.create(original_image='originals/o.png', processed_image=expired.processed_image.name)
+        stats = self._stats()
+        media_gc.expire_outputs(7, stats)
+        self.assertEqual((stats['evicted'], stats['bytes_freed']), (1, 0))
+        self.assertTrue(default_storage.exists(expired.processed_image.name))
+
+
+class RenderOutcomeTests(TransactionTestCase):
+    """A render always ends 'completed' or 'failed', also when its outcome is stored from another thread."""
+
+    def _render(self, upload):
+        project = ImageProject.objects.create(original_image='originals/t.png')
+        with mock.patch.object(pipeline, 'process_project', return_value=upload):
+            result = pipeline.render_project(project, {})
+        return project, result
+
+    def test_failed_upload(self):
+        upload = Future()
+        project, result = self._render(upload)
+        upload.set_exception(OSError('storage down'))
+        self.assertIsInstance(result.exception(), OSError)
+        self.assertEqual(ImageProject.objects.get(pk=project.pk).status, 'failed')
+
+    def test_failed_save_still_marks_failed(self):
+        upload = Future()
+        project, result = self._render(upload)
+        with mock.patch.object(ImageProject, 'save', side_effect=RuntimeError('save failed')):
+            thread = threading.Thread(target=upload.set_result, args=(('processed/t.png', {}),))
+            thread.start()
+            thread.join()
+        self.assertIsInstance(result.exception(), RuntimeError)
+        self.assertEqual(ImageProject.objects.get(pk=project.pk).status, 'failed')
+
+    def test_completed(self):
+        upload = Future()
+        project, result = self._render(upload)
+        upload.set_result(('processed/t.png', {'format': 'png'}))
+        stored = ImageProject.objects.get(pk=project.pk)
+        self.assertEqual((stored.status, stored.processed_image.name), ('completed', 'processed/t.png'))
+        self.assertIs(result.result(), project)
+
+
+class EncodingPolicyTests(SimpleTestCase):
+    """Deployment defaults, request overrides and the encoders they select."""
+
+    def test_defaults_and_overrides(self):
+        self.assertEqual(encoding.resolve(source_name='photo.JPEG')['ext'], '.jpg')
+        with override_settings(FIXPIX_OUTPUT_FORMAT='webp', FIXPIX_WEBP_QUALITY=80):
+            policy = encoding.resolve(source_name='photo.png')
+            self.assertEqual((policy['ext'], policy['webp_quality']), ('.webp', 80))
+            policy = encoding.resolve({'format': 'jpg', 'quality': 500, 'progressive': 'true'})
+        self.assertEqual(policy['ext'], '.jpg')
+        self.assertEqual(policy['jpeg_quality'], 100)
+        self.assertTrue(policy['jpeg_progressive'])
+        with self.assertRaises(ValueError):
+            encoding.resolve({'format': 'bmp'})
+
+    def test_encoders(self):
+        image = _frame()
+        for fmt, expected in (('png', 'PNG'), ('jpg', 'JPEG'), ('webp', 'WEBP')):
+            with self.subTest(fmt=fmt):
+                data, info = encoding.encode(image, encoding.resolve({'format': fmt, 'quality': 70}))
+                self.assertEqual(Image.open(io.BytesIO(data)).format, expected)
+                self.assertEqual((info['format'], info['bytes']), (fmt, len(data)))
+        lossless, _ = encoding.encode(image, encoding.resolve({'format': 'png'}))
+        decoded = cv2.imdecode(np.frombuffer(lossless, np.uint8), cv2.IMREAD_UNCHANGED)
+        self.assertTrue(np.array_equal(decoded, image))
+
+    def test_jpeg_with_alpha_falls_back_to_png(self):
+        image = _frame(shape=(32, 32, 4))
+        data, info = encoding.encode(image, encoding.resolve({'format': 'jpg'}))
+        self.assertEqual(info['format'], 'png')
+        self.assertEqual(Image.open(io.BytesIO(data)).mode, 'RGBA')
+
+
+class MediaTestCase(TestCase):
+    """A TestCase with its own MEDIA_ROOT."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
+def _encoded(fmt='PNG', frames=1, seed=0):
+    images = [Image.fromarray(_frame(seed + index)[:, :, ::-1]) for index in range(frames)]
+    buffer = io.BytesIO()
+    if frames > 1:
+        images[0].save(buffer, format=fmt, save_all=True, append_images=images[1:], duration=80)
+    else:
+        images[0].save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+class DecodeCacheTests(MediaTestCase):
+    """Decoded originals are cached as copy-on-write maps, keyed by the stored file."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        self.enterContext(override_settings(FIXPIX_DECODE_CACHE_DIR=self.cache_dir))
+        self.reads = self.enterContext(mock.patch.object(decode_cache.storage, 'read_image',
+                                                         side_effect=decode_cache.storage.read_image))
+
+    def _original(self, name, seed=0):
+        project = ImageProject()
+        project.original_image.save(name, SimpleUploadedFile(name, _encoded(seed=seed)), save=False)
+        return project.original_image
+
+    def _entry(self, field):
+        return os.path.join(self.cache_dir, decode_cache.fingerprint(field) + '.npy')
+
+    def test_miss_then_hit(self):
+        field = self._original('a.png')
+        decoded = decode_cache.load(field)
+        cached = decode_cache.load(field)
+        self.assertEqual(self.reads.call_count, 1)
+        self.assertIsInstance(cached, np.memmap)
+        self.assertTrue(np.array_equal(cached, decoded))
+
+    def test_replaced_original_misses(self):
+        field = self._original('a.png')
+        decode_cache.load(field)
+        with open(field.path, 'wb') as f:
+            f.write(_encoded('JPEG', seed=5))
+        replaced = decode_cache.load(field)
+        self.assertEqual(self.reads.call_count, 2)
+        self.assertTrue(np.array_equal(replaced, cv2.imread(field.path)))
+
+    def test_least_recently_used_is_evicted(self):
+        first, second, third = (self._original(f'{name}.png', seed) for seed, name in enumerate('abc'))
+        entry_bytes = _frame().nbytes + 128
+        with override_settings(FIXPIX_DECODE_CACHE_MB=2.5 * entry_bytes / (1024 * 1024)):
+            decode_cache.load(first)
+            decode_cache.load(second)
+            now = time.time()
+            os.utime(self._entry(first), (now - 20, now - 20))
+            os.utime(self._entry(second), (now - 10, now - 10))
+            # A hit makes the first entry the most recently used
+            decode_cache.load(first)
+            decode_cache.load(third)
+        self.assertTrue(os.path.exists(self._entry(first)))
+        self.assertFalse(os.path.exists(self._entry(second)))
+        self.assertTrue(os.path.exists(self._entry(third)))
+
+    def test_in_place_edits_leave_the_entry_unmodified(self):
+        field = self._original('a.png')
+        expected = decode_cache.load(field).copy()
+        cached = decode_cache.load(field)
+        cached[:] = 0
+        self.assertTrue(np.array_equal(np.load(self._entry(field)), expected))
+        self.assertTrue(np.array_equal(decode_cache.load(field), expected))
+
+    def test_concurrent_eviction(self):
+        decode_cache.load(self._original('a.png'))
+        open(os.path.join(self.cache_dir, 'partial.tmp'), 'wb').close()
+        entries = list(os.scandir(self.cache_dir))
+        # Another process removed every entry after this one listed them
+        for entry in entries:
+            os.remove(entry.path)
+        with mock.patch.object(decode_cache, '_entries', return_value=entries):
+            decode_cache.evict(self.cache_dir, 0)
+        with mock.patch.object(decode_cache, 'evict', side_effect=PermissionError('read-only')):
+            self.assertEqual(decode_cache.load(self._original('b.png', 1)).shape, _frame().shape)
+
+
+class PresetPreviewTests(MediaTestCase):
+    """GET /api/images/<id>/presets/ renders every preset once per original, size and layout."""
+
+    client_class = APIClient
+
+    def setUp(self):
+        cache.clear()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        self.enterContext(override_settings(FIXPIX_DECODE_CACHE_DIR=cache_dir))
+        user = User.objects.create_user('owner')
+        self.client.force_authenticate(user)
+        self.project = ImageProject(user=user)
+        self.project.original_image.save('a.png', SimpleUploadedFile('a.png', _encoded()))
+        self.url = f'/api/images/{self.project.pk}/presets/'
+
+    def test_clamp_size(self):
+        self.assertEqual([previews.clamp_size(value) for value in (10, '300', 9999, 'large', None)],
+                         [previews.MIN_SIZE, 300, previews.MAX_SIZE, previews.DEFAULT_SIZE, previews.DEFAULT_SIZE])
+
+    def test_sheet_and_etag(self):
+        rendered = mock.Mock(side_effect=previews.render)
+        with mock.patch.object(previews, 'render', rendered):
+            response = self.client.get(self.url, {'size': 64})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/jpeg')
+            self.assertEqual(Image.open(io.BytesIO(response.content)).format, 'JPEG')
+            etag = response['ETag']
+
+            response = self.client.get(self.url, {'size': 64}, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(rendered.call_count, 1)
+            # Another size is another rendering
+            self.assertNotEqual(self.client.get(self.url, {'size': 96}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_json_layout(self):
+        response = self.client.get(self.url, {'size': 64, 'layout': 'json'})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(set(body), set(PRESETS))
+        self.assertTrue(all(url.startswith('data:image/jpeg;base64,') for url in body.values()))
+
+    def test_unknown_layout(self):
+        self.assertEqual(self.client.get(self.url, {'layout': 'grid'}).status_code, 400)
+
+
+class ImageStatsTests(MediaTestCase):
+    """Statistics are computed once per original and stored on the project."""
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        self.enterContext(override_settings(FIXPIX_DECODE_CACHE_DIR=cache_dir))
+        self.computed = self.enterContext(mock.patch.object(image_stats, 'compute', side_effect=image_stats.compute))
+
+    def test_stored_and_reused(self):
+        project = ImageProject()
+        project.original_image.save('a.png', SimpleUploadedFile('a.png', _encoded()))
+        stats = image_stats.for_project(project)
+        stored = ImageProject.objects.get(pk=project.pk)
+        self.assertEqual(stored.stats, stats)
+        self.assertEqual(stats['fingerprint'], decode_cache.fingerprint(stored.original_image))
+        self.assertEqual(image_stats.for_project(stored), stats)
+        self.assertEqual(self.computed.call_count, 1)
+
+    def test_recomputed_for_a_replaced_original(self):
+        project = ImageProject()
+        project.original_image.save('a.png', SimpleUploadedFile('a.png', _encoded()))
+        before = image_stats.for_project(project)
+        with open(project.original_image.path, 'wb') as f:
+            f.write(_encoded('JPEG', seed=5))
+        after = image_stats.for_project(ImageProject.objects.get(pk=project.pk))
+        self.assertEqual(self.computed.call_count, 2)
+        self.assertNotEqual(after['fingerprint'], before['fingerprint'])
+        self.assertEqual(ImageProject.objects.get(pk=project.pk).stats, after)
+
+
+@override_settings(FIXPIX_SINGLE_FLIGHT_URL='')
+class SingleFlightTests(SimpleTestCase):
+    """Concurrent identical renders run once; every caller gets its outcome."""
+
+    CALLERS = 8
+
+    def _attach(self):
+        """Start CALLERS concurrent runs of one key; returns (their Futures, the render, start calls)."""
+        render = Future()
+        starts = []
+
+        def start():
+            starts.append(1)
+            return render
+
+        render_key = single_flight.key('project', {'brightness': 1.1})
+        barrier = threading.Barrier(self.CALLERS)
+
+        def call():
+            barrier.wait()
+            return single_flight.run(render_key, start, mock.Mock(side_effect=AssertionError))
+
+        with ThreadPoolExecutor(self.CALLERS) as pool:
+            futures = [future.result() for future in [pool.submit(call) for _ in range(self.CALLERS)]]
+        return futures, render, starts
+
+    def test_result_reaches_every_caller(self):
+        futures, render, starts = self._attach()
+        self.assertEqual(len(starts), 1)
+        render.set_result('rendered')
+        self.assertEqual([future.result(timeout=1) for future in futures], ['rendered'] * self.CALLERS)
+
+    def test_error_reaches_every_caller(self):
+        futures, render, starts = self._attach()
+        self.assertEqual(len(starts), 1)
+        render.set_exception(RuntimeError('render failed'))
+        for future in futures:
+            with self.assertRaisesMessage(RuntimeError, 'render failed'):
+                future.result(timeout=1)
+
+    def test_finished_render_is_not_reused(self):
+        first, render, _ = self._attach()
+        render.set_result('first')
+        second, render, starts = self._attach()
+        self.assertEqual(len(starts), 1)
+        self.assertIsNot(first[0], second[0])
+        render.set_result('second')
+
+
+class ColorizerTests(SimpleTestCase):
+    """Learned colorization batches concurrent calls; without a model the sepia tone is used."""
+
+    class FakeModel:
+        """Predicts a/b equal to the input's centred L; the first pass waits for `release`."""
+
+        def __init__(self):
+            self.batches = []
+            self.started = threading.Event()
+            self.release = threading.Event()
+
+        def predict(self, tensor):
+            if not self.batches:
+                self.started.set()
+                self.release.wait(5)
+            self.batches.append(len(tensor))
+            return np.repeat(tensor, 2, axis=1)
+
+    @override_settings(FIXPIX_COLORIZE_MODEL='')
+    def test_sepia_without_model(self):
+        self.assertIsNone(colorizer.get_model())
+        gray = np.tile(np.linspace(30, 220, 128, dtype=np.uint8), (96, 1))
+        toned = AIEngine.colorize_image(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), return_path=False)
+        self.assertEqual(toned.shape, (96, 128, 3))
+        blue, _, red = cv2.split(toned.astype(np.float32))
+        self.assertGreater(red.mean(), blue.mean() + 10)
+
+    @override_settings(FIXPIX_COLORIZE_MODEL='/nonexistent/colorizer.onnx')
+    def test_missing_model_falls_back(self):
+        self.assertIsNone(colorizer.get_model())
+
+    def test_concurrent_calls_are_batched(self):
+        model = self.FakeModel()
+        tensors = [np.full((1, 1, 4, 4), index, np.float32) for index in range(4)]
+        with ThreadPoolExecutor(len(tensors)) as pool:
+            first = pool.submit(colorizer.predict_chroma, model, tensors[0])
+            self.assertTrue(model.started.wait(5))
+            queued = [pool.submit(colorizer.predict_chroma, model, tensor) for tensor in tensors[1:]]
+            while len(colorizer._pending) < len(queued):
+                time.sleep(0.01)
+            model.release.set()
+            results = [first.result(5)] + [future.result(5) for future in queued]
+        # The calls that arrived during the first pass ran as one batch
+        self.assertEqual(model.batches, [1, 3])
+        for index, chroma in enumerate(results):
+            self.assertEqual(chroma.shape, (2, 4, 4))
+            self.assertTrue(np.all(chroma == index))
+
+    def test_model_without_batch_support(self):
+        # A model whose export has a fixed batch size of 1
+        model = object.__new__(colorizer._Model)
+        model.batches = True
+        calls = []
+
+        def forward(tensor):
+            calls.append(len(tensor))
+            if len(tensor) > 1:
+                raise RuntimeError('fixed batch size')
+            return np.repeat(tensor, 2, axis=1)
+        model._forward = forward
+        chroma = model.predict(np.arange(3, dtype=np.float32).reshape(3, 1, 1, 1))
+        self.assertEqual(chroma[:, 0].ravel().tolist(), [0, 1, 2])
+        self.assertFalse(model.batches)
+        self.assertEqual(calls, [3, 1, 1, 1])
+
+
+class SmoothingTests(SimpleTestCase):
+    """The approximate smoothing backends stay out of memory-budgeted jobs."""
+
+    def test_budget_uses_the_bilateral_filter(self):
+        with smoothing.quality('fast'):
+            self.assertEqual(smoothing.choose_method(9), 'grid')
+            with memory.memory_budget(_frame()):
+                self.assertEqual(smoothing.choose_method(9), 'bilateral')
+
+    def test_low_memory_pipeline_at_every_tier(self):
+        settings = {'lowMemory': True, 'removeScratches': True, 'denoiseStrength': 5}
+        with smoothing.quality('high'):
+            reference = run_pipeline(_frame(), settings)
+        for tier in ('balanced', 'fast'):
+            with smoothing.quality(tier):
+                np.testing.assert_array_equal(run_pipeline(_frame(), settings), reference)
+
+
+class RequestMetricsTests(TestCase):
+    """Every request is timed, labelled by its URL name and logged when slow."""
+
+    client_class = APIClient
+
+    def setUp(self):
+        self.client.force_authenticate(User.objects.create_user('owner'))
+
+    def test_server_timing(self):
+        header = self.client.get('/api/images/')['Server-Timing']
+        self.assertRegex(header, r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries"')
+        with override_settings(FIXPIX_SERVER_TIMING=False):
+            self.assertNotIn('Server-Timing', self.client.get('/api/images/'))
+
+    def test_endpoint_labels(self):
+        self.client.get('/api/images/')
+        self.client.get('/api/not-a-route/')
+        series = metrics.HTTP_REQUEST_SECONDS._series
+        self.assertIn(('imageproject-list', 'GET', '2xx'), series)
+        self.assertIn(('unmatched', 'GET', '4xx'), series)
+        # Ids in the path do not create series of their own
+        self.client.get(f'/api/images/{uuid.uuid4()}/')
+        self.assertIn(('imageproject-detail', 'GET', '4xx'), series)
+
+    def test_slow_request_log(self):
+        with override_settings(FIXPIX_SLOW_REQUEST_MS=0.001), self.assertLogs('api.middleware', 'WARNING') as logs:
+            self.client.get('/api/images/')
+        self.assertIn('Slow request: GET /api/images/ (imageproject-list) -> 200', logs.output[0])
+        self.assertRegex(logs.output[0], r'\d+ queries in')
+        with override_settings(FIXPIX_SLOW_REQUEST_MS=0), self.assertNoLogs('api.middleware', 'WARNING'):
+            self.client.get('/api/images/')
+
+
+# Cold start of a fresh process: Django set-up plus the URLconf, tasks and Celery app
+IMPORT_BUDGET_SECONDS = 3.0
+# Worker warm-up without configured models (OpenCV codecs and filters only)
+WARMUP_BUDGET_SECONDS = 2.0
+# Optional packages that must only be imported when a job needs them
+LAZY_MODULES = ('rembg', 'onnxruntime', 'redis')
+
+_COLD_START = """
+import json, os, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+import backend.urls, backend.celery, api.tasks
+imported = time.perf_counter() - start
+loaded = [name for name in %r if name in sys.modules]
+from api import warmup
+start = time.perf_counter()
+warmup.warm()
+print(json.dumps({'import': imported, 'loaded': loaded, 'warmup': time.perf_counter() - start}))
+"""
+
+
+class StartupBudgetTests(SimpleTestCase):
+    """Import time and worker warm-up of a fresh process stay within budget."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='backend.settings',
+                   FIXPIX_COLORIZE_MODEL='', FIXPIX_SINGLE_FLIGHT_URL='')
+        output = subprocess.run(
+            [sys.executable, '-c', _COLD_START % (LAZY_MODULES,)],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        cls.cold_start = json.loads(output.strip().splitlines()[-1])
+
+    def test_heavy_dependencies_are_lazy(self):
+        self.assertEqual(self.cold_start['loaded'], [])
+
+    def test_import_time_budget(self):
+        self.assertLess(self.cold_start['import'], IMPORT_BUDGET_SECONDS)
+
+    def test_warmup_budget(self):
+        self.assertLess(self.cold_start['warmup'], WARMUP_BUDGET_SECONDS)
+
+
+class StatelessAuthTests(TestCase):
+    """Token-backed users are checked against each user's cached state."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('auth', password='first-password')
+
+    def _get(self, token=None):
+        token = token or AccessToken.for_user(self.user)
+        return self.client.get('/api/images/', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_state_is_cached(self):
+        token = AccessToken.for_user(self.user)
+        self.assertEqual(self._get(token).status_code, 200)
+        # Only the project query: the user's state comes from the cache
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get(token).status_code, 200)
+
+    def test_password_change_revokes_tokens(self):
+        token = AccessToken.for_user(self.user)
+        self.assertEqual(self._get(token).status_code, 200)
+        self.user.set_password('second-password')
+        self.user.save()
+        self.assertEqual(self._get(token).status_code, 401)
+        self.assertEqual(self._get().status_code, 200)
+
+    def test_deactivation_revokes_tokens(self):
+        token = AccessToken.for_user(self.user)
+        self.assertEqual(self._get(token).status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self._get(token).status_code, 401)
+
+    def test_saving_the_user_invalidates_the_cache(self):
+        authentication.user_state(self.user.pk)
+        self.assertIsNotNone(cache.get(authentication._state_key(self.user.pk)))
+        self.user.save()
+        self.assertIsNone(cache.get(authentication._state_key(self.user.pk)))
+        authentication.user_state(self.user.pk)
+        self.user.delete()
+        self.assertIsNone(authentication.user_state(self.user.pk))
+
+    def test_tokens_without_the_revoke_claim_are_rejected(self):
+        token = AccessToken.for_user(self.user)
+        del token[jwt_settings.REVOKE_TOKEN_CLAIM]
+        self.assertEqual(self._get(token).status_code, 401)
+
+
+class ProcessImageTaskTests(TransactionTestCase):
+    """The Celery task renders through render_project, storing only the final output."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.media_root = media_root
+
+    def test_stores_only_the_output(self):
+        project = ImageProject(processing_type='restore')
+        project.original_image.save('t.png', SimpleUploadedFile('t.png', _encoded()))
+        result = tasks.process_image_async.apply(args=(str(project.pk), {})).get()
+        self.assertEqual(result['status'], 'success')
+
+        project.refresh_from_db()
+        self.assertEqual(project.status, 'completed')
+        self.assertTrue(project.settings['removeScratches'])
+        self.assertIn('remove_scratches', {stage['stage'] for stage in project.metrics['stages']})
+        outputs = os.listdir(os.path.join(self.media_root, 'processed'))
+        self.assertEqual(['processed/' + name for name in outputs], [project.processed_image.name])
+
+
+class FrameCountTests(MediaTestCase):
+    """Originals are only opened to count frames when they may be animated, and only once."""
+
+    def test_animated_gif_is_counted_once(self):
+        project = ImageProject.objects.create(
+            original_image=SimpleUploadedFile('anim.gif', _encoded('GIF', frames=3)))
+        self.assertTrue(animation.is_animated(project))
+        self.assertEqual(ImageProject.objects.get(pk=project.pk).frame_count, 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(animation.frame_count(project), 3)
+
+    def test_other_formats_are_not_opened(self):
+        # Not an image at all: opening it would fail
+        project = ImageProject.objects.create(original_image=SimpleUploadedFile('photo.jpg', b'not read'))
+        self.assertFalse(animation.is_animated(project))
+        self.assertEqual(project.frame_count, 1)
+
+
+class ExportEndpointTests(MediaTestCase):
+    """POST /api/images/export/ streams a ZIP of the owner's outputs."""
+
+    client_class = APIClient
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner')
+        self.client.force_authenticate(self.user)
+
+    def _processed(self, name, user=None, seed=0):
+        project = ImageProject(user=user or self.user)
+        project.original_image.save(f'{name}.png', SimpleUploadedFile(f'{name}.png', _encoded(seed=seed)), save=False)
+        project.processed_image.save(f'{name}_edited.png', SimpleUploadedFile('out.png', _encoded(seed=seed + 1)))
+        return project
+
+    def _export(self, ids, **options):
+        return self.client.post('/api/images/export/', dict(options, ids=ids), format='json')
+
+    def test_export_streams_the_owners_outputs(self):
+        first, second = self._processed('first'), self._processed('second', seed=2)
+        other = self._processed('other', user=User.objects.create_user('other'))
+        response = self._export([str(first.pk), str(second.pk), str(other.pk)])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.namelist(), [export.entry_name(first, 'png'), export.entry_name(second, 'png')])
+            with second.processed_image.open('rb') as stored:
+                self.assertEqual(archive.read(export.entry_name(second, 'png')), stored.read())
+
+    def test_export_reencodes(self):
+        project = self._processed('photo')
+        response = self._export([str(project.pk)], format='jpeg', quality=70)
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            data = archive.read(export.entry_name(project, 'jpg'))
+        self.assertEqual(Image.open(io.BytesIO(data)).format, 'JPEG')
+
+    def test_export_errors(self):
+        other = self._processed('other', user=User.objects.create_user('other'))
+        self.assertEqual(self._export([str(other.pk)]).status_code, 404)
+        self.assertEqual(self._export(['not-a-uuid']).status_code, 400)
+        self.assertEqual(self._export([]).status_code, 400)
+        self.assertEqual(self._export([str(other.pk)], format='bmp').status_code, 400)
+
+    @override_settings(FIXPIX_EXPORT_WORKERS=1)
+    async def test_asgi_stream(self):
+        projects = [await sync_to_async(self._processed)(f'p{index}', seed=index) for index in range(4)]
+        token = await sync_to_async(AccessToken.for_user)(self.user)
+        encoded = mock.Mock(side_effect=export.encode)
+        with mock.patch.object(export, 'encode', encoded):
+            response = await self.async_client.post(
+                '/api/images/export/', {'ids': [str(project.pk) for project in projects], 'format': 'jpg'},
+                content_type='application/json', headers={'Authorization': f'Bearer {token}'})
+            self.assertTrue(response.is_async)
+            chunks = response.streaming_content
+            # The first entry is sent before the later ones are encoded
+            first_chunk = await anext(chunks)
+            self.assertLessEqual(encoded.call_count, 2)
+            data = first_chunk + b''.join([chunk async for chunk in chunks])
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertEqual(archive.namelist(), [export.entry_name(project, 'jpg') for project in projects])
+
+
+@override_settings(FIXPIX_BULK_PREPARE=False)
+class BulkUploadEndpointTests(MediaTestCase):
+    """POST /api/images/bulk/ creates a project per valid file and reports each file."""
+
+    client_class = APIClient
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner')
+        self.client.force_authenticate(self.user)
+
+    def _bulk(self, *files):
+        return self.client.post('/api/images/bulk/', {'files': list(files), 'processing_type': 'colorize'})
+
+    def test_bulk_partial_failure(self):
+        response = self._bulk(SimpleUploadedFile('a.png', _encoded()),
+                              SimpleUploadedFile('notes.png', b'not an image'),
+                              SimpleUploadedFile('b.png', _encoded(seed=3)))
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual((body['created'], body['failed']), (2, 1))
+        self.assertEqual([(result['file'], result['status']) for result in body['results']],
+                         [('a.png', 'created'), ('notes.png', 'failed'), ('b.png', 'created')])
+        self.assertIn('original_image', body['results'][1]['errors'])
+        projects = ImageProject.objects.filter(user=self.user)
+        self.assertEqual(projects.count(), 2)
+        self.assertEqual(set(projects.values_list('processing_type', flat=True)), {'colorize'})
+
+    def test_bulk_all_invalid(self):
+        response = self._bulk(SimpleUploadedFile('notes.png', b'not an image'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['failed'], 1)
+        self.assertFalse(ImageProject.objects.exists())
+        self.assertEqual(self.client.post('/api/images/bulk/', {}).status_code, 400)
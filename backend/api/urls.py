@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ImageViewSet, RegisterView, MyTokenObtainPairView
+from .views import ImageViewSet, RegisterView, MyTokenObtainPairView, metrics_view, job_events
 from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
@@ -13,4 +13,6 @@ urlpatterns = [
     path('register/', RegisterView.as_view(), name='auth_register'),
     path('token/', MyTokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('metrics/', metrics_view, name='metrics'),
+    path('jobs/<str:job_id>/events/', job_events, name='job_events'),
 ]
@@ -2,14 +2,27 @@ from rest_framework import viewsets, status, generics
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from django.conf import settings as django_settings
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.core.files.base import ContentFile
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.static import serve
+from asgiref.sync import sync_to_async
+import asyncio
+import hmac
+import json
+import logging
 import time
-import os
-import base64
+from . import bulk_upload, encoding, executor, export, image_stats, metrics, previews, single_flight, smoothing, storage
 from .models import ImageProject
+from .pipeline import apply_legacy_settings, render_project
 from .serializers import ImageProjectSerializer, RegisterSerializer, UserSerializer, MyTokenObtainPairSerializer
 from rest_framework_simplejwt.views import TokenObtainPairView
 
+logger = logging.getLogger(__name__)
+
 class MyTokenObtainPairView(TokenObtainPairView):
     serializer_class = MyTokenObtainPairSerializer
 
@@ -23,10 +36,45 @@ class ImageViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return ImageProject.objects.filter(user=self.request.user).order_by('-created_at')
+        # request.user is a token-backed user: scope by id, no User query
+        return ImageProject.objects.filter(user_id=self.request.user.id).order_by('-created_at')
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        serializer.save(user_id=self.request.user.id)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Create one project per uploaded file (see api.bulk_upload).
+        Multipart fields:
+        - files: the images (repeated)
+        - processing_type: applied to every project (default: restore)
+        Returns a result per file, in order; invalid files do not fail the others.
+        """
+        uploads = request.FILES.getlist('files')
+        if not uploads:
+            return Response({'error': 'No files uploaded'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = bulk_upload.max_files()
+        if limit and len(uploads) > limit:
+            return Response({'error': f'At most {limit} files per upload'}, status=status.HTTP_400_BAD_REQUEST)
+
+        fields = {}
+        if request.data.get('processing_type'):
+            fields['processing_type'] = request.data['processing_type']
+
+        with metrics.phase('bulk_upload'):
+            created = bulk_upload.create(uploads, fields, request.user.id)
+
+        results = []
+        for upload, project, errors in created:
+            if project is None:
+                results.append({'file': upload.name, 'status': 'failed', 'errors': errors})
+            else:
+                data = self.get_serializer(project).data
+                results.append({'file': upload.name, 'status': 'created', 'project': data})
+        succeeded = sum(1 for result in results if result['status'] == 'created')
+        return Response({'created': succeeded, 'failed': len(results) - succeeded, 'results': results},
+                        status=status.HTTP_201_CREATED if succeeded else status.HTTP_400_BAD_REQUEST)
 
     @action(detail=True, methods=['post'])
     def process_image(self, request, pk=None):
@@ -35,137 +83,105 @@ class ImageViewSet(viewsets.ModelViewSet):
         # Determine settings from request body (Pipeline Mode)
         # Sandbox defaults if not provided
         settings = request.data.get('settings', {})
-        print(f"DEBUG: Process Image called. Settings: {settings}")
+        logger.debug("Process Image called. Settings: %s", settings)
         
         # Fallback to legacy processing_type if settings empty
-        algo_type = project.processing_type
-        if not settings and algo_type:
-             if algo_type == 'restore': settings['removeScratches'] = True
-             if algo_type == 'colorize': settings['colorize'] = True
-             if algo_type == 'upscale': settings['upscaleX'] = 2
-
-        # Simulate processing delay slightly for UX (1.5s)
-        project.status = 'processing'
-        project.save()
-        
+        settings = apply_legacy_settings(settings, project.processing_type)
+
+        if not project.original_image:
+            return Response({'error': 'No original image'}, status=status.HTTP_400_BAD_REQUEST)
         try:
-             # Use AI Engine
-            from .ai_engine import AIEngine
-            from django.conf import settings as django_settings
-            
-            if not project.original_image:
-                 return Response({'error': 'No original image'}, status=status.HTTP_400_BAD_REQUEST)
-                 
-            # Start pipeline with original image
-            current_path = project.original_image.path
-            current_img = AIEngine._read_image(current_path)
-            
-            # 1. Restoration (Scratches/Denoise)
-            if settings.get('removeScratches', False):
-                current_img = AIEngine.remove_scratches(current_img, return_path=False)
-
-            # 2. Face Restoration
-            if settings.get('faceRestoration', False):
-                current_img = AIEngine.restore_faces(current_img, return_path=False)
-            
-            # 3. Colorization
-            if settings.get('colorize', False):
-                current_img = AIEngine.colorize_image(current_img, return_path=False)
-                
-            # 4. Adjustments (Brightness, Contrast, Saturation)
-            b = float(settings.get('brightness', 1.0))
-            c = float(settings.get('contrast', 1.0))
-            s = float(settings.get('saturation', 1.0))
-            
-            if b != 1.0 or c != 1.0 or s != 1.0:
-                current_img = AIEngine.adjust_image(current_img, brightness=b, contrast=c, saturation=s, return_path=False)
-
-            # 5. Upscaling (Last step)
-            upscale_x = int(settings.get('upscaleX', 1))
-            if upscale_x > 1:
-                current_img = AIEngine.upscale_image(current_img, scale=2, return_path=False)
-                if upscale_x >= 4:
-                     current_img = AIEngine.upscale_image(current_img, scale=2, return_path=False)
-
-            # 6. Auto-Enhance (Magic Wand)
-            if settings.get('autoEnhance', False):
-                 current_img = AIEngine.auto_enhance(current_img, return_path=False)
-
-            # 6.5. White Balance Correction
-            if settings.get('whiteBalance', False):
-                 current_img = AIEngine.correct_white_balance(current_img, return_path=False)
-
-            # 6.6. Advanced Denoising (if strength specified)
-            denoise_strength = int(settings.get('denoiseStrength', 0))
-            if denoise_strength > 0:
-                 current_img = AIEngine.denoise_advanced(current_img, strength=denoise_strength, return_path=False)
-
-            # 6.7. Filter Preset
-            filter_preset = settings.get('filterPreset', '')
-            if filter_preset and filter_preset != 'none':
-                 current_img = AIEngine.apply_filter_preset(current_img, filter_preset, return_path=False)
-
-            # 7. Background Removal
-            if settings.get('removeBackground', False):
-                 try:
-                    current_img = AIEngine.remove_background(current_img, return_path=False)
-                 except Exception as e:
-                    print(f"BG Removal Failed: {e}")
-            
-            # 8. Object Removal (Inpainting)
-            mask_data = request.data.get('mask')
-            if mask_data:
-                # Expecting "data:image/png;base64,..."
-                if 'base64,' in mask_data:
-                    mask_data = mask_data.split('base64,')[1]
-                
-                # Save mask temporarily
-                mask_content = base64.b64decode(mask_data)
-                mask_filename = f"mask_{pk}_{int(time.time())}.png"
-                mask_path = os.path.join(django_settings.MEDIA_ROOT, 'temp', mask_filename)
-                os.makedirs(os.path.dirname(mask_path), exist_ok=True)
-                
-                with open(mask_path, 'wb') as f:
-                    f.write(mask_content)
-                
-                # Run Inpainting
-                current_img = AIEngine.inpaint_object(current_img, mask_path, return_path=False)
-                
-                # Clean up mask
-                if os.path.exists(mask_path):
-                    os.remove(mask_path)
-            
-            # Final Save
-            # We use the original path to generate the filename base
-            # If current_img is mixed input (e.g. from scratch), ensure we save it.
-            # Using _save_result directly
-            final_rel_path = AIEngine._save_result(current_img, project.original_image.path, 'edited', return_path=True)
-            
-            current_path = os.path.join(django_settings.MEDIA_ROOT, final_rel_path)
-
-            # Make relative path for DB
-            # current_path is absolute. Need relative to MEDIA_ROOT?
-            # AIEngine returns 'processed/file.ext' relative to MEDIA_ROOT usually.
-            # But we kept overwriting current_path with Absolute.
-            # We need to extract the relative part for the final save.
-            
-            final_rel_path = os.path.relpath(current_path, django_settings.MEDIA_ROOT)
-            
-            
-            project.processed_image.name = final_rel_path
-            # Save the settings used for this generation
-            project.settings = settings
-            project.status = 'completed'
-            project.save()
-            
-            serializer = self.get_serializer(project)
-            return Response(serializer.data)
-            
+            encoding.resolve(settings.get('output'))
+            smoothing.resolve_tier(settings.get('quality'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        mask_data = request.data.get('mask')
+
+        def follow():
+            # A duplicate request finished the render in another process
+            project.refresh_from_db()
+            if project.status == 'failed':
+                raise RuntimeError('Render failed')
+            return project
+
+        try:
+            # Run the stage pipeline; the outcome and stage metrics are saved on the project.
+            # Duplicate requests (double clicks, retries) attach to the render in flight
+            project = single_flight.run(
+                single_flight.key(project.pk, settings, mask_data),
+                lambda: render_project(project, settings, mask_data=mask_data),
+                follow,
+            ).result()
         except Exception as e:
-            project.status = 'failed'
-            project.save()
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        serializer = self.get_serializer(project)
+        return Response(serializer.data)
+
+    @action(detail=True, methods=['post'])
+    def process_local(self, request, pk=None):
+        """
+        Queue the pipeline on the local process pool (see api.executor).
+
+        Returns 202 with the job id and the URL of its Server-Sent Events
+        stream, which reports each finished stage and then the result URL.
+        """
+        project = self.get_object()
+        if not project.original_image:
+            return Response({'error': 'No original image'}, status=status.HTTP_400_BAD_REQUEST)
+
+        settings = apply_legacy_settings(request.data.get('settings', {}), project.processing_type)
+        try:
+            encoding.resolve(settings.get('output'))
+            smoothing.resolve_tier(settings.get('quality'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        job = executor.submit(project, settings, mask_data=request.data.get('mask'))
+        events_url = request.build_absolute_uri(reverse('job_events', args=[job.id]))
+        return Response({'job': job.id, 'stages': job.stages, 'events': events_url}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'])
+    def stats(self, request, pk=None):
+        """Statistics of the original: channel means, histograms, noise estimate and faces."""
+        project = self.get_object()
+        if not project.original_image:
+            return Response({'error': 'No original image'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(image_stats.for_project(project))
+
+    @action(detail=True, methods=['get'])
+    def presets(self, request, pk=None):
+        """
+        Preview the original under every preset, rendered in one batched pass.
+
+        Query Params:
+        - size: longest side of each preview, 64-512 (default: 256)
+        - layout: 'sheet' (one JPEG contact sheet, default) or 'json'
+          (a base64 JPEG data URL per preset)
+        """
+        project = self.get_object()
+        if not project.original_image:
+            return Response({'error': 'No original image'}, status=status.HTTP_400_BAD_REQUEST)
+        layout = request.query_params.get('layout', 'sheet')
+        if layout not in previews.LAYOUTS:
+            return Response({'error': f"Unknown layout: {layout}"}, status=status.HTTP_400_BAD_REQUEST)
+        size = previews.clamp_size(request.query_params.get('size', previews.DEFAULT_SIZE))
+
+        etag = f'"{previews.cache_key(project, size, layout)}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            try:
+                _, body, content_type = previews.render(project, size, layout)
+            except Exception as e:
+                logger.error("Preview Error: %s", e)
+                return Response({'error': 'Error rendering previews'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            response = HttpResponse(body, content_type=content_type)
+        response['ETag'] = etag
+        response['Cache-Control'] = f'private, max-age={previews.CACHE_SECONDS}'
+        return response
+
     @action(detail=True, methods=['get'], permission_classes=[AllowAny])
     def download(self, request, pk=None):
         """
@@ -175,9 +191,8 @@ class ImageViewSet(viewsets.ModelViewSet):
         - format: 'png', 'jpg', 'jpeg', 'webp' (default: original ext or png)
         - quality: 1-100 (default: 90)
         """
-        from django.http import FileResponse, HttpResponse
+        from django.http import FileResponse
         import mimetypes
-        from PIL import Image
         import io
         
         try:
@@ -189,64 +204,147 @@ class ImageViewSet(viewsets.ModelViewSet):
         if not project.processed_image:
              return Response({'error': 'No processed image available'}, status=status.HTTP_404_NOT_FOUND)
              
-        file_path = project.processed_image.path
-        if not os.path.exists(file_path):
+        # Read through the storage backend (local, S3 or Cloudinary)
+        file_path = project.processed_image.name
+        if not project.processed_image.storage.exists(file_path):
             return Response({'error': 'File not found on server'}, status=status.HTTP_404_NOT_FOUND)
 
         # Parse Query Params
-        target_format = request.query_params.get('format', '').lower()
-        quality_param = request.query_params.get('quality', '90')
-        
-        try:
-            quality = int(quality_param)
-            quality = max(1, min(100, quality))
-        except ValueError:
-            quality = 90
-
-        # If no specific format requested, serve raw file (fastest) unless resizing/re-encoding needed?
-        # Actually, let's always use PIL if format/quality is specified to ensure it applies.
-        # But if format is empty and quality is default, serve raw.
-        original_ext = os.path.splitext(file_path)[1].lower().replace('.', '')
-        if original_ext == 'jpeg': original_ext = 'jpg'
-        
+        target_format = export.normalize_format(request.query_params.get('format'))
+        quality = export.parse_quality(request.query_params.get('quality'))
         if not target_format:
-            target_format = original_ext
-        if target_format == 'jpeg': target_format = 'jpg'
+            target_format = export.stored_format(project.processed_image)
 
-        # Optimize: If requested format matches original AND quality is high/default, serve distinct file
-        # But user might want to Compress (quality 50) same format.
-        # Simple Logic: Open, Convert, Save to Buffer.
-        
+        # Simple Logic: Open, Convert, Save to Buffer (the user may want to compress the same format).
         try:
-            with Image.open(file_path) as img:
-                # Convert RGBA to RGB if saving as JPEG
-                if target_format == 'jpg' and img.mode == 'RGBA':
-                    img = img.convert('RGB')
-                
-                # Buffer
-                buffer = io.BytesIO()
-                
-                # Save mapping
-                pil_format = target_format.upper()
-                if pil_format == 'JPG': pil_format = 'JPEG'
-                
-                # Save parameters
-                save_params = {'format': pil_format}
-                if target_format in ['jpg', 'jpeg', 'webp']:
-                    save_params['quality'] = quality
-                    # Optimize for webp
-                    if target_format == 'webp':
-                        save_params['method'] = 6
-                
-                img.save(buffer, **save_params)
-                buffer.seek(0)
-                
-                # Generate filename
-                timestamp = int(time.time())
-                filename = f"fixpix_export_{timestamp}.{target_format}"
-                content_type = mimetypes.guess_type(filename)[0] or f'image/{target_format}'
-                
-                return FileResponse(buffer, as_attachment=True, filename=filename, content_type=content_type)
+            buffer = io.BytesIO(export.encode(project.processed_image, target_format, quality))
+
+            # Generate filename
+            timestamp = int(time.time())
+            filename = f"fixpix_export_{timestamp}.{target_format}"
+            content_type = mimetypes.guess_type(filename)[0] or f'image/{target_format}'
+
+            return FileResponse(buffer, as_attachment=True, filename=filename, content_type=content_type)
         except Exception as e:
-            print(f"Export Error: {e}")
+            logger.error("Export Error: %s", e)
             return Response({'error': 'Error generating export'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['post'])
+    def export(self, request):
+        """
+        Stream a ZIP archive of several processed images (see api.export).
+        Body:
+        - ids: project ids to export (the user's own, with a processed image)
+        - format: 'png', 'jpg', 'jpeg', 'webp' (default: each output's own)
+        - quality: 1-100 (default: 90 when re-encoding, else outputs are copied as stored)
+        """
+        ids = request.data.get('ids')
+        if not isinstance(ids, list) or not ids:
+            return Response({'error': 'ids must be a non-empty list of project ids'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        limit = getattr(django_settings, 'FIXPIX_EXPORT_MAX_PROJECTS', 1000)
+        if limit and len(ids) > limit:
+            return Response({'error': f'At most {limit} projects per export'}, status=status.HTTP_400_BAD_REQUEST)
+
+        target_format = export.normalize_format(request.data.get('format'))
+        if target_format and target_format not in export.FORMATS:
+            return Response({'error': f'Unsupported format: {target_format}'}, status=status.HTTP_400_BAD_REQUEST)
+        quality = request.data.get('quality')
+        quality = export.parse_quality(quality) if quality not in (None, '') else None
+
+        try:
+            # Read here, on the request's thread: the stream may run on other threads
+            projects = list(ImageProject.objects.filter(user_id=self.request.user.id, pk__in=ids)
+                            .exclude(processed_image='').exclude(processed_image__isnull=True)
+                            .only('pk', 'original_image', 'processed_image').order_by('created_at'))
+        except DjangoValidationError:
+            return Response({'error': 'Invalid project id'}, status=status.HTTP_400_BAD_REQUEST)
+        if not projects:
+            return Response({'error': 'No processed images to export'}, status=status.HTTP_404_NOT_FOUND)
+
+        chunks = export.export_zip(projects, target_format, quality)
+        if isinstance(request._request, ASGIRequest):
+            # Django reads plain iterators whole under ASGI
+            chunks = export.stream_async(chunks)
+        response = StreamingHttpResponse(chunks, content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="fixpix_export_{int(time.time())}.zip"'
+        return response
+
+def metrics_view(request):
+    """
+    Expose engine stage histograms in the Prometheus text format.
+
+    Only to FIXPIX_METRICS_ALLOWED_IPS, or with FIXPIX_METRICS_TOKEN as a bearer token.
+    """
+    allowed = request.META.get('REMOTE_ADDR') in getattr(django_settings, 'FIXPIX_METRICS_ALLOWED_IPS', ())
+    token = getattr(django_settings, 'FIXPIX_METRICS_TOKEN', '')
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        allowed = True
+    if not allowed:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def media_view(request, path):
+    """
+    Serve local media. Content-addressed outputs never change, so they are
+    cached for a year without revalidation; other files for a few minutes.
+    """
+    response = serve(request, path, document_root=django_settings.MEDIA_ROOT)
+    response['Cache-Control'] = storage.cache_control(path)
+    return response
+
+
+def job_events(request, job_id):
+    """
+    Stream a local render's progress as Server-Sent Events.
+
+    Events: 'progress' ({stage, completed, total}) after every stage, then
+    'done' ({url}) or 'error' ({error}). The unguessable job id is the
+    credential, since EventSource cannot send an Authorization header.
+
+    Events are read from the job store (see api.executor), so any web
+    process can serve the stream. Django only streams iterators of the
+    server's kind (others are read whole before the first byte is sent),
+    so the stream is an async generator under ASGI and a plain one under
+    WSGI.
+    """
+    job = executor.get_job(job_id)
+    if job is None:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+
+    def message(event, data):
+        if event == 'done':
+            data = dict(data, url=request.build_absolute_uri(data['url']))
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    if isinstance(request, ASGIRequest):
+        read_events = sync_to_async(executor.job_events, thread_sensitive=False)
+
+        async def stream():
+            position = 0
+            while True:
+                events, done = await read_events(job_id, position)
+                for event, data in events:
+                    yield message(event, data)
+                position += len(events)
+                if done:
+                    return
+                await asyncio.sleep(executor.POLL_INTERVAL)
+    else:
+        def stream():
+            position = 0
+            while True:
+                events, done = executor.job_events(job_id, position)
+                for event, data in events:
+                    yield message(event, data)
+                position += len(events)
+                if done:
+                    return
+                time.sleep(executor.POLL_INTERVAL)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep reverse proxies (nginx) from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
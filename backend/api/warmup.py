@@ -0,0 +1,81 @@
+"""
+Worker Warm-Up for FixPix
+
+A fresh worker process would pay for model loading and first-call
+initialisation inside its first job. warm() does that work at process
+start instead (Celery's worker_process_init and the local executor's pool
+initializer):
+
+- opencv: the PNG/JPEG codecs and the filters every render uses, run
+  once on a small image (their first calls build tables and thread pools);
+- faces: the Haar face cascade used by the image statistics;
+- colorizer: the FIXPIX_COLORIZE_MODEL network, when configured;
+- rembg: the FIXPIX_REMBG_MODEL session, when rembg is installed.
+
+Steps are independent: a failing step is logged and the others still
+run. Disabled with FIXPIX_WARMUP.
+"""
+
+import logging
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from . import colorizer, image_stats, segmentation, smoothing
+
+logger = logging.getLogger(__name__)
+
+# Side of the image the OpenCV warm-up runs on
+WARMUP_SIZE = 64
+
+
+def _opencv():
+    img = np.random.default_rng(0).integers(0, 256, (WARMUP_SIZE, WARMUP_SIZE, 3), dtype=np.uint8)
+    for ext in ('.png', '.jpg', '.webp'):
+        ok, buf = cv2.imencode(ext, img)
+        if ok:
+            cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+    cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    cv2.GaussianBlur(img, (5, 5), 0)
+    cv2.resize(img, (WARMUP_SIZE * 2, WARMUP_SIZE * 2), interpolation=cv2.INTER_CUBIC)
+    smoothing.edge_preserving(img, 9, 75, 75, method='bilateral')
+
+
+def _faces():
+    image_stats.faces_detector()
+
+
+def _colorizer():
+    colorizer.get_model()
+
+
+def _rembg():
+    if segmentation.available():
+        segmentation.get_session()
+
+
+STEPS = (
+    ('opencv', _opencv),
+    ('faces', _faces),
+    ('colorizer', _colorizer),
+    ('rembg', _rembg),
+)
+
+
+def warm():
+    """Run the warm-up steps; returns {step: seconds} ({} when FIXPIX_WARMUP is off)."""
+    if not getattr(settings, 'FIXPIX_WARMUP', True):
+        return {}
+    timings = {}
+    for name, step in STEPS:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning("Warm-up step %s failed: %s", name, e)
+        timings[name] = time.perf_counter() - start
+    logger.info("Worker warmed up in %.2fs (%s)", sum(timings.values()),
+                ', '.join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    return timings
@@ -0,0 +1,148 @@
+"""
+Working Image for FixPix
+
+The frame a pipeline run operates on. Stages edit it in the colour space
+they work in ('bgr', 'lab', 'hsv' or 'gray'); conversions happen lazily,
+only when a stage asks for a space the frame is not in, so consecutive
+operations in the same space skip the round-trip through BGR. Only the
+final output is materialised in BGR.
+"""
+
+import cv2
+import numpy as np
+
+from . import memory
+
+
+# Conversions to and from BGR; everything else goes through BGR
+_FROM_BGR = {'lab': cv2.COLOR_BGR2LAB, 'hsv': cv2.COLOR_BGR2HSV, 'gray': cv2.COLOR_BGR2GRAY}
+_TO_BGR = {'lab': cv2.COLOR_LAB2BGR, 'hsv': cv2.COLOR_HSV2BGR, 'gray': cv2.COLOR_GRAY2BGR}
+
+
+class WorkingImage:
+    """
+    A frame held in one current colour space, plus cached read-only views.
+
+    writable(space) converts the frame to `space` if needed and returns
+    the buffer to edit in place; it becomes the current frame and every
+    other view is dropped. Buffers the frame does not own (the caller's
+    input array) are copied before the first edit.
+    """
+
+    def __init__(self, image, space='bgr', owned=False):
+        self.space = space
+        self._views = {space: image}
+        self._owned = {space: owned}
+        # A released 3-channel buffer, reused by the next conversion
+        self._spare = None
+
+    @classmethod
+    def wrap(cls, image, owned=False):
+        """Return `image` if it already is a WorkingImage, else wrap the BGR array."""
+        if isinstance(image, cls):
+            return image
+        return cls(image, owned=owned)
+
+    @property
+    def shape(self):
+        """Shape of the frame in BGR."""
+        image = self._views[self.space]
+        if self.space == 'bgr':
+            return image.shape
+        return image.shape[:2] + (3,)
+
+    @property
+    def nbytes(self):
+        return sum(view.nbytes for view in self._views.values())
+
+    @property
+    def channels(self):
+        """
+        'gray' when the frame is single-channel, else 'bgr'.
+
+        Per-channel operations (contrast, blur, vignette) give the same
+        result on a gray frame and on its BGR copy, so they run in
+        whichever of the two the frame already holds.
+        """
+        return 'gray' if self.space == 'gray' else 'bgr'
+
+    def _buffer(self, shape, dtype):
+        spare = self._spare
+        if spare is not None and spare.shape == shape and spare.dtype == dtype:
+            self._spare = None
+            return spare
+        return memory.track(np.empty(shape, dtype=dtype))
+
+    def buffers(self):
+        """Every array the working image holds: its views and the spare buffer."""
+        arrays = list(self._views.values())
+        if self._spare is not None:
+            arrays.append(self._spare)
+        return arrays
+
+    def borrow(self, shape, dtype=np.uint8):
+        """A temporary buffer for a stage: the spare frame buffer when it fits, else a new array."""
+        return self._buffer(tuple(shape), dtype)
+
+    def _convert(self, src_space, dst_space):
+        src = self._views[src_space]
+        code = _FROM_BGR[dst_space] if src_space == 'bgr' else _TO_BGR[src_space]
+        shape = src.shape[:2] if dst_space == 'gray' else src.shape[:2] + (3,)
+        return cv2.cvtColor(src, code, dst=self._buffer(shape, src.dtype))
+
+    def _set(self, space, image):
+        """Make `image` (owned) the current frame; a dropped owned buffer becomes the spare."""
+        for other, view in self._views.items():
+            if view is not image and self._owned[other] and view.ndim == 3:
+                self._spare = view
+        self.space = space
+        self._views = {space: memory.track(image)}
+        self._owned = {space: True}
+
+    def view(self, space='bgr'):
+        """The frame in `space`, converted and cached if needed. Do not modify it."""
+        if space not in self._views:
+            if self.space != 'bgr' and space != 'bgr':
+                self.view('bgr')
+            src_space = 'bgr' if space != 'bgr' else self.space
+            self._views[space] = self._convert(src_space, space)
+            self._owned[space] = True
+        return self._views[space]
+
+    def writable(self, space='bgr'):
+        """Convert the frame to `space` and return its buffer for in-place edits."""
+        if space in self._views:
+            image = self._views[space]
+            if not self._owned[space]:
+                copy = self._buffer(image.shape, image.dtype)
+                np.copyto(copy, image)
+                image = copy
+        else:
+            if self.space != 'bgr' and space != 'bgr' and 'bgr' not in self._views:
+                # Going through BGR: the old buffer is recycled for the target space
+                self._set('bgr', self._convert(self.space, 'bgr'))
+            image = self._convert('bgr' if space != 'bgr' else self.space, space)
+        self._set(space, image)
+        return image
+
+    def replace(self, image, space='bgr'):
+        """Make a newly computed array the current frame."""
+        self._set(space, image)
+        return self
+
+    def bgr(self):
+        """Materialise the frame as BGR and release every other buffer."""
+        image = self.view('bgr')
+        self._views = {'bgr': image}
+        self._owned = {'bgr': self._owned['bgr']}
+        self.space = 'bgr'
+        self._spare = None
+        return image
+
+    def detach(self):
+        """Hand the BGR frame to the caller and empty the working image."""
+        image = self.bgr()
+        self._views = {}
+        self._owned = {}
+        self.space = None
+        return image
@@ -7,6 +7,7 @@ Images are processed in background workers instead of blocking the main web serv
 
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 
 # Set the default Django settings module
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
@@ -21,6 +22,15 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
+@worker_process_init.connect
+def configure_worker_process(**kwargs):
+    """Size each worker process's thread pools (and pin it when enabled), then preload models."""
+    from billiard.process import current_process
+    from api import compute, warmup
+    compute.configure_worker_process(getattr(current_process(), 'index', None) or 0)
+    warmup.warm()
+
+
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
     """Debug task for testing Celery is working."""
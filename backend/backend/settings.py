@@ -46,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover every other middleware
+    'api.middleware.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -60,7 +62,7 @@ MIDDLEWARE = [
 REST_FRAMEWORK = {
     # Authentication
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.StatelessJWTAuthentication',
     ),
     
     # Rate Limiting (Throttling)
@@ -69,14 +71,17 @@ REST_FRAMEWORK = {
         'rest_framework.throttling.UserRateThrottle',
     ],
     'DEFAULT_THROTTLE_RATES': {
-        'anon': '20/minute',      # Anonymous users: 20 requests/minute
-        'user': '100/minute',     # Authenticated users: 100 requests/minute
+        'anon': os.environ.get('THROTTLE_ANON_RATE', '20/minute'),   # Anonymous users: 20 requests/minute
+        'user': os.environ.get('THROTTLE_USER_RATE', '100/minute'),  # Authenticated users: 100 requests/minute
     },
     
     # Pagination
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
     
+    # `?format=` selects the export format in `download`, not a DRF renderer
+    'URL_FORMAT_OVERRIDE': None,
+
     # Filtering & Ordering
     'DEFAULT_FILTER_BACKENDS': [
         'rest_framework.filters.SearchFilter',
@@ -88,8 +93,14 @@ from datetime import timedelta
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
+    # Tokens carry a hash of the user's password; changing it revokes them
+    'CHECK_REVOKE_TOKEN': True,
 }
 
+# Stateless JWT authentication re-reads each user's active flag and password hash
+# from the database at most once per this many seconds (see api.authentication)
+FIXPIX_AUTH_CACHE_SECONDS = int(os.environ.get('FIXPIX_AUTH_CACHE_SECONDS', '60'))
+
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -192,11 +203,12 @@ if STORAGE_PROVIDER == 's3':
     AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME')
     AWS_S3_REGION_NAME = os.environ.get('AWS_S3_REGION_NAME', 'us-east-1')
     AWS_S3_CUSTOM_DOMAIN = f'{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com'
+    # Content-addressed outputs are uploaded as immutable instead (see api.storage_backends)
     AWS_S3_OBJECT_PARAMETERS = {'CacheControl': 'max-age=86400'}
     AWS_DEFAULT_ACL = 'public-read'
     
     STORAGES = {
-        'default': {'BACKEND': 'storages.backends.s3boto3.S3Boto3Storage'},
+        'default': {'BACKEND': 'api.storage_backends.OutputsS3Storage'},
         'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
     }
     MEDIA_URL = f'https://{AWS_S3_CUSTOM_DOMAIN}/media/'
@@ -220,7 +232,104 @@ elif STORAGE_PROVIDER == 'cloudinary':
 else:
     # Local storage (default for development)
     MEDIA_URL = '/media/'
-    MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+    MEDIA_ROOT = os.environ.get('MEDIA_ROOT', os.path.join(BASE_DIR, 'media'))
+
+# Celery Configuration
+# Redis in production; the in-memory broker runs tasks eagerly in-process for local development
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'memory://')
+CELERY_TASK_ALWAYS_EAGER = CELERY_BROKER_URL.startswith('memory://')
+
+# AI Engine Configuration
+# Per-stage peak memory measured with tracemalloc while jobs run. Off by default: tracing makes
+# every Python allocation in the process several times slower, and its peaks are process-wide
+FIXPIX_TRACE_MEMORY = os.environ.get('FIXPIX_TRACE_MEMORY', 'False').lower() in ('true', '1', 'yes')
+
+# /api/metrics/ is served to these client addresses, or to requests with the bearer token when one is set
+FIXPIX_METRICS_ALLOWED_IPS = [ip.strip() for ip in os.environ.get('FIXPIX_METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()]
+FIXPIX_METRICS_TOKEN = os.environ.get('FIXPIX_METRICS_TOKEN', '')
+
+# Low-memory mode: in-place stages and a per-job peak of FACTOR x the largest frame
+# (can also be enabled per request with settings.lowMemory)
+FIXPIX_LOW_MEMORY = os.environ.get('FIXPIX_LOW_MEMORY', 'False').lower() in ('true', '1', 'yes')
+FIXPIX_MEMORY_BUDGET_FACTOR = float(os.environ.get('FIXPIX_MEMORY_BUDGET_FACTOR', '4'))
+
+# Outputs larger than this (megapixels) render out-of-core through memory-mapped files (0 disables)
+FIXPIX_OUT_OF_CORE_MEGAPIXELS = float(os.environ.get('FIXPIX_OUT_OF_CORE_MEGAPIXELS', '150'))
+FIXPIX_SCRATCH_DIR = os.environ.get('FIXPIX_SCRATCH_DIR', '')  # Defaults to the system temp dir
+
+# API request instrumentation: Server-Timing response header, and a warning with the
+# slowest queries for requests slower than SLOW_REQUEST_MS (0 disables the log)
+FIXPIX_SERVER_TIMING = os.environ.get('FIXPIX_SERVER_TIMING', 'True').lower() in ('true', '1', 'yes')
+FIXPIX_SLOW_REQUEST_MS = float(os.environ.get('FIXPIX_SLOW_REQUEST_MS', '1000'))
+
+# Edge-preserving smoothing backend: 'high' (bilateral filter), 'balanced' (guided filter)
+# or 'fast' (bilateral grid); renders can override it with settings.quality
+FIXPIX_SMOOTHING_QUALITY = os.environ.get('FIXPIX_SMOOTHING_QUALITY', 'high')
+
+# Learned colorization: a local ONNX model (empty keeps the sepia tone), run on an
+# L-channel proxy of SIZE x SIZE pixels (see api.colorizer)
+FIXPIX_COLORIZE_MODEL = os.environ.get('FIXPIX_COLORIZE_MODEL', '')
+FIXPIX_COLORIZE_SIZE = int(os.environ.get('FIXPIX_COLORIZE_SIZE', '224'))
+
+# Background removal model for rembg (when installed); one session per worker process
+FIXPIX_REMBG_MODEL = os.environ.get('FIXPIX_REMBG_MODEL', 'u2net')
+
+# Preload models and OpenCV resources when a worker process starts (see api.warmup)
+FIXPIX_WARMUP = os.environ.get('FIXPIX_WARMUP', 'True').lower() in ('true', '1', 'yes')
+
+# CPU scheduling: jobs running at once per container (also the Celery worker concurrency),
+# threads per job (0 = automatic: 1 for small jobs, cores / concurrency otherwise)
+# and optional pinning of each worker process to its own cores
+FIXPIX_WORKER_CONCURRENCY = int(os.environ.get('FIXPIX_WORKER_CONCURRENCY', '2'))
+FIXPIX_THREADS_PER_JOB = int(os.environ.get('FIXPIX_THREADS_PER_JOB', '0'))
+FIXPIX_SMALL_JOB_MEGAPIXELS = float(os.environ.get('FIXPIX_SMALL_JOB_MEGAPIXELS', '1'))
+FIXPIX_CPU_PINNING = os.environ.get('FIXPIX_CPU_PINNING', 'False').lower() in ('true', '1', 'yes')
+CELERY_WORKER_CONCURRENCY = FIXPIX_WORKER_CONCURRENCY
+
+# Local executor (renders in a process pool of the web process, progress over SSE);
+# 0 uses FIXPIX_WORKER_CONCURRENCY processes
+FIXPIX_LOCAL_WORKERS = int(os.environ.get('FIXPIX_LOCAL_WORKERS', '0'))
+
+# Duplicate renders (same project and settings) attach to the one in flight; with a Redis
+# URL (e.g. redis://redis:6379/1) this also spans web processes. Locks expire after the timeout
+FIXPIX_SINGLE_FLIGHT_URL = os.environ.get('FIXPIX_SINGLE_FLIGHT_URL', '')
+FIXPIX_SINGLE_FLIGHT_TIMEOUT = int(os.environ.get('FIXPIX_SINGLE_FLIGHT_TIMEOUT', '900'))
+
+# Local executor jobs and their progress events, shared by every web process through Redis
+# (defaults to the single-flight Redis; empty keeps them in the memory of one process)
+FIXPIX_JOB_STORE_URL = os.environ.get('FIXPIX_JOB_STORE_URL', FIXPIX_SINGLE_FLIGHT_URL)
+
+# Threads uploading rendered outputs to the default storage in the background
+FIXPIX_UPLOAD_WORKERS = int(os.environ.get('FIXPIX_UPLOAD_WORKERS', '2'))
+
+# Output encoding defaults (requests override them with settings.output); an empty
+# format keeps the original's extension
+FIXPIX_OUTPUT_FORMAT = os.environ.get('FIXPIX_OUTPUT_FORMAT', '')
+FIXPIX_PNG_COMPRESSION = int(os.environ.get('FIXPIX_PNG_COMPRESSION', '1'))
+FIXPIX_JPEG_QUALITY = int(os.environ.get('FIXPIX_JPEG_QUALITY', '95'))
+FIXPIX_JPEG_PROGRESSIVE = os.environ.get('FIXPIX_JPEG_PROGRESSIVE', 'False').lower() in ('true', '1', 'yes')
+FIXPIX_JPEG_OPTIMIZE = os.environ.get('FIXPIX_JPEG_OPTIMIZE', 'False').lower() in ('true', '1', 'yes')
+FIXPIX_WEBP_QUALITY = int(os.environ.get('FIXPIX_WEBP_QUALITY', '90'))
+FIXPIX_WEBP_METHOD = int(os.environ.get('FIXPIX_WEBP_METHOD', '4'))
+
+# Node-local cache of decoded originals, memory-mapped by every worker (0 disables)
+FIXPIX_DECODE_CACHE_DIR = os.environ.get('FIXPIX_DECODE_CACHE_DIR', '')  # Defaults to <system temp>/fixpix-decoded
+FIXPIX_DECODE_CACHE_MB = float(os.environ.get('FIXPIX_DECODE_CACHE_MB', '2048'))
+
+# Media garbage collection: byte quotas for processed outputs (0 = unlimited), least
+# recently rendered evicted first; unreferenced files younger than the grace period are kept
+FIXPIX_MEDIA_USER_QUOTA_MB = float(os.environ.get('FIXPIX_MEDIA_USER_QUOTA_MB', '0'))
+FIXPIX_MEDIA_QUOTA_MB = float(os.environ.get('FIXPIX_MEDIA_QUOTA_MB', '0'))
+FIXPIX_MEDIA_GC_GRACE_SECONDS = int(os.environ.get('FIXPIX_MEDIA_GC_GRACE_SECONDS', '3600'))
+
+# Bulk ZIP exports: projects per request (0 = unlimited) and encoding threads (0 = the process's share)
+FIXPIX_EXPORT_MAX_PROJECTS = int(os.environ.get('FIXPIX_EXPORT_MAX_PROJECTS', '1000'))
+FIXPIX_EXPORT_WORKERS = int(os.environ.get('FIXPIX_EXPORT_WORKERS', '0'))
+
+# Bulk uploads: files per request (0 = unlimited; DATA_UPLOAD_MAX_NUMBER_FILES still applies)
+# and background rendering of the new projects' preview sheets and statistics
+FIXPIX_BULK_UPLOAD_MAX_FILES = int(os.environ.get('FIXPIX_BULK_UPLOAD_MAX_FILES', '100'))
+FIXPIX_BULK_PREPARE = os.environ.get('FIXPIX_BULK_PREPARE', 'True').lower() in ('true', '1', 'yes')
 
 # CORS Configuration
 # CORS_ALLOWED_ORIGINS = [